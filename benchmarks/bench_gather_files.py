@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Count file system calls and wall time of gathering .continuous files for a directory of
+128 channels x several sub_ids. The legacy approach (glob, then rebuilding and stat'ing every
+candidate file name) is reproduced here for comparison with open_ephys.gather_files.
+
+Usage: python benchmarks/bench_gather_files.py [n_channels] [n_sub_ids]
+"""
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from unittest import mock
+
+from dataman.formats import open_ephys as oe
+
+N_REPEATS = 20
+
+
+def legacy_gather_files(target_directory, proc_node, channel_type='CH', template=oe.NAME_TEMPLATE):
+    target_path = Path(target_directory).resolve()
+    glob = template.format(proc_node=proc_node, channel_type=channel_type, channel='*', sub_id='')
+    ids = []
+    for name in [g.name for g in target_path.glob(glob)]:
+        id_str = name[name.index(channel_type) + len(channel_type):name.index(oe.FMT_FEXT)]
+        channel, _, sub_id = id_str.partition('_')
+        ids.append((int(sub_id) if sub_id else -1, int(channel)))
+    sub_ids, channels = map(set, zip(*ids))
+
+    files = {}
+    for sid in sorted(sub_ids):
+        sub_files = {}
+        for channel in sorted(channels):
+            filename = template.format(proc_node=proc_node, channel=channel, channel_type=channel_type,
+                                       sub_id='' if sid == -1 else '_{}'.format(sid))
+            if not (target_path / filename).exists():
+                raise FileNotFoundError(filename)
+            sub_files[channel - 1] = str(target_path / filename)
+        files[sid] = sub_files
+    return files
+
+
+def count_calls(func, *args, **kwargs):
+    """Run func once, counting calls of stat-like and directory listing functions."""
+    counts = Counter()
+    wrapped = {}
+    for name in ['stat', 'lstat', 'scandir', 'listdir']:
+        original = getattr(os, name)
+
+        def counting(*a, _name=name, _original=original, **kw):
+            counts[_name] += 1
+            return _original(*a, **kw)
+        wrapped[name] = counting
+
+    with mock.patch.multiple(os, **wrapped):
+        func(*args, **kwargs)
+    return counts
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    for _ in range(N_REPEATS):
+        func(*args, **kwargs)
+    return (time.perf_counter() - start) / N_REPEATS
+
+
+def main(n_channels=128, n_sub_ids=4):
+    with tempfile.TemporaryDirectory() as target:
+        for sid in [-1] + list(range(n_sub_ids - 1)):
+            for channel in range(1, n_channels + 1):
+                Path(target, oe.NAME_TEMPLATE.format(proc_node=100, channel_type='CH', channel=channel,
+                                                     sub_id='' if sid == -1 else '_{}'.format(sid))).touch()
+
+        print('{} channels x {} sub_ids'.format(n_channels, n_sub_ids))
+        for name, func in [('legacy glob + exists', legacy_gather_files), ('scandir + regex', oe.gather_files)]:
+            counts = count_calls(func, target, '100')
+            print('{:>22}: {:5d} stat, {:3d} listing calls, {:7.2f} ms'.format(
+                name, counts['stat'] + counts['lstat'], counts['scandir'] + counts['listdir'],
+                timed(func, target, '100') * 1000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
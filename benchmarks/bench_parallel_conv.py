@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Wall time of dm conv for a synthetic session of several recordings, converted with 1, 2 and 4 jobs. With .dat
+outputs, the recordings are converted in parallel, each into its own part of the outputs.
+
+Usage: python benchmarks/bench_parallel_conv.py [n_recordings] [n_channels] [n_records]
+"""
+import os.path as op
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from dataman.conv import convert
+from dataman.formats import open_ephys as oe
+
+JOBS = [1, 2, 4]
+
+SETTINGS = """<?xml version="1.0"?>
+<SETTINGS><INFO><VERSION>0.4.4</VERSION><DATE>1 Jan 2020</DATE><OS>Linux</OS><MACHINE>m</MACHINE></INFO>
+<SIGNALCHAIN><PROCESSOR name="Sources/Rhythm FPGA" NodeId="100"/><PROCESSOR name="Sinks/Record" NodeId="101"/>
+</SIGNALCHAIN><AUDIO bufferSize="1024"/></SETTINGS>"""
+
+HEADER = "header.format = 'Open Ephys Data Format'; \nheader.version = 0.4;\nheader.header_bytes = 1024;\n" \
+         "header.description = 'x';\nheader.date_created = '1-Jan-2020 000000';\nheader.channel = 'CH{channel}';\n" \
+         "header.channelType = 'Continuous';\nheader.sampleRate = 30000;\nheader.blockLength = 1024;\n" \
+         "header.bufferSize = 1024;\nheader.bitVolts = 0.195;\n"
+
+
+def write_recording(path, n_channels, n_records, seed=0):
+    """Recording directory of n_channels .continuous files with n_records records of noise each."""
+    path.mkdir()
+    (path / 'settings.xml').write_text(SETTINGS)
+    rng = np.random.RandomState(seed)
+    for channel in range(1, n_channels + 1):
+        records = np.zeros(n_records, dtype=oe.DATA_DT)
+        records['timestamp'] = np.arange(n_records) * oe.NUM_SAMPLES
+        records['n_samples'] = oe.NUM_SAMPLES
+        records['samples'] = rng.randint(-2000, 2000, size=(n_records, oe.NUM_SAMPLES))
+        records['rec_mark'] = oe.REC_MARKER
+        file_path = path / oe.NAME_TEMPLATE.format(proc_node=100, channel_type='CH', channel=channel, sub_id='')
+        with open(str(file_path), 'wb') as fid:
+            fid.write(HEADER.format(channel=channel).encode().ljust(oe.SIZE_HEADER))
+            records.tofile(fid)
+
+
+def main(n_recordings=4, n_channels=32, n_records=300):
+    with tempfile.TemporaryDirectory() as tmp:
+        targets = []
+        for n in range(n_recordings):
+            targets.append(Path(tmp, 'rec{:02d}'.format(n)))
+            write_recording(targets[-1], n_channels, n_records, seed=n)
+        n_bytes = n_recordings * n_channels * n_records * oe.NUM_SAMPLES * 2
+
+        print('{} recordings x {} channels x {} records ({:.1f} MB)'.format(n_recordings, n_channels, n_records,
+                                                                          n_bytes / 1e6))
+        for jobs in JOBS:
+            out_path = op.join(tmp, 'out{}'.format(jobs))
+            start = time.perf_counter()
+            convert.main(list(map(str, targets)) + ['-o', out_path, '-N', str(jobs)])
+            elapsed = time.perf_counter() - start
+            print('{:>2} jobs: {:7.2f} s, {:7.2f} MB/s'.format(jobs, elapsed, n_bytes / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,92 @@
+import argparse
+import logging
+import os
+import os.path as op
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from tqdm import tqdm
+
+from dataman.formats import open_ephys as oe
+from dataman.lib import util, chunking
+
+logger = logging.getLogger(__name__)
+
+LOG_STR_ISSUE = '{fname}: {n} {issue} (first at record {first})'
+ISSUES = {'bad_rec_mark': 'corrupt record markers',
+          'bad_n_samples': 'records with unexpected sample count',
+          'bad_timestamps': 'non-increasing record timestamps'}
+
+
+def gather_continuous_files(targets):
+    """List all .continuous files in the target directories, or the targets themselves if they are files."""
+    files = []
+    for target in targets:
+        target = Path(target)
+        if target.is_dir():
+            files.extend(sorted(target.glob('*' + oe.FMT_FEXT)))
+        elif target.suffix == oe.FMT_FEXT:
+            files.append(target)
+        else:
+            logger.warning('Skipping {}, not a directory or {} file.'.format(target, oe.FMT_FEXT))
+    return files
+
+
+def report_file(result):
+    """Log issues found in a single file. Returns True if the file is intact."""
+    fname = op.basename(result['FILEPATH'])
+    intact = True
+    if result['trailing_bytes']:
+        logger.error('{}: {} trailing bytes, last record incomplete'.format(fname, result['trailing_bytes']))
+        intact = False
+
+    for key, issue in ISSUES.items():
+        if len(result[key]):
+            logger.error(LOG_STR_ISSUE.format(fname=fname, n=len(result[key]), issue=issue, first=result[key][0]))
+            intact = False
+
+    if intact:
+        logger.debug('{}: {} records OK'.format(fname, result['n_records']))
+    return intact
+
+
+def main(args):
+    parser = argparse.ArgumentParser('Verify integrity of raw data files before processing.')
+    parser.add_argument('target', nargs='*', default=['.'],
+                        help="""Path/list of paths to directories containing raw .continuous data, single
+                                .continuous files OR path to .session definition file.""")
+    parser.add_argument('-N', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of files checked in parallel. Default: number of CPUs')
+    chunking.add_memory_argument(parser)
+
+    cli_args = parser.parse_args(args)
+    logger.debug('Arguments: {}'.format(cli_args))
+    chunking.apply_memory_argument(cli_args)
+
+    from dataman.conv.convert import expand_sessions
+    targets = [util.full_path(t) for t in expand_sessions(cli_args.target)]
+    files = gather_continuous_files(targets)
+    if not len(files):
+        logger.error('No {} files found in {}'.format(oe.FMT_FEXT, targets))
+        sys.exit(1)
+
+    logger.info('Checking {} files with {} workers'.format(len(files), cli_args.jobs))
+    n_bytes = sum([op.getsize(f) for f in files])
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, cli_args.jobs)) as pool:
+        # records of a file validated at once, the budget is shared by the workers
+        chunk_records = chunking.plan_size('check', 1, itemsize=oe.SIZE_RECORD, workers=cli_args.jobs)
+        futures = [pool.submit(oe.verify_records, str(f), chunk_records) for f in files]
+        with tqdm(total=n_bytes, unit='B', unit_scale=True) as pbar:
+            for future in as_completed(futures):
+                result = future.result()
+                if not report_file(result):
+                    failed.append(result['FILEPATH'])
+                pbar.update(op.getsize(result['FILEPATH']))
+
+    if len(failed):
+        logger.error('{} of {} files failed verification.'.format(len(failed), len(files)))
+        sys.exit(1)
+
+    logger.info('All {} files ({}) passed verification.'.format(len(files), util.fmt_size(n_bytes).strip()))
@@ -1,12 +1,17 @@
 import numpy as np
+import json
 import logging
 import os
 import os.path as op
-from dataman.lib import util
+import tempfile
+from dataman.lib import util, chunking
 from dataman.formats import get_valid_formats
 from dataman.formats import open_ephys as oe
-import pprint
-from contextlib import ExitStack
+from dataman.formats import open_ephys_binary as oebin
+from dataman.formats import kwik
+from dataman.formats import dat, hdf5
+from contextlib import ExitStack, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import time
 import tqdm
 import argparse
@@ -32,6 +37,9 @@ LOG_STR_ITEM = ', Header: channel: {header[channel]}, date: {header[date_created
 DEBUG_STR_CHUNK = 'Reading {count} records (left: {left}, max: {num_records})'
 DEBUG_STR_REREF = 'Re-referencing by subtracting average of channels {channels}'
 DEBUG_STR_ZEROS = 'Zeroing (Flag: {flag}) dead channel {channel}'
+LOG_STR_GAPS = 'Sub_id {sub_id}: {n_gaps} gaps ({n_missing} blocks zero-filled), {n_dropped} duplicate records dropped'
+LOG_STR_COPIED = '{n_channels} channels, {n_samples} samples ({dur:s}, {bw:.2f} MB) in {et:.2f} s ({ts:.2f} MB/s)'
+LOG_STR_METADATA = 'Metadata of {n} targets in {wall:.2f} s ({seq:.2f} s sequential, {saved:.2f} s saved)'
 
 MODE_STR = {'a': 'Append', 'w': "Write"}
 MODE_STR_PAST = {'a': 'Appended', 'w': "Wrote"}
@@ -39,6 +47,21 @@ MODE_STR_PAST = {'a': 'Appended', 'w': "Wrote"}
 DEFAULT_FULL_TEMPLATE = '{prefix}--cg({cg_id:02})_ch[{crs}]'
 DEFAULT_SHORT_TEMPLATE = '{prefix}--cg{cg_id:02}'
 
+# Stages of dm ref and dm split that can be applied while converting
+PIPELINE_STAGES = ['ref', 'split']
+PIPELINE_REF_LABEL = '_meanref'
+PIPELINE_SPLIT_PREFIX = 'tetrode'
+
+# Targets whose metadata is read at once, each reading up to open_ephys.HEADER_WORKERS file headers in parallel
+METADATA_WORKERS = 4
+
+# Progress of .dat conversions, next to the first output, see Checkpoint
+CHECKPOINT_SUFFIX = '.dataman.checkpoint'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_INTERVAL = 1.
+# Records stepped back from the checkpoint of a target before converting it from the start, see resume_progress
+VERIFY_RECORDS = 4
+
 
 def expand_sessions(lot):
     """Check if item in target list is a .session file. If so, read all lines as
@@ -58,52 +81,177 @@ def expand_sessions(lot):
     return targets
 
 
-def continuous_to_dat(target_metadata, output_path, channel_group,
-                      file_mode='w', chunk_records=1000, duration=0,
-                      dead_channel_ids=None, zero_dead_channels=True):
+def gather_metadata(format_input, targets, **kwargs):
+    """Read metadata of all targets concurrently. Header reading is bound by storage latency, so targets
+    are handled by a thread pool of up to METADATA_WORKERS threads, each target may read its own file headers in
+    parallel as well.
+
+    Args:
+        format_input: Format module of the targets
+        targets: List of target paths
+        **kwargs: Passed on to metadata_from_target of the format
+
+    Returns:
+        List of metadata dictionaries, in order of the targets.
+    """
+    def timed_metadata(target):
+        t_start = time.time()
+        metadata = format_input.metadata_from_target(target, **kwargs)
+        return metadata, time.time() - t_start
+
+    start_t = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, min(METADATA_WORKERS, len(targets)))) as pool:
+        results = list(pool.map(timed_metadata, targets))
+    elapsed = time.time() - start_t
+
+    sequential = sum([duration for _, duration in results])
+    logger.log(level=LOG_LEVEL_VERBOSE,
+               msg=LOG_STR_METADATA.format(n=len(targets), wall=elapsed, seq=sequential,
+                                           saved=max(0., sequential - elapsed)))
+    return [metadata for metadata, _ in results]
+
+
+def bit_volts(target_metadata, channel):
+    """Microvolts per bit of a channel, from the file metadata or the .continuous file header."""
+    file_metadata = next(iter(target_metadata['SUBSETS'].values()))['FILES'][channel]
+    if 'BIT_VOLTS' in file_metadata:
+        return float(file_metadata['BIT_VOLTS'])
+    return float(oe.read_header(file_metadata['FILEPATH'])['bitVolts'])
+
+
+def has_side_files(output_path):
+    """Plain and compressed .dat outputs come with .log, .dman, .dataman.offsets, metadata sidecar and .prb files.
+    .h5 outputs describe themselves in their attributes."""
+    return dat.container_format(output_path) is not hdf5
+
+
+def open_dman(output_path):
+    """Segment table of the targets appended to an output, nothing for outputs without side files."""
+    return open(output_path + '.dman', 'a') if has_side_files(output_path) else nullcontext()
+
+
+def group_rows(channel_group, dead_channel_ids, rows):
+    """Rows of the data and reference channels of a channel group in the block of channels read per chunk, and
+    the indices of its dead channels."""
+    data_channel_ids = channel_group['channels']
+    ref_channel_ids = [rid for rid in channel_group['reference']] if "reference" in channel_group else []
+    dead_channels_indices = [data_channel_ids.index(dc) for dc in dead_channel_ids if dc in data_channel_ids]
+    return [rows[cid] for cid in data_channel_ids], [rows[rid] for rid in ref_channel_ids], dead_channels_indices
+
+
+def subtract_mean(samples, mean):
+    """Subtract a float32 average from integer samples, truncating like dm ref does when subtracting its
+    reference file."""
+    return (samples - mean).astype(samples.dtype)
+
+
+def continuous_to_dat(target_metadata, outputs,
+                      file_mode='w', duration=0,
+                      dead_channel_ids=None, zero_dead_channels=True, fill_gaps=False, type_outputs=None,
+                      compression=None, mean_reference=None, start=None, skip=0, count=None, progress=None):
+    """Convert the records of all subsets of a target into flat int16 .dat files, one per channel group.
+
+    outputs is a list of (output_path, channel_group) tuples. The record stream is walked once: every chunk of
+    records is read for the union of data and reference channels of all groups, each input file exactly once,
+    and fanned out to the group outputs. Reference averages shared by several groups are computed once per chunk.
+
+    With fill_gaps, records are placed by their timestamps. Blocks missing from the record stream are written
+    as zeros and duplicated records are dropped, keeping the output aligned with the acquisition clock.
+
+    type_outputs maps additional channel types (e.g. AUX, ADC) to output paths. All channels of those types,
+    gathered by metadata_from_target into TYPES, are written to their own file within the same pass over
+    the records.
+
+    mean_reference is a list of channels whose average is subtracted from all outputs before dead channels are
+    zeroed, the common average reference of dm ref computed per chunk, see subtract_mean.
+
+    With start, the samples are written from that sample on into existing .dat outputs instead of by file_mode,
+    see conversion_schedule. The caller then keeps the .dman segment tables. skip and count select the samples
+    [skip, skip + count) of the target, in whole records, e.g. to resume an interrupted conversion. progress is
+    called with the number of samples written so far after every chunk, once the outputs are flushed.
+
+    The outputs are compressed .datz or chunked .h5 files if the output paths have that extension, compressed
+    with the given codec or filter, see dat.create_writer.
+    """
     start_t = time.time()
 
-    # Logging
-    file_handler = logging.FileHandler(output_path + '.log')
+    # Logging, the log of every output covers the shared pass
+    file_handlers = [logging.FileHandler(output_path + '.log') for output_path, _ in outputs
+                     if has_side_files(output_path)]
     formatter = logging.Formatter('%(message)s')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    for file_handler in file_handlers:
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
     logger.log(level=LOG_LEVEL_VERBOSE, msg='Target metadata: {}'.format(pformat(target_metadata, indent=2)))
 
     # NOTE: Channel numbers zero-based in configuration, but not in file name space. Grml.
-    data_channel_ids = channel_group['channels']
-    ref_channel_ids = [rid for rid in channel_group['reference']] if "reference" in channel_group else []
     dead_channel_ids = [did for did in dead_channel_ids]
     logger.debug("Zeroing dead channels: {}, dead (OE) channels: {}".format(zero_dead_channels, dead_channel_ids))
-    dead_channels_indices = [data_channel_ids.index(dc) for dc in dead_channel_ids if dc in data_channel_ids]
+
+    # Every data or reference channel of any group is read once per chunk, into its own row
+    mean_reference = [] if mean_reference is None else mean_reference
+    read_channel_ids = list(dict.fromkeys([ch for _, cg in outputs for ch in cg['channels'] + cg.get('reference', [])]
+                                          + mean_reference))
+    rows = {ch: row for row, ch in enumerate(read_channel_ids)}
+    groups = [group_rows(channel_group, dead_channel_ids, rows) for _, channel_group in outputs]
+    mean_rows = [rows[ch] for ch in mean_reference]
+    n_channels_out = sum([len(data_rows) for data_rows, _, _ in groups])
+
+    target_rate = next(iter(target_metadata['SUBSETS'].values()))['JOINT_HEADERS']['sampling_rate']
 
     try:
-        logger.debug('Opening output file {} in filemode {}'.format(output_path, file_mode + 'b'))
-        with ExitStack() as stack,\
-                open(output_path, file_mode + 'b') as out_fid_dat,\
-                open(output_path + '.dman', 'a') as dman_offset_file:
+        with ExitStack() as stack, oe.FilePool() as pool:
+            out_dats = []
+            dman_offset_files = []
+            for output_path, channel_group in outputs:
+                logger.debug('Opening output file {} in filemode {}'.format(output_path, file_mode + 'b'))
+                out_dats.append(stack.enter_context(
+                    dat.create_writer(output_path, len(channel_group['channels']), sampling_rate=target_rate,
+                                      mode=file_mode, compression=compression, start=start)))
+                dman_offset_files.append(stack.enter_context(open_dman(output_path) if start is None
+                                                             else nullcontext()))
+
+            type_outputs = {} if type_outputs is None else type_outputs
+            type_fids = {ctype: stack.enter_context(
+                dat.create_writer(path, len(target_metadata['TYPES'][ctype]['CHANNELS']), sampling_rate=target_rate,
+                                  mode=file_mode, compression=compression, start=start))
+                for ctype, path in type_outputs.items()}
 
             data_duration = 0
             samples_written = 0
+            skip_left = int(skip)
+            count_left = None if count is None else int(count)
 
             # Loop over all sub-recordings
             for sub_id, subset in target_metadata['SUBSETS'].items():
                 logger.debug('Converting sub_id {}'.format(sub_id))
-                data_file_paths = [subset['FILES'][cid]['FILEPATH'] for cid in data_channel_ids]
-                ref_file_paths = [subset['FILES'][rid]['FILEPATH'] for rid in ref_channel_ids]
-                logger.log(level=LOG_LEVEL_VERBOSE, msg=data_file_paths)
-
-                data_files = [stack.enter_context(oe.ContinuousFile(f)) for f in data_file_paths]
-                ref_files = [stack.enter_context(oe.ContinuousFile(f)) for f in ref_file_paths]
-                for oe_file in data_files:
-                    logger.log(level=LOG_LEVEL_VERBOSE, msg="Open data file: {}".format(op.basename(oe_file.path)) +
-                                                            LOG_STR_ITEM.format(header=oe_file.header))
-                for oe_file in ref_files:
-                    logger.log(level=LOG_LEVEL_VERBOSE,
-                               msg="Open reference file: {}".format(op.basename(oe_file.path)) +
-                                   LOG_STR_ITEM.format(header=oe_file.header))
-
-                n_blocks = subset['JOINT_HEADERS']['n_blocks']
+                read_file_paths = [subset['FILES'][cid]['FILEPATH'] for cid in read_channel_ids]
+                logger.log(level=LOG_LEVEL_VERBOSE, msg=read_file_paths)
+
+                type_file_paths = {}
+                for ctype in type_fids:
+                    type_subset = target_metadata['TYPES'][ctype]['SUBSETS'][sub_id]
+                    if type_subset['JOINT_HEADERS']['n_blocks'] != subset['JOINT_HEADERS']['n_blocks']:
+                        raise ValueError('{} channels of sub_id {} not aligned with data channels'.format(
+                            ctype, sub_id))
+                    type_file_paths[ctype] = [type_subset['FILES'][ch]['FILEPATH']
+                                              for ch in sorted(type_subset['FILES'])]
+                all_file_paths = read_file_paths + [f for paths in type_file_paths.values() for f in paths]
+                for file_path in read_file_paths:
+                    logger.log(level=LOG_LEVEL_VERBOSE, msg="Open data file: {}".format(op.basename(file_path)) +
+                                                            LOG_STR_ITEM.format(header=pool.get(file_path).header))
+
+                if fill_gaps:
+                    timeline = subset['TIMELINE'] if 'TIMELINE' in subset \
+                        else oe.timeline_from_file(read_file_paths[0])
+                    gap_records, gap_positions = oe.record_positions(timeline)
+                    n_blocks = timeline['n_blocks']
+                    if len(timeline['gaps']) or len(timeline['dropped']):
+                        logger.warning(LOG_STR_GAPS.format(sub_id=sub_id, n_gaps=len(timeline['gaps']),
+                                                           n_missing=sum([g[1] for g in timeline['gaps']]),
+                                                           n_dropped=len(timeline['dropped'])))
+                else:
+                    n_blocks = subset['JOINT_HEADERS']['n_blocks']
                 sampling_rate = subset['JOINT_HEADERS']['sampling_rate']
                 # buffer_size = subset['JOINT_HEADERS']['buffer_size']
                 block_size = subset['JOINT_HEADERS']['block_size']
@@ -115,63 +263,515 @@ def continuous_to_dat(target_metadata, output_path, channel_group,
                     epsilon = 1 / sampling_rate * block_size * 1000
                     logger.warning(
                         "Remaining duration limit ({:.0f} ms) less than duration of single block ({:.0f} ms). "
-                        "Skipping target.".format(duration * 1000, epsilon))
-                    return 0
+                        "Skipping rest of target.".format(duration * 1000, epsilon))
+                    break
+
+                # records before skip are already in the outputs, stop after count samples
+                block = min(records_left, skip_left // block_size)
+                skip_left -= block * block_size
+                records_left -= block
+                if count_left is not None:
+                    records_left = min(records_left, count_left // block_size)
+                    count_left -= records_left * block_size
+                if records_left < 1:
+                    continue
 
-                # loop over all records, in chunk sizes
+                # loop over all records, in chunks of records planned from the memory budget
                 bytes_written = 0
+                planner = chunking.ChunkPlanner('conv', len(all_file_paths), align=block_size)
                 pbar = tqdm.tqdm(total=records_left * 1024, unit_scale=True, unit='Samples')
-                while records_left:
-                    count = min(records_left, chunk_records)
+                for first, last in planner.spans(0, records_left * block_size):
+                    n_read = (last - first) // block_size
 
-                    logger.log(level=LOG_LEVEL_VERBOSE, msg=DEBUG_STR_CHUNK.format(count=count, left=records_left,
+                    logger.log(level=LOG_LEVEL_VERBOSE, msg=DEBUG_STR_CHUNK.format(count=n_read, left=records_left,
                                                                                    num_records=n_blocks))
-                    res = np.vstack([f.read_record(count) for f in data_files])
-
-                    # reference channels if needed
-                    if len(ref_channel_ids):
-                        logger.debug(DEBUG_STR_REREF.format(channels=ref_channel_ids))
-                        res -= np.vstack([f.read_record(count) for f in ref_files]).mean(axis=0, dtype=np.int16)
-
-                    # zero dead channels if needed
-                    if len(dead_channels_indices) and zero_dead_channels:
-                        zeros = np.zeros_like(res[0])
-                        for dci in dead_channels_indices:
-                            logger.debug(DEBUG_STR_ZEROS.format(flag=zero_dead_channels, channel=data_channel_ids[dci]))
-                            res[dci] = zeros
-
-                    res.transpose().tofile(out_fid_dat)
-
-                    records_left -= count
-                    pbar.update(count * 1024)
-                    samples_written += count * 1024
-                    bytes_written += (count * 2048 * len(data_channel_ids))
+                    if fill_gaps:
+                        # place the records falling into the current window of blocks, rest stays zero
+                        lo, hi = np.searchsorted(gap_positions, [block, block + n_read])
+                        chunks = pool.read_blocks(all_file_paths, gap_records[lo:hi], gap_positions[lo:hi] - block,
+                                                  n_read)
+                    else:
+                        chunks = pool.read([(f, block * block_size, n_read * block_size) for f in all_file_paths])
+
+                    # other channel types go straight to their outputs
+                    type_chunk = len(read_file_paths)
+                    for ctype, paths in type_file_paths.items():
+                        type_fids[ctype].write(chunks[type_chunk:type_chunk + len(paths)].transpose())
+                        type_chunk += len(paths)
+
+                    ref_means = {}
+                    # same precision and order of summation as the reference file of dm ref
+                    mean = np.ascontiguousarray(chunks[mean_rows].T).mean(axis=1, dtype=np.float32) \
+                        if len(mean_rows) else None
+                    for out_dat, (data_rows, ref_rows, dead_channels_indices) in zip(out_dats, groups):
+                        res = chunks[data_rows]
+
+                        # reference channels if needed, average computed once for groups sharing references
+                        if len(ref_rows):
+                            logger.debug(DEBUG_STR_REREF.format(channels=[read_channel_ids[r] for r in ref_rows]))
+                            if tuple(ref_rows) not in ref_means:
+                                ref_means[tuple(ref_rows)] = chunks[ref_rows].mean(axis=0, dtype=np.int16)
+                            res -= ref_means[tuple(ref_rows)]
+
+                        if mean is not None:
+                            res = subtract_mean(res, mean)
+
+                        # zero dead channels if needed
+                        if len(dead_channels_indices) and zero_dead_channels:
+                            logger.debug(DEBUG_STR_ZEROS.format(flag=zero_dead_channels, channel=dead_channels_indices))
+                            res[dead_channels_indices] = 0
+
+                        out_dat.write(res.transpose())
+
+                    records_left -= n_read
+                    block += n_read
+                    pbar.update(n_read * 1024)
+                    samples_written += n_read * 1024
+                    bytes_written += (n_read * 2048 * n_channels_out)
+                    if progress is not None:
+                        for writer in out_dats + list(type_fids.values()):
+                            writer.flush()
+                        progress(samples_written)
 
                 pbar.close()
 
-                data_duration += bytes_written / (2 * sampling_rate * len(data_channel_ids))
+                data_duration += bytes_written / (2 * sampling_rate * n_channels_out)
                 elapsed = time.time() - start_t
                 speed = bytes_written / elapsed
-                logger.debug('{appended} {channels} channels into "{op:s}"'.format(
-                    appended=MODE_STR_PAST[file_mode], channels=len(data_channel_ids),
-                    op=os.path.abspath(output_path)))
+                for output_path, channel_group in outputs:
+                    logger.debug('{appended} {channels} channels into "{op:s}"'.format(
+                        appended=MODE_STR_PAST[file_mode], channels=len(channel_group['channels']),
+                        op=os.path.abspath(output_path)))
                 logger.info(
                     '{n_channels} channels, {rec} blocks ({dur:s}, {bw:.2f} MB) in {et:.2f} s ({ts:.2f} MB/s)'.format(
-                        n_channels=len(data_channel_ids), rec=n_blocks - records_left, dur=util.fmt_time(data_duration),
+                        n_channels=n_channels_out, rec=n_blocks - records_left, dur=util.fmt_time(data_duration),
                         bw=bytes_written / 1e6, et=elapsed, ts=speed / 1e6))
                 # returning duration of data written, epsilon=1 sample, allows external loop to make proper judgement if
                 # going to next target makes sense via comparison. E.g. if time less than one sample short of
                 # duration limit.
-                logger.removeHandler(file_handler)
-                file_handler.close()
 
             # Writing segment position data
-            dman_offset_file.write('{}, {}\n'.format(target_metadata['TARGET'], samples_written))
+            for dman_offset_file in dman_offset_files:
+                if dman_offset_file is not None:
+                    dman_offset_file.write('{}, {}\n'.format(target_metadata['TARGET'], samples_written))
             print('written!')
             return data_duration
 
     except IOError as e:
+        # recorded in the logs of the outputs, the caller can not go on without the samples of this target
         logger.exception('Operation failed: {error}'.format(error=e.strerror))
+        raise
+
+    finally:
+        for file_handler in file_handlers:
+            logger.removeHandler(file_handler)
+            file_handler.close()
+
+
+def open_samples(target_metadata):
+    """(n_samples, n_channels) array of a target already stored in sample-interleaved layout, the memory-mapped
+    continuous.dat of an Open Ephys binary recording or the recordings of a .kwd file."""
+    file_path = next(iter(next(iter(target_metadata['SUBSETS'].values()))['FILES'].values()))['FILEPATH']
+    if util.fext(file_path) == kwik.KWD_FEXT:
+        return kwik.KwdDataset(target_metadata)
+    return oebin.memmap(target_metadata)
+
+
+def binary_to_dat(target_metadata, outputs,
+                  file_mode='w', duration=0,
+                  dead_channel_ids=None, zero_dead_channels=True, fill_gaps=False, type_outputs=None,
+                  compression=None, mean_reference=None, start=None, skip=0, count=None, progress=None):
+    """Write channels of an Open Ephys binary recording or .kwd file into flat int16 .dat files, one per
+    channel group, see continuous_to_dat for outputs, mean_reference, start, skip, count and progress.
+
+    The continuous.dat of the recording already has the output layout. Conversion reduces to selecting and
+    reordering channels of the memory-mapped data, or a plain copy if all channels are kept in order. The
+    recordings of .kwd files are read chunk by chunk as hyperslabs, see open_samples. Every chunk is read once
+    and fanned out to all outputs.
+    Neither has separate channel types, type_outputs must be empty.
+    """
+    if type_outputs:
+        raise ValueError('Channel type outputs not supported for {} or {} targets.'.format(oebin.FMT_NAME,
+                                                                                           kwik.FMT_NAME))
+    start_t = time.time()
+    if fill_gaps:
+        logger.warning('Gap filling not supported for binary recordings, copying samples as is.')
+
+    data = open_samples(target_metadata)
+    sampling_rate = next(iter(target_metadata['SUBSETS'].values()))['JOINT_HEADERS']['sampling_rate']
+
+    dead_channel_ids = [did for did in dead_channel_ids]
+    groups = [group_rows(channel_group, dead_channel_ids, {ch: ch for ch in range(data.shape[1])})
+              for _, channel_group in outputs]
+    n_channels_out = sum([len(data_rows) for data_rows, _, _ in groups])
+
+    n_samples = data.shape[0] if not duration else min(data.shape[0], int(duration * sampling_rate))
+    skip = min(int(skip), n_samples)
+    n_samples = n_samples if count is None else min(n_samples, skip + int(count))
+    planner = chunking.ChunkPlanner('conv', data.shape[1], itemsize=data.dtype.itemsize, align=oe.NUM_SAMPLES)
+    logger.debug('Copying {} samples of {} channels into {} outputs'.format(n_samples, data.shape[1], len(outputs)))
+
+    with ExitStack() as stack:
+        out_dats = [stack.enter_context(dat.create_writer(output_path, len(channel_group['channels']),
+                                                          dtype=data.dtype, sampling_rate=sampling_rate,
+                                                          mode=file_mode, compression=compression, start=start))
+                    for output_path, channel_group in outputs]
+        dman_offset_files = [stack.enter_context(open_dman(output_path) if start is None else nullcontext())
+                             for output_path, _ in outputs]
+
+        pbar = tqdm.tqdm(total=n_samples - skip, unit_scale=True, unit='Samples')
+        for first, last in planner.spans(skip, n_samples):
+            chunk = data[first:last]
+            pbar.update(last - first)
+            mean = chunk.take(mean_reference, axis=1).mean(axis=1, dtype=np.float32, keepdims=True) \
+                if mean_reference else None
+            for out_dat, (data_rows, ref_rows, dead_channels_indices) in zip(out_dats, groups):
+                zero_dead = zero_dead_channels and len(dead_channels_indices)
+                if data_rows == list(range(data.shape[1])) and not len(ref_rows) and not zero_dead and mean is None:
+                    out_dat.write(chunk)
+                    continue
+
+                res = chunk.take(data_rows, axis=1)
+                if len(ref_rows):
+                    logger.debug(DEBUG_STR_REREF.format(channels=ref_rows))
+                    res -= chunk.take(ref_rows, axis=1).mean(axis=1, dtype=np.int16, keepdims=True)
+                if mean is not None:
+                    res = subtract_mean(res, mean)
+                if zero_dead:
+                    res[:, dead_channels_indices] = 0
+                out_dat.write(res)
+            if progress is not None:
+                for out_dat in out_dats:
+                    out_dat.flush()
+                progress(last - skip)
+        pbar.close()
+
+        for dman_offset_file in dman_offset_files:
+            if dman_offset_file is not None:
+                dman_offset_file.write('{}, {}\n'.format(target_metadata['TARGET'], n_samples - skip))
+    if isinstance(data, kwik.KwdDataset):
+        data.close()
+
+    bytes_written = (n_samples - skip) * n_channels_out * data.dtype.itemsize
+    elapsed = time.time() - start_t
+    logger.info(LOG_STR_COPIED.format(n_channels=n_channels_out, n_samples=n_samples - skip,
+                                      dur=util.fmt_time((n_samples - skip) / sampling_rate), bw=bytes_written / 1e6,
+                                      et=elapsed, ts=bytes_written / elapsed / 1e6))
+    return (n_samples - skip) / sampling_rate
+
+
+def target_rate(target_metadata):
+    """Sampling rate of the first subset of a target."""
+    return next(iter(target_metadata['SUBSETS'].values()))['JOINT_HEADERS']['sampling_rate']
+
+
+def target_samples(target_metadata, duration=None, fill_gaps=False, binary=False):
+    """Number of samples continuous_to_dat (or binary_to_dat) writes for a target, from its headers.
+
+    Args:
+        target_metadata: Metadata of the target
+        duration: Duration limit in seconds, None for all samples
+        fill_gaps: Records are placed by their timestamps, see continuous_to_dat
+        binary: Target is converted by binary_to_dat
+    """
+    subsets = list(target_metadata['SUBSETS'].values())
+    if binary:
+        n_samples = sum([int(subset['JOINT_HEADERS']['n_samples']) for subset in subsets])
+        return n_samples if not duration else min(n_samples, int(duration * target_rate(target_metadata)))
+
+    n_samples = 0
+    for subset in subsets:
+        headers = subset['JOINT_HEADERS']
+        if fill_gaps:
+            timeline = subset['TIMELINE'] if 'TIMELINE' in subset \
+                else oe.timeline_from_file(next(iter(subset['FILES'].values()))['FILEPATH'])
+            n_blocks = timeline['n_blocks']
+        else:
+            n_blocks = headers['n_blocks']
+        n_records = n_blocks if not duration \
+            else min(n_blocks, int(duration * headers['sampling_rate'] // headers['block_size']))
+        if n_records < 1:
+            break
+        n_samples += n_records * headers['block_size']
+    return n_samples
+
+
+def conversion_schedule(targets_metadata, duration=None, fill_gaps=False, binary=False):
+    """Duration limit, first output sample and number of samples of the targets to convert, in order. Known from
+    the headers, so every target can be written to its place in the outputs independently of the others. Targets
+    past the duration limit are left out. A duration of 0 (or None) converts everything.
+
+    Returns:
+        List of (target_metadata, duration, start, n_samples) tuples.
+    """
+    duration = duration or None
+    schedule = []
+    start = 0
+    duration_written = 0
+    for target_metadata in targets_metadata:
+        target_duration = None if duration is None else duration - duration_written
+        if target_duration is not None and target_duration <= 0:
+            logger.warning('Duration limit reached, skipping target {}'.format(target_metadata['TARGET']))
+            continue
+        n_samples = target_samples(target_metadata, target_duration, fill_gaps=fill_gaps, binary=binary)
+        schedule.append((target_metadata, target_duration, start, n_samples))
+        start += n_samples
+        duration_written += n_samples / target_rate(target_metadata)
+    return schedule
+
+
+class Checkpoint:
+    """Progress of a conversion into .dat outputs, the samples of every target of the schedule already in the
+    outputs. Kept in a JSON file next to the first output, so an interrupted conversion can be resumed with
+    --resume, see resume_progress.
+
+    The conversion settings are stored along, a checkpoint only applies to the same targets, outputs and settings.
+    """
+
+    def __init__(self, path, conversion, done=None):
+        self.path = str(path)
+        self.conversion = json.loads(json.dumps(conversion, default=int))
+        self.done = [0] * len(self.conversion['targets']) if done is None else list(done)
+        self.saved_t = 0
+
+    @classmethod
+    def load(cls, path):
+        """Checkpoint stored at path, None if there is none."""
+        if not op.exists(str(path)):
+            return None
+        with open(str(path), 'r') as cf:
+            stored = json.load(cf)
+        return cls(path, stored['conversion'], stored['done'])
+
+    def matches(self, other):
+        return self.conversion == other.conversion
+
+    def update(self, n_target, n_samples, force=False):
+        """Samples of a target in the outputs. Saved at most every CHECKPOINT_INTERVAL seconds, unless forced."""
+        self.done[n_target] = int(n_samples)
+        if force or time.time() - self.saved_t > CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        """Replace the checkpoint file, never leaving a partially written one behind."""
+        with open(self.path + '.tmp', 'w') as cf:
+            json.dump({'version': CHECKPOINT_VERSION, 'conversion': self.conversion, 'done': self.done}, cf)
+        os.replace(self.path + '.tmp', self.path)
+        self.saved_t = time.time()
+
+    def remove(self):
+        if op.exists(self.path):
+            os.remove(self.path)
+
+
+def verify_tail(convert_target, schedule_item, outputs, type_outputs, first, last, **kwargs):
+    """Compare samples [first, last) of a target in the outputs with the samples converted anew from the source."""
+    target_metadata, duration, start, _ = schedule_item
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fresh = [(op.join(tmp_dir, '{}{}'.format(n, dat.FMT_FEXT)), channel_group)
+                 for n, (_, channel_group) in enumerate(outputs)]
+        fresh_types = {ctype: op.join(tmp_dir, ctype + dat.FMT_FEXT) for ctype in type_outputs}
+        convert_target(target_metadata=target_metadata, outputs=fresh, type_outputs=fresh_types, duration=duration,
+                       skip=first, count=last - first, **kwargs)
+
+        pairs = [(path, fresh_path, len(channel_group['channels']))
+                 for (path, channel_group), (fresh_path, _) in zip(outputs, fresh)]
+        pairs += [(type_outputs[ctype], fresh_types[ctype], len(target_metadata['TYPES'][ctype]['CHANNELS']))
+                  for ctype in type_outputs]
+        for path, fresh_path, n_channels in pairs:
+            expected = np.fromfile(fresh_path, dtype=target_metadata['DTYPE'])
+            offset = (start + first) * n_channels * expected.itemsize
+            found = np.fromfile(path, dtype=target_metadata['DTYPE'], count=expected.size, offset=offset)
+            if expected.size != (last - first) * n_channels or not np.array_equal(found, expected):
+                return False
+    return True
+
+
+def resume_progress(convert_target, schedule, outputs, type_outputs, checkpoint, **kwargs):
+    """Samples of every target of the schedule that can be kept in the outputs of an interrupted conversion.
+
+    The progress of the stored checkpoint is limited to the samples present in the outputs and rounded down to
+    whole records. The last record before the resume position of every target is converted again and compared
+    with the outputs, stepping back a record at a time if they differ, up to VERIFY_RECORDS records. The outputs
+    are then resized to the full conversion.
+
+    Returns:
+        List of the samples of every target already in the outputs, None if there is nothing to resume.
+    """
+    stored = Checkpoint.load(checkpoint.path)
+    if stored is None:
+        logger.warning('No checkpoint {}, converting from the start'.format(checkpoint.path))
+        return None
+    if not stored.matches(checkpoint):
+        raise ValueError('Checkpoint {} belongs to a conversion of other targets, outputs or settings. Remove it to '
+                         'start over.'.format(checkpoint.path))
+
+    paths = [(path, len(channel_group['channels'])) for path, channel_group in outputs]
+    paths += [(path, len(schedule[0][0]['TYPES'][ctype]['CHANNELS'])) for ctype, path in type_outputs.items()]
+    itemsize = np.dtype(schedule[0][0]['DTYPE']).itemsize
+    present = min([op.getsize(path) // (n_channels * itemsize) if op.exists(path) else 0
+                   for path, n_channels in paths])
+
+    done = []
+    for n_target, schedule_item in enumerate(schedule):
+        target_metadata, _, start, n_samples = schedule_item
+        record = next(iter(target_metadata['SUBSETS'].values()))['JOINT_HEADERS']['block_size']
+        kept = min(stored.done[n_target], max(0, present - start))
+        kept = n_samples if kept == n_samples else kept // record * record
+        for _ in range(VERIFY_RECORDS):
+            if kept <= 0 or verify_tail(convert_target, schedule_item, outputs, type_outputs,
+                                        first=max(0, kept - record), last=kept, **kwargs):
+                break
+            logger.warning('Output differs from {} before sample {}, stepping back one record'.format(
+                target_metadata['TARGET'], kept))
+            kept = (kept - 1) // record * record
+        else:
+            kept = 0
+        done.append(kept)
+        logger.info('Resuming {} at sample {} of {}'.format(target_metadata['TARGET'], kept, n_samples))
+
+    n_total = sum([n_samples for _, _, _, n_samples in schedule])
+    for path, n_channels in paths:
+        with open(path, 'ab') as fid:
+            fid.truncate(n_total * n_channels * itemsize)
+    return done
+
+
+def convert_targets(convert_target, schedule, outputs, type_outputs=None, jobs=1, checkpoint=None, done=None,
+                    **kwargs):
+    """Convert the targets of a schedule into the outputs, yielding (target_metadata, n_samples) in order of the
+    targets as they are done.
+
+    Plain .dat outputs are allocated up front and every target is written to its place in the outputs. With several
+    jobs, a pool of processes converts the targets in parallel, sharing the memory budget. The progress is kept in
+    the checkpoint, after every chunk when converting in this process, else after every target.
+
+    Compressed and .h5 outputs can only be written in order, the targets are converted one after the other. With
+    several jobs, the outputs are split among the jobs.
+
+    Args:
+        convert_target: continuous_to_dat or binary_to_dat
+        schedule: List of (target_metadata, duration, start, n_samples), see conversion_schedule
+        outputs: List of (output_path, channel_group) tuples
+        type_outputs: Channel type output paths, see continuous_to_dat
+        jobs: Number of processes
+        checkpoint: Checkpoint of .dat outputs
+        done: Samples of every target already in the .dat outputs, see resume_progress
+        **kwargs: Passed on to convert_target
+    """
+    type_outputs = {} if type_outputs is None else type_outputs
+    paths = [output_path for output_path, _ in outputs] + list(type_outputs.values())
+    if all([dat.container_format(path) is None for path in paths]) and len(schedule):
+        if done is None:
+            n_total = sum([n_samples for _, _, _, n_samples in schedule])
+            dtype = schedule[0][0]['DTYPE']
+            for output_path, channel_group in outputs:
+                dat.allocate(output_path, n_total, len(channel_group['channels']), dtype=dtype)
+            for ctype, type_path in type_outputs.items():
+                dat.allocate(type_path, n_total, len(schedule[0][0]['TYPES'][ctype]['CHANNELS']), dtype=dtype)
+            done = [0] * len(schedule)
+        if checkpoint is not None:
+            for n_target, n_samples in enumerate(done):
+                checkpoint.update(n_target, n_samples, force=n_target == len(done) - 1)
+
+        with ProcessPoolExecutor(max_workers=jobs, initializer=chunking.set_memory_limit,
+                                 initargs=(chunking.memory_limit() / jobs,)) if jobs > 1 else nullcontext() as pool:
+            if pool is not None:
+                logger.info('Converting {} targets with {} jobs'.format(len(schedule), jobs))
+                futures = [pool.submit(convert_target, target_metadata=target_metadata, outputs=outputs,
+                                       type_outputs=type_outputs, duration=duration, start=start + kept, skip=kept,
+                                       **kwargs) if kept < n_samples else None
+                           for (target_metadata, duration, start, n_samples), kept in zip(schedule, done)]
+                results = (future.result() if future is not None else 0 for future in futures)
+            else:
+                def target_progress(n_target, kept):
+                    return None if checkpoint is None else lambda n: checkpoint.update(n_target, kept + n)
+
+                results = (convert_target(target_metadata=target_metadata, outputs=outputs, type_outputs=type_outputs,
+                                          duration=duration, start=start + kept, skip=kept,
+                                          progress=target_progress(n_target, kept), **kwargs)
+                           if kept < n_samples else 0
+                           for n_target, ((target_metadata, duration, start, n_samples), kept)
+                           in enumerate(zip(schedule, done)))
+
+            for n_target, ((target_metadata, _, _, n_samples), kept, target_duration) in enumerate(
+                    zip(schedule, done, results)):
+                n_written = kept + round(target_duration * target_rate(target_metadata))
+                if n_written != n_samples:
+                    raise RuntimeError('Converted {} samples of {}, expected {} from its headers'.format(
+                        n_written, target_metadata['TARGET'], n_samples))
+                if checkpoint is not None:
+                    checkpoint.update(n_target, n_samples, force=True)
+                # segment tables are kept here, in order of the targets
+                for output_path, _ in outputs:
+                    with open_dman(output_path) as dman_offset_file:
+                        if dman_offset_file is not None:
+                            dman_offset_file.write('{}, {}\n'.format(target_metadata['TARGET'], n_samples))
+                yield target_metadata, n_samples
+        return
+
+    if jobs <= 1:
+        for n_target, (target_metadata, duration, _, _) in enumerate(schedule):
+            logger.debug('Starting conversion for target {}'.format(target_metadata['TARGET']))
+            target_duration = convert_target(target_metadata=target_metadata, outputs=outputs,
+                                             type_outputs=type_outputs, file_mode='a' if n_target else 'w',
+                                             duration=duration, **kwargs)
+            yield target_metadata, round(target_duration * target_rate(target_metadata))
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=chunking.set_memory_limit,
+                             initargs=(chunking.memory_limit() / jobs,)) as pool:
+        partitions = [outputs[job::jobs] for job in range(min(jobs, len(outputs)))]
+        logger.info('Converting {} outputs with {} jobs, targets in order'.format(len(outputs), len(partitions)))
+        for n_target, (target_metadata, duration, _, _) in enumerate(schedule):
+            futures = [pool.submit(convert_target, target_metadata=target_metadata, outputs=partition,
+                                   type_outputs=type_outputs if not n_partition else {},
+                                   file_mode='a' if n_target else 'w', duration=duration, **kwargs)
+                       for n_partition, partition in enumerate(partitions)]
+            target_duration = [future.result() for future in futures][0]
+            yield target_metadata, round(target_duration * target_rate(target_metadata))
+
+
+def pipeline_outputs(stages, channel_group, layout, dead_channels, output_base, out_fext):
+    """Outputs of the ref and split stages applied to the flat channel group while converting, as written by
+    dm ref (common average of good channels subtracted, dead channels zeroed) and dm split (one output per
+    channel group of the layout, groups with only dead channels skipped).
+
+    Args:
+        stages: List of PIPELINE_STAGES
+        channel_group: Flat channel group of the conversion, channels in output order
+        layout: Probe dictionary the channel group was flattened from, or None
+        dead_channels: List of dead channels
+        output_base: Output path without extension of the converted file
+        out_fext: Output file extension
+
+    Returns:
+        Tuple of outputs dictionary {id: (path, channel group, channel_groups, dead_channels)} in the layout of
+        the .prb files written along, and list of channels to average as reference (None without ref stage).
+    """
+    channels = channel_group['channels']
+    if layout is not None:
+        cg_flat, dead_flat = util.monotonic_prb(layout)
+    else:
+        cg_flat = {0: {'channels': list(range(len(channels)))}}
+        dead_flat = sorted([channels.index(dc) for dc in dead_channels if dc in channels])
+
+    mean_reference = [ch for idx, ch in enumerate(channels) if idx not in dead_flat] if 'ref' in stages else None
+    label = PIPELINE_REF_LABEL if 'ref' in stages else ''
+    if 'split' not in stages:
+        return {0: (output_base + label + out_fext, channel_group, cg_flat, dead_flat)}, mean_reference
+
+    outputs = {}
+    width = len(str(max(cg_flat)))
+    for cg_id, cg in cg_flat.items():
+        if all([ch in dead_flat for ch in cg['channels']]):
+            logger.warning(f'Skipping tetrode {cg_id} because all channels are dead.')
+            continue
+        path = op.join(op.dirname(output_base), '{}{:0{}d}{}'.format(PIPELINE_SPLIT_PREFIX, cg_id, width, out_fext))
+        outputs[cg_id] = (path, {'channels': [channels[idx] for idx in cg['channels']]},
+                          {0: {'channels': list(range(len(cg['channels'])))}},
+                          sorted([cg['channels'].index(dc) for dc in dead_flat if dc in cg['channels']]))
+    return outputs, mean_reference
 
 
 def main(args):
@@ -192,6 +792,12 @@ def main(args):
     parser.add_argument('-f', '--format', help='Output format. Default is: {}'.format(list(FORMATS.keys())[2]),
                         choices=FORMATS.keys(), default=list(FORMATS.keys())[2])
     parser.add_argument('--fname_channels', action='store_true', help='Include original channel numbers in file names.')
+    parser.add_argument('-N', '--jobs', type=int, default=1,
+                        help='Number of processes converting targets (.dat outputs) or outputs in parallel. '
+                             'Default: 1')
+    parser.add_argument('--compression',
+                        help='Codec of datz outputs (zlib, bz2, lzma, default zlib), or filter of hdf5 outputs '
+                             '(gzip, lzf, default none).')
 
     # Channel arrangement
     channel_group = parser.add_mutually_exclusive_group()
@@ -209,17 +815,37 @@ def main(args):
                         help='List of dead channels. If flag set, these will be set to zero.')
     parser.add_argument('-z', '--zero-dead-channels', action='store_true')
     parser.add_argument('--dry-run', action='store_true', help='Do not write data files (but still create prb/prm')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted conversion into .dat files from its checkpoint, keeping the '
+                             'outputs up to the last record matching the source.')
     parser.add_argument('-p', "--params", help='Path to .params file.')
     parser.add_argument('-D', "--duration", type=int, help='Limit duration of recording (s)')
+    parser.add_argument('--channel-types', nargs='*', choices=['AUX', 'ADC'], default=[],
+                        help='Additional channel types written to their own files in the same pass.')
+    parser.add_argument('--fill-gaps', action='store_true',
+                        help='Align records by timestamps, zero-filling dropped and skipping duplicated records.')
+    parser.add_argument('--pipeline', type=lambda stages: [stage for stage in stages.split(',') if stage], default=[],
+                        help='Apply later stages while converting, in the same pass over the data: "ref" subtracts '
+                             'the average of the good channels and zeros dead channels, "split" writes a file and '
+                             '.prb per channel group of the layout. E.g. --pipeline ref,split')
     parser.add_argument('--remove-trailing-zeros', action='store_true')
     parser.add_argument('--out_fname_template', action='store_true', help='Template for file naming.')
+    chunking.add_memory_argument(parser)
 
     cli_args = parser.parse_args(args)
     logger.debug('Arguments: {}'.format(cli_args))
+    chunking.apply_memory_argument(cli_args)
 
     if cli_args.remove_trailing_zeros:
         raise NotImplementedError("Trailing zero removal not implemented (also not a good idea to begin with...)")
 
+    pipeline = cli_args.pipeline
+    if not set(pipeline).issubset(PIPELINE_STAGES):
+        parser.error('Unknown pipeline stages {}, use {}'.format(sorted(set(pipeline) - set(PIPELINE_STAGES)),
+                                                                PIPELINE_STAGES))
+    if len(pipeline) and cli_args.split_groups:
+        parser.error('--pipeline converts all channels at once, use "--pipeline split" instead of --split-groups')
+
     targets = [op.abspath(op.expanduser(t)) for t in expand_sessions(cli_args.target)]
     target_exists = [t for t in targets if op.exists(t)]
     if not all(target_exists):
@@ -233,9 +859,15 @@ def main(args):
     assert len(formats) == 1
     logger.debug('Using module: {}'.format(format_input.__name__))
 
+    # Open Ephys binary and kwik recordings already are in the output layout, others are converted record by record
+    convert_target = binary_to_dat if format_input in [oebin, kwik] else continuous_to_dat
+
     # Output file format
     format_output = FORMATS[cli_args.format.lower()]
     logger.debug('Output module: {}'.format(format_output.__name__))
+    if cli_args.resume and format_output is not dat:
+        parser.error('--resume needs .dat outputs, {} files can only be written in one go'.format(
+            format_output.FMT_NAME))
 
     # Set up channel layout (channels, references, dead channels) from command line inputs or layout file
     # List of bad channels, will be added to channel group dict
@@ -255,6 +887,8 @@ def main(args):
             if layout_file.exists():
                 logger.warning(f'Using probe file {layout_file.name} matching session file name.')
                 break
+        else:
+            layout_file = None
 
     if cli_args.channel_count is not None:
         channel_groups = {0: {'channels': list(range(cli_args.channel_count)),
@@ -293,7 +927,11 @@ def main(args):
     # and can fail prematurely if the wrong naming template is being used
     # This needs more work.
     logger.debug('Getting metadata for all targets')
-    targets_metadata_list = [format_input.metadata_from_target(t) for t in targets]
+    if len(cli_args.channel_types) and format_input is not oe:
+        raise ValueError('Channel types only available for {} targets.'.format(oe.FMT_NAME))
+    metadata_kwargs = {'channel_type': ['CH'] + cli_args.channel_types} if len(cli_args.channel_types) else {}
+    targets_metadata_list = gather_metadata(format_input, targets, timeline=cli_args.fill_gaps, **metadata_kwargs)
+    sampling_rate = next(iter(targets_metadata_list[0]['SUBSETS'].values()))['JOINT_HEADERS']['sampling_rate']
 
     if channel_groups is None:
         target_channels = list(set([ch for t in targets_metadata_list for ch in t['CHANNELS']]))
@@ -323,9 +961,11 @@ def main(args):
     logger.debug('Filename template: {}'.format(fname_template))
 
     # +++++++++++++++++++++++++++++++++++++++++ MAIN LOOP ++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    # Iterates over all channel groups, calling continuous_to_dat for each to be bundled together
+    # Iterates over all targets, converting each into all channel group outputs in a single pass
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    total_duration_written = 0
+    # Output path, channel group and layout written along (.prb file or .h5 attributes) of every output
+    outputs = {}
+    mean_reference = None
     for cg_id, channel_group in channel_groups.items():
         logger.debug('channel group: {}'.format(channel_group))
 
@@ -334,49 +974,103 @@ def main(args):
         # channel ranges from consecutive channels, for output file naming
         crs = util.fmt_channel_ranges(channel_group['channels'])
         output_basename = fname_template.format(prefix=out_prefix, cg_id=cg_id, crs=crs)
-        output_fname = ''.join([output_basename, out_fext])
-        output_file_path = op.join(out_path, output_fname)
-
-        with open(output_file_path + '.dataman.offsets', 'w') as dman_offset_file:
-            dman_offset_file.write('target_path, num_samples\n')
-
-        duration_written = 0
-        # First target, file mode is write, after that, append to output file
-        for file_mode, target_metadata in enumerate(targets_metadata_list):
-            duration = None if cli_args.duration is None else cli_args.duration - duration_written
-            target_path = target_metadata['TARGET']
-
-            logger.debug('Starting conversion for target {}'.format(target_path))
-
-            if not cli_args.dry_run and WRITE_DATA:
-                duration_written += continuous_to_dat(
-                    target_metadata=target_metadata,
-                    output_path=output_file_path,
-                    channel_group=channel_group,
-                    dead_channel_ids=dead_channels,
-                    zero_dead_channels=cli_args.zero_dead_channels,
-                    file_mode='a' if file_mode else 'w',
-                    duration=duration,
-                    chunk_records=5)
-            total_duration_written += duration_written
-
-        # create the per-group .prb files
+
+        if len(pipeline):
+            outputs, mean_reference = pipeline_outputs(pipeline, channel_group, layout, dead_channels,
+                                                       op.join(out_path, output_basename), out_fext)
+            break
+
+        # Per-group layout
         # FIXME: Dead channels are big mess
         if cli_args.split_groups or (layout is None):
             # One prb file per channel group
             ch_out = channel_group['channels']
             cg_out = {0: {'channels': list(range(len(ch_out)))}}
-            dead_channels = sorted([ch_out.index(dc) for dc in dead_channels if dc in ch_out])
+            dead_out = sorted([ch_out.index(dc) for dc in dead_channels if dc in ch_out])
 
         else:
             # Same channel groups, but with flat numbering
-            cg_out, dead_channels = util.monotonic_prb(layout)
-
-        with open(op.join(out_path, output_basename + '.prb'), 'w') as prb_out:
-            prb_out.write('dead_channels = {}\n'.format(pprint.pformat(dead_channels)))
-            prb_out.write('channel_groups = {}'.format(pprint.pformat(cg_out)))
-
-        logger.debug('Done! Total data length written: {}'.format(util.fmt_time(total_duration_written)))
+            cg_out, dead_out = util.monotonic_prb(layout)
+        outputs[cg_id] = (op.join(out_path, ''.join([output_basename, out_fext])), channel_group, cg_out, dead_out)
+
+    for output_file_path, _, _, _ in outputs.values():
+        if has_side_files(output_file_path):
+            with open(output_file_path + dat.OFFSETS_SUFFIX, 'w') as dman_offset_file:
+                dman_offset_file.write('target_path, num_samples\n')
+            # segment tables are appended target by target
+            open(output_file_path + '.dman', 'w').close()
+
+    # Additional channel types are written along with the channel groups
+    type_outputs = {ctype: op.join(out_path, '{}--{}{}'.format(out_prefix, ctype.lower(), out_fext))
+                    for ctype in cli_args.channel_types}
+
+    duration_written = 0
+    offsets = []
+    written = not cli_args.dry_run and WRITE_DATA
+    # Targets are written one after the other, in the order given, starting at known samples of the outputs
+    schedule = conversion_schedule(targets_metadata_list, cli_args.duration, fill_gaps=cli_args.fill_gaps,
+                                   binary=convert_target is binary_to_dat) if written else []
+    target_outputs = [(output_file_path, channel_group) for output_file_path, channel_group, _, _ in outputs.values()]
+    conversion = dict(dead_channel_ids=dead_channels,
+                      zero_dead_channels=cli_args.zero_dead_channels or 'ref' in pipeline,
+                      fill_gaps=cli_args.fill_gaps,
+                      compression=cli_args.compression,
+                      mean_reference=mean_reference)
+
+    # Progress of .dat outputs is checkpointed, an interrupted conversion continues from there with --resume
+    checkpoint = None
+    done = None
+    if written and format_output is dat:
+        checkpoint = Checkpoint(target_outputs[0][0] + CHECKPOINT_SUFFIX,
+                                dict(targets=[(target_metadata['TARGET'], start, n_samples)
+                                              for target_metadata, _, start, n_samples in schedule],
+                                     outputs=target_outputs, type_outputs=type_outputs, **conversion))
+        if cli_args.resume:
+            done = resume_progress(convert_target, schedule, target_outputs, type_outputs, checkpoint, **conversion)
+
+    converted = convert_targets(convert_target, schedule, outputs=target_outputs, type_outputs=type_outputs,
+                                jobs=cli_args.jobs, checkpoint=checkpoint, done=done, **conversion)
+    for target_metadata, n_samples in converted:
+        duration_written += n_samples / target_rate(target_metadata)
+        offsets.append((target_metadata['TARGET'], n_samples))
+        for output_file_path, _, _, _ in outputs.values():
+            if has_side_files(output_file_path):
+                with open(output_file_path + dat.OFFSETS_SUFFIX, 'a') as dman_offset_file:
+                    dman_offset_file.write('{}, {}\n'.format(*offsets[-1]))
+
+    for output_id, (output_file_path, channel_group, cg_out, dead_out) in outputs.items():
+        side_files = has_side_files(output_file_path)
+
+        # Channel type outputs are described along with the first output
+        group_type_outputs = type_outputs if output_id == next(iter(outputs)) else {}
+
+        # Describe the layout of the output for later stages, in the attributes of .h5 files
+        if written and not side_files:
+            hdf5.write_metadata(output_file_path, offsets=offsets,
+                                bit_volts=bit_volts(targets_metadata_list[0], channel_group['channels'][0]),
+                                channel_groups=cg_out, dead_channels=dead_out)
+            for ctype, type_path in group_type_outputs.items():
+                type_metadata = dict(targets_metadata_list[0], **targets_metadata_list[0]['TYPES'][ctype])
+                hdf5.write_metadata(type_path, offsets=offsets,
+                                    bit_volts=bit_volts(type_metadata, type_metadata['CHANNELS'][0]))
+
+        if written and side_files:
+            dat.write_sidecar(output_file_path, n_channels=len(channel_group['channels']), dtype=oe.DEFAULT_DTYPE,
+                              sampling_rate=sampling_rate,
+                              bit_volts=bit_volts(targets_metadata_list[0], channel_group['channels'][0]),
+                              offsets=offsets)
+            for ctype, type_path in group_type_outputs.items():
+                type_metadata = dict(targets_metadata_list[0], **targets_metadata_list[0]['TYPES'][ctype])
+                dat.write_sidecar(type_path, n_channels=len(type_metadata['CHANNELS']), dtype=oe.DEFAULT_DTYPE,
+                                  sampling_rate=sampling_rate,
+                                  bit_volts=bit_volts(type_metadata, type_metadata['CHANNELS'][0]), offsets=offsets)
+
+        if side_files:
+            util.write_prb(op.splitext(output_file_path)[0] + '.prb', cg_out, dead_out)
+
+    if checkpoint is not None:
+        checkpoint.remove()
+    logger.debug('Done! Total data length written: {}'.format(util.fmt_time(duration_written)))
 
 
 if __name__ == '__main__':
@@ -14,7 +14,10 @@ from tqdm import tqdm
 
 import dataman.lib.report
 from dataman.detect import report
-from dataman.lib.util import butter_bandpass
+from dataman.formats import dat, datz, hdf5, kwik
+from dataman.formats import open_ephys as oe
+from dataman.lib import chunking
+from dataman.lib.util import butter_bandpass, run_prb
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +27,14 @@ logging.getLogger('matplotlib.fontmanager').disabled = True
 
 MINIMUM_NOISE_THRESHOLD = 5
 
+# Tetrode files are plain, compressed or HDF5, read alike through dat.DatDataset
+TETRODE_FEXTS = [dat.FMT_FEXT, datz.FMT_FEXT, hdf5.FMT_FEXT]
+
+
+def tetrode_paths(directory):
+    """Sorted tetrode .dat/.datz/.h5 files in a directory."""
+    return sorted([f for f in Path(directory).glob('tetrode*') if f.suffix in TETRODE_FEXTS])
+
 
 def get_batches(length, batch_size):
     """Given length of e.g. an array and a batch size, return size of batches
@@ -106,12 +117,15 @@ def detect_spikes(arr, min_thresholds, max_sd=18, fs=3e4, chunk_size_s=60, chunk
                   s_pre=10, s_post=22, reject_overlap=16, align='min'):
     """Given wideband signal, find peaks (minima) in the high-pass filtered signal. Returns a list of
     curated timestamps to reject duplicates and overlapping spikes.
+
+    Chunks are chunk_size_s long, or shorter if the filtered chunk would exceed the memory budget.
     """
     # TODO: Interpolation
     # TODO: Maximum artifact rejection
     # TODO: Return rejected timestamps
 
-    chunk_size = int(chunk_size_s * fs)  # chunk size for detection
+    # chunk size for detection
+    chunk_size = chunking.plan_size('detect', arr.shape[1], arr.dtype.itemsize, maximum=int(chunk_size_s * fs))
 
     microvolt_factor = 0.195
     use_thr = min_thresholds / microvolt_factor
@@ -211,10 +225,30 @@ def detect_spikes(arr, min_thresholds, max_sd=18, fs=3e4, chunk_size_s=60, chunk
     return valid_timestamps
 
 
+def create_waveform_file(outpath, timestamps, n_samples, n_channels, s_pre=10):
+    """Create .mat (HDF5) file with spike index and an empty (n_samples * n_channels, n_spikes) int16 'spikes'
+    dataset to be filled with waveforms. Timestamps are converted into the MClust time domain.
+    """
+    if os.path.exists(outpath):
+        raise FileExistsError('Mat file already exists. Exiting.')
+
+    # TODO: Save additional metadata alongside waveforms, e.g. thresholds, version, original paths
+    h5s.savemat(str(outpath), {'n': len(timestamps),
+                               'index': np.double((timestamps - s_pre) / 3),  # convert to MClust time domain
+                               'readme': 'Written by dataman.',
+                               # 'original_path': str(path)
+                               }, compress=False)
+
+    n_samples_concat = n_samples * n_channels
+    with h5.File(str(outpath), 'a') as hf:
+        hf.create_dataset('spikes', (n_samples_concat, len(timestamps)), maxshape=(n_samples_concat, None),
+                          dtype='int16')
+
+
 def extract_waveforms(timestamps, arr, outpath, s_pre=10, s_post=22, lc=300, hc=6000, chunk_size_s=60,
                       chunk_overlap_s=0.05, fs=3e4):
     """Extracts waveforms from raw signal around s_pre->s_post samples of spike trough. Waveforms and timestamps
-    are stored directly in .mat files.
+    are stored directly in .mat files. Chunks are planned as in detect_spikes.
     """
     assert max(timestamps) + s_post < arr.shape[0]
     assert min(timestamps) - s_pre >= 0
@@ -222,7 +256,7 @@ def extract_waveforms(timestamps, arr, outpath, s_pre=10, s_post=22, lc=300, hc=
     if s_pre + s_post != 32:
         logger.warning(f'Number of waveforms samples {s_pre}+{s_post} != 32 as expected by MClust!')
 
-    chunk_size = int(chunk_size_s * fs)
+    chunk_size = chunking.plan_size('detect', arr.shape[1], arr.dtype.itemsize, maximum=int(chunk_size_s * fs))
     n_samples = s_pre + s_post
     n_channels = arr.shape[1]
 
@@ -236,20 +270,10 @@ def extract_waveforms(timestamps, arr, outpath, s_pre=10, s_post=22, lc=300, hc=
     chunk_overlap = int(chunk_overlap_s * fs)
 
     # prepare the mat file
-    if os.path.exists(outpath):
-        raise FileExistsError('Mat file already exists. Exiting.')
-
-    # TODO: Save additional metadata alongside waveforms, e.g. thresholds, version, original paths
-    h5s.savemat(str(outpath), {'n': len(timestamps),
-                               'index': np.double((timestamps - s_pre) / 3),  # convert to MClust time domain
-                               'readme': 'Written by dataman.',
-                               # 'original_path': str(path)
-                               }, compress=False)
+    create_waveform_file(outpath, timestamps, n_samples, n_channels, s_pre=s_pre)
 
     n_samples_concat = n_samples * n_channels
     with h5.File(str(outpath), 'a') as hf:
-        hf.create_dataset('spikes', (n_samples_concat, len(timestamps)), maxshape=(n_samples_concat, None),
-                          dtype='int16')
         for n_chunk, start in enumerate(tqdm(chunk_starts, leave=False, desc='3) extracting')):
             # limits of core batch chunk
             b_start = start
@@ -281,15 +305,52 @@ def extract_waveforms(timestamps, arr, outpath, s_pre=10, s_post=22, lc=300, hc=
     return waveforms
 
 
+def convert_oe_spikes(target, force=False):
+    """Write waveform files for all Open Ephys .spikes files in the target directory, in place of spike detection.
+    Timestamps are made relative to the first record of the .continuous files in the same directory, if present.
+    """
+    spikes_paths = sorted(target.glob('*' + oe.SPIKES_FEXT))
+    if not len(spikes_paths):
+        logger.error(f'No {oe.SPIKES_FEXT} files found at {target}')
+        return
+
+    t0 = 0
+    continuous_paths = sorted(target.glob('*' + oe.FMT_FEXT))
+    if len(continuous_paths):
+        with oe.ContinuousFile(continuous_paths[0]) as cf:
+            t0 = int(cf.records['timestamp'][0]) if cf.num_records else 0
+    logger.debug(f'Spike timestamps relative to first record timestamp {t0}')
+
+    for tt, spikes_path in enumerate(spikes_paths):
+        matpath = target / f'tetrode{tt:02}.mat'
+        if matpath.exists() and not force:
+            logger.error(f'{matpath} already exists. Delete or use --force to overwrite.')
+            exit(1)
+        elif matpath.exists() and force:
+            logger.warning(f'{matpath} already exists, deleting it.')
+            os.remove(matpath)
+
+        with oe.SpikesFile(spikes_path) as spikes:
+            if spikes.n_channels != 4:
+                logger.warning(f'{spikes_path.name} has {spikes.n_channels} channels, dm fet expects tetrodes.')
+            spikes.to_mat(matpath, t0=t0)
+            logger.info(f'{spikes_path.name} -> {matpath.name}: {spikes.num_spikes} spikes')
+
+
 def main(args):
     parser = argparse.ArgumentParser('Detect spikes in .dat files')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Verbose (debug) output")
 
     parser.add_argument('target', default='.',
-                        help="""Directory with tetrode files.""")
-    parser.add_argument('-o', '--out_path', help='Output file path Defaults to current working directory')
-    parser.add_argument('--sampling-rate', type=float, help='Sampling rate. Default 30000 Hz', default=3e4)
+                        help="""Directory with tetrode files, or .session file listing such directories. Same-named
+                                tetrode files of a session are treated as one continuous recording. A .kwd file, or
+                                directory holding one, is split into tetrodes while reading.""")
+    parser.add_argument('-l', '--layout',
+                        help='Probe file grouping the channels of .kwd targets. Default: groups of 4 channels')
+    parser.add_argument('-o', '--out_path', help='Output path for sessions. Defaults to current working directory')
+    parser.add_argument('--sampling-rate', type=float,
+                        help='Sampling rate. Default: from metadata sidecar of the .dat file, or 30000 Hz')
     parser.add_argument('--noise_percentile', type=int, help='Noise percentile. Default: 5', default=5)
     parser.add_argument('--threshold', type=float, help='Threshold. Default: 4.5', default=4.5)
     parser.add_argument('-t', '--tetrodes', nargs='*', help='0-index list of tetrodes to look at. Default: all.')
@@ -297,15 +358,18 @@ def main(args):
     parser.add_argument('-a', '--align', help='Alignment method, default: min', default='min')
     parser.add_argument('--start', type=float, help='Segment start in seconds', default=0)
     parser.add_argument('--end', type=float, help='Segment end in seconds')
+    parser.add_argument('--from-spikes', action='store_true',
+                        help='Convert Open Ephys .spikes files at target to waveform files instead of detecting.')
+    chunking.add_memory_argument(parser)
 
     cli_args = parser.parse_args(args)
     logger.debug('Arguments: {}'.format(cli_args))
+    chunking.apply_memory_argument(cli_args)
 
     stddev_factor = cli_args.threshold
     logger.debug('Threshold factor  : {}'.format(stddev_factor))
 
-    fs = cli_args.sampling_rate
-    logger.debug('Sampling rate     : {}'.format(fs))
+    logger.debug('Sampling rate     : {}'.format(cli_args.sampling_rate))
 
     noise_percentile = cli_args.noise_percentile
     logger.debug('Noise percentile : {}'.format(noise_percentile))
@@ -314,16 +378,42 @@ def main(args):
     logger.debug('Alignment method : {}'.format(alignment_method))
 
     target = Path(cli_args.target)
-    if target.is_file() and target.exists():
+    if cli_args.from_spikes:
+        convert_oe_spikes(target, force=cli_args.force)
+        return
+
+    # Each tetrode is a list of files, concatenated in order
+    kwd_metadata, kwd_groups = None, None
+    if target.suffix in ['.session', '.txt']:
+        from dataman.conv.convert import expand_sessions
+        session_dirs = [Path(t).expanduser().resolve() for t in expand_sessions([str(target)])]
+        target = Path(cli_args.out_path if cli_args.out_path is not None else os.getcwd())
+        tetrode_files = [target / f.name for f in tetrode_paths(session_dirs[0])]
+        tetrode_sets = [[d / f.name for d in session_dirs] for f in tetrode_files]
+        logger.debug('Using session mode with {} recordings, output to {}'.format(len(session_dirs), target))
+    elif target.suffix == kwik.KWD_FEXT or \
+            (target.is_dir() and not len(tetrode_paths(target)) and kwik.detect(str(target))):
+        # Channel groups are read straight from the raw recordings, no tetrode files needed
+        kwd_metadata = kwik.metadata_from_target(target)
+        kwd_path = Path(kwik.find_kwd(target))
+        if cli_args.layout is not None:
+            kwd_groups = [cg['channels'] for cg in run_prb(cli_args.layout)['channel_groups'].values()]
+        else:
+            kwd_groups = [kwd_metadata['CHANNELS'][n:n + 4] for n in range(0, len(kwd_metadata['CHANNELS']), 4)]
+        target = Path(cli_args.out_path) if cli_args.out_path is not None else kwd_path.parent
+        tetrode_files = [target / f'tetrode{tt:02}{kwik.KWD_FEXT}' for tt in range(len(kwd_groups))]
+        tetrode_sets = [[kwd_path] for _ in kwd_groups]
+        logger.debug('Using {} channel groups of {}, output to {}'.format(len(kwd_groups), kwd_path.name, target))
+    elif target.is_file() and target.exists():
         tetrode_files = [target]
+        tetrode_sets = [[target]]
         target = target.parent
         logger.debug('Using single file mode with {}'.format(target))
     else:
-        tetrode_files = sorted(target.glob('tetrode*.dat'))
-
-    start = int(cli_args.start * fs) if cli_args.start is not None else 0
-    end = int(cli_args.end * fs) if cli_args.end is not None else -1
+        tetrode_files = tetrode_paths(target)
+        tetrode_sets = [[f] for f in tetrode_files]
 
+    target.mkdir(parents=True, exist_ok=True)
     now = dt.today().strftime('%Y%m%d_%H%M%S')
     report_path = target / f'dataman_detect_report_{now}.html'
 
@@ -332,8 +422,9 @@ def main(args):
 
         # General report on shape, lengths etc.
         tqdm.write(f'-> Starting spike detection for {tetrode_file.name}')
-        if not tetrode_file.exists():
-            logger.info(f"{tetrode_file} not found. Skipping.")
+        missing = [f for f in tetrode_sets[tt] if not f.exists()]
+        if len(missing):
+            logger.info(f"{', '.join(map(str, missing))} not found. Skipping.")
             continue
 
         matpath = tetrode_file.with_suffix('.mat')
@@ -344,10 +435,24 @@ def main(args):
             logger.warning(f'{matpath} already exists, deleting it.')
             os.remove(matpath)
 
-        raw_memmap = np.memmap(tetrode_file, dtype='int16')
-        logger.debug(f'loading {start}:{end} from memmap {raw_memmap}')
-        wb = raw_memmap.reshape((-1, 4))[start:end]
-        del raw_memmap
+        if kwd_metadata is not None:
+            # Channel group read from the raw recordings
+            dataset = kwik.KwdDataset(kwd_metadata, channels=kwd_groups[tt])
+            sidecar = {'sampling_rate': dataset.sampling_rate}
+        else:
+            # Layout from the metadata sidecar written by conv/split, if there is one, or the file itself
+            sidecar = dat.layout_info(tetrode_sets[tt][0])
+            n_channels = 4 if sidecar is None else sidecar['n_channels']
+            dtype = dat.DEFAULT_DTYPE if sidecar is None else sidecar['dtype']
+            dataset = dat.DatDataset(tetrode_sets[tt], n_channels=n_channels, dtype=dtype)
+
+        fs = cli_args.sampling_rate if cli_args.sampling_rate is not None else \
+            sidecar['sampling_rate'] if sidecar is not None else dat.DEFAULT_SAMPLING_RATE
+        start = int(cli_args.start * fs) if cli_args.start is not None else 0
+        end = int(cli_args.end * fs) if cli_args.end is not None else -1
+
+        logger.debug(f'loading {start}:{end} from {len(tetrode_sets[tt])} file(s), {dataset.shape}')
+        wb = dataset.subset(start, end)
 
         logger.debug('Creating waveform figure...')
         report_string += '<h1>Recording</h1>\n'
@@ -5,7 +5,7 @@ from __future__ import print_function
 import logging
 import os
 import sys
-from dataman.formats import open_ephys, kwik, dat
+from dataman.formats import open_ephys, kwik, dat, open_ephys_binary
 from dataman.lib import util
 from termcolor import colored
 
@@ -44,9 +44,9 @@ _row = "{0:<28}{1}{2:>4}{3:>4}{4:>4}{5:>4}{6:>12}"
 
 
 def contains_data(path, pre_walk=None):
-    """Check if directory or list of files contains a data set of known format (OE, Kwik, Dat)"""
+    """Check if directory or list of files contains a data set of known format (OE, Kwik, Dat, OEBin)"""
 
-    formats = [open_ephys, dat, kwik]
+    formats = [open_ephys, dat, kwik, open_ephys_binary]
     for fmt in formats:
         detected = fmt.detect(path, pre_walk)
         if detected:
@@ -113,7 +113,8 @@ class DataMan(cmd.Cmd):
 
     @staticmethod
     def do_check(args_string):
-        raise NotImplemented('check not implemented')
+        from dataman.check import check
+        check.main(args_string.split(' '))
 
     @staticmethod
     def do_proc(args_string):
@@ -144,6 +145,7 @@ def main():
         cli     Interactive CLI
         ls      Basic target statistics
         vis     Simple data visualizer
+        check   Verify integrity of raw data files
         convert Convert formats and layouts
         ref     Creating references/reference-subtracting data
         split   Split file into separate files bundling channels
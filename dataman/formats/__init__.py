@@ -1,3 +1,3 @@
 def get_valid_formats():
-    from dataman.formats import open_ephys, kwik, dat
-    return [open_ephys, kwik, dat]
+    from dataman.formats import open_ephys, kwik, dat, open_ephys_binary, datz, hdf5
+    return [open_ephys, kwik, dat, open_ephys_binary, datz, hdf5]
@@ -1,5 +1,6 @@
+import json
 import os.path as op
-from dataman.lib import util, Streamer
+from dataman.lib import util, Streamer, chunking
 import numpy as np
 import logging
 from .open_ephys import NUM_SAMPLES
@@ -13,20 +14,346 @@ DEFAULT_SAMPLING_RATE = 3e4
 AMPLITUDE_SCALE = 1 / 2 ** 10
 
 MAX_NUM_CHANNELS_GUESS = 1024
+
+# Segment table of a .dat file concatenated from several sources, written by conv
+OFFSETS_SUFFIX = '.dataman.offsets'
+
+# JSON file next to a .dat file describing its layout, written by conv/split/ref
+SIDECAR_SUFFIX = '.dataman.json'
+SIDECAR_VERSION = 1
 POSSIBLE_DTYPES = ['float16', 'float32', 'float64', 'int16', 'int32', 'uint16']
+# Layout scores of dtypes other than the preferred one are inflated by this factor. Interleaved int16 pairs
+# read as int32 look about as smooth as the int16 channels themselves.
+DTYPE_PRIOR = 1.25
+# Bound on the size of the difference matrix scored at once in rank_layouts
+MAX_SCORE_ELEMENTS = 2 ** 22
 
 logger = logging.getLogger(__name__)
 
 
+class DatFile:
+    """Single .dat file of interleaved samples. Owns one memory map of the file as (n_samples, n_channels) array,
+    opened on first access and kept until closed. The layout comes from the metadata (sidecar, explicit values or
+    guessing, see metadata_from_target).
+
+    Windows without channel selection, or with a single channel or a channel slice, are views into the map.
+    Channel lists produce a copy of only the selected window.
+    """
+
+    def __init__(self, path, n_channels=None, dtype=None, mode='r', metadata=None):
+        """
+        Args:
+            path: Path to .dat file
+            n_channels: Number of channels. Default: from metadata
+            dtype: Sample dtype. Default: from metadata
+            mode: Memory map mode, 'r' or 'r+'
+            metadata: Metadata dictionary from metadata_from_target, read if not given
+        """
+        self.path = str(path)
+        self.metadata = metadata_from_target(self.path, n_channels=n_channels, dtype=dtype) \
+            if metadata is None else metadata
+        self.n_channels = int(self.metadata['CHANNELS']['n_channels'])
+        self.dtype = np.dtype(self.metadata['DTYPE'])
+        self.sampling_rate = self.metadata['HEADER']['sampling_rate']
+        self.mode = mode
+        self._data = None
+
+    @classmethod
+    def create(cls, path, n_samples, n_channels, dtype=DEFAULT_DTYPE, sampling_rate=DEFAULT_SAMPLING_RATE):
+        """Create a new .dat file of the given size, mapped for writing."""
+        np.memmap(str(path), dtype=dtype, mode='w+', shape=(int(n_samples), int(n_channels))).flush()
+        metadata = {'HEADER': {'sampling_rate': sampling_rate, 'block_size': 1, 'n_samples': n_samples},
+                    'DTYPE': str(np.dtype(dtype)), 'CHANNELS': {'n_channels': n_channels}, 'TARGET': str(path)}
+        return cls(path, mode='r+', metadata=metadata)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=self.dtype, mode=self.mode).reshape(-1, self.n_channels)
+        return self
+
+    def close(self):
+        if self._data is not None and self.mode != 'r':
+            self._data.flush()
+        self._data = None
+
+    @property
+    def data(self):
+        """Memory map of the whole file as (n_samples, n_channels) array."""
+        return self.open()._data
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def n_samples(self):
+        return self.data.shape[0]
+
+    def __len__(self):
+        return self.n_samples
+
+    def window(self, start=0, n_samples=None, channels=None):
+        """Samples [start, start + n_samples) of the selected channels, clipped to the end of the file.
+
+        Args:
+            start: First sample
+            n_samples: Number of samples. Default: to the end of the file
+            channels: Channel index, slice or list of channels. Default: all channels
+
+        Returns:
+            (n_samples, n_channels) array, a view into the map unless channels is a list.
+        """
+        end = self.n_samples if n_samples is None else min(self.n_samples, int(start) + int(n_samples))
+        window = self.data[int(start):end]
+        if channels is None:
+            return window
+        if isinstance(channels, (int, np.integer, slice)):
+            return window[:, channels]
+        return window.take(channels, axis=1)
+
+    def channel_view(self, channels):
+        """All samples of a channel index or slice as strided view, of a channel list as copy."""
+        return self.window(channels=channels)
+
+    def chunks(self, chunk_size=None, channels=None, start=0, end=None):
+        """Iterate over (start, end, window) chunks of the file, see window.
+
+        Args:
+            chunk_size: Samples per chunk. Default: largest chunk within the memory budget, see chunking.plan_size
+            channels: Channel selection of the windows
+            start: First sample
+            end: End sample (exclusive). Default: end of file
+        """
+        end = self.n_samples if end is None else min(self.n_samples, int(end))
+        chunk_size = chunking.plan_size('read', self.n_channels, self.dtype.itemsize) if chunk_size is None \
+            else int(chunk_size)
+        for chunk_start in range(int(start), end, chunk_size):
+            chunk_end = min(end, chunk_start + chunk_size)
+            yield chunk_start, chunk_end, self.window(chunk_start, chunk_end - chunk_start, channels)
+
+
+class DatWriter:
+    """Appends (n_samples, n_channels) arrays to a .dat file. Counterpart of datz.DatzWriter and hdf5.H5Writer,
+    see create_writer. With start, samples are written from that sample on into an existing file, e.g. one
+    allocated by allocate, so several writers can fill their part of a file at the same time."""
+
+    def __init__(self, path, n_channels, dtype=DEFAULT_DTYPE, sampling_rate=DEFAULT_SAMPLING_RATE, mode='w',
+                 compression=None, start=None):
+        if compression is not None:
+            raise ValueError('{} files are not compressed, use .datz or .h5 for {}'.format(FMT_FEXT, compression))
+        self.path = str(path)
+        self.n_channels = int(n_channels)
+        self.dtype = np.dtype(dtype)
+        if start is None:
+            self.fid = open(self.path, mode + 'b')
+        else:
+            self.fid = open(self.path, 'r+b')
+            self.fid.seek(int(start) * self.n_channels * self.dtype.itemsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, arr):
+        np.asarray(arr, dtype=self.dtype).reshape(-1, self.n_channels).tofile(self.fid)
+
+    def flush(self):
+        """Hand the samples written so far to the operating system, e.g. before recording progress."""
+        self.fid.flush()
+
+    def close(self):
+        if self.fid is not None:
+            self.fid.close()
+        self.fid = None
+
+
+def allocate(path, n_samples, n_channels, dtype=DEFAULT_DTYPE):
+    """Create or truncate a .dat file to hold n_samples samples, to be filled by DatWriters with start."""
+    with open(str(path), 'wb') as fid:
+        fid.truncate(int(n_samples) * int(n_channels) * np.dtype(dtype).itemsize)
+
+
+def container_format(path):
+    """Format module of self-describing variants of the .dat layout, by extension: datz for compressed .datz files,
+    hdf5 for .h5 files. None for plain .dat files."""
+    ext = util.fext(str(path))
+    if ext == '.datz':
+        from dataman.formats import datz
+        return datz
+    if ext == '.h5':
+        from dataman.formats import hdf5
+        return hdf5
+    return None
+
+
+def open_file(path, n_channels=None, dtype=None, mode='r', metadata=None):
+    """Open a .dat, compressed .datz or .h5 file, by extension, as DatFile, datz.DatzFile or hdf5.H5File."""
+    fmt = container_format(path)
+    if fmt is not None:
+        return fmt.open_file(path, n_channels=n_channels, dtype=dtype, mode=mode, metadata=metadata)
+    return DatFile(path, n_channels=n_channels, dtype=dtype, mode=mode, metadata=metadata)
+
+
+def create_writer(path, n_channels, dtype=DEFAULT_DTYPE, sampling_rate=DEFAULT_SAMPLING_RATE, mode='w',
+                  compression=None, start=None):
+    """Writer for a .dat, compressed .datz or .h5 file, by extension. All take (n_samples, n_channels) arrays.
+
+    Args:
+        path: Output file path
+        n_channels: Number of channels
+        dtype: Sample dtype
+        sampling_rate: Sampling rate, stored in the header of .datz and .h5 files
+        mode: 'w' to create or truncate, 'a' to append
+        compression: Codec of .datz files (zlib, bz2, lzma), filter of .h5 files (gzip, lzf). Default: zlib for
+                     .datz, none for .h5
+        start: Write into an existing .dat file from this sample on, instead of by mode, see DatWriter
+    """
+    fmt = container_format(path)
+    if fmt is not None:
+        if start is not None:
+            raise ValueError('{} files can only be written in order, not from sample {}'.format(fmt.FMT_NAME, start))
+        return fmt.create_writer(path, n_channels, dtype=dtype, sampling_rate=sampling_rate, mode=mode,
+                                 compression=compression)
+    return DatWriter(path, n_channels, dtype=dtype, sampling_rate=sampling_rate, mode=mode, compression=compression,
+                     start=start)
+
+
+def layout_info(path):
+    """Layout of a .dat, .datz or .h5 file in the form of the metadata sidecar (n_channels, dtype, sampling_rate,
+    bit_volts, offsets): the sidecar if there is one, else the header of self-describing files. None for .dat files
+    without sidecar."""
+    sidecar = read_sidecar(path)
+    if sidecar is not None or container_format(path) is None:
+        return sidecar
+    metadata = container_format(path).metadata_from_target(path)
+    return {'n_channels': metadata['CHANNELS']['n_channels'],
+            'dtype': metadata['DTYPE'],
+            'sampling_rate': metadata['HEADER']['sampling_rate'],
+            'bit_volts': metadata['HEADER']['bit_volts'],
+            'offsets': metadata['OFFSETS'] or []}
+
+
+class DatDataset:
+    """Several .dat files of identical layout presented as one contiguous (n_samples, n_channels) array, e.g.
+    per-day recordings of a session. Files are memory-mapped, slices within a single file are views into the
+    mapping, slices crossing file boundaries are stitched into a new array. Compressed .datz and .h5 files can be mixed
+    in, their windows are decoded on access.
+
+    The offset table maps global samples to files. Where a file has a .dataman.offsets table of the sources it
+    was converted from, the sources are listed as segments as well.
+    """
+
+    def __init__(self, paths, n_channels=None, dtype=None, start=0, end=None):
+        """
+        Args:
+            paths: List of .dat/.datz/.h5 file paths, in order
+            n_channels: Number of channels. Default: from sidecar, or guessed, see metadata_from_target
+            dtype: Sample dtype. Default: from sidecar, or guessed
+            start: First global sample of the dataset, see subset
+            end: End of the dataset (exclusive)
+        """
+        self.paths = [str(p) for p in paths]
+        if not len(self.paths):
+            raise ValueError('No .dat files given.')
+
+        self.files = [open_file(p, n_channels=n_channels, dtype=dtype) for p in self.paths]
+        self.n_channels = self.files[0].n_channels
+        self.dtype = self.files[0].dtype
+        self.sampling_rate = self.files[0].sampling_rate
+        if any([(f.n_channels, f.dtype) != (self.n_channels, self.dtype) for f in self.files]):
+            raise ValueError('Files differ in channel count or dtype: {}'.format(self.paths))
+
+        self.file_offsets = np.cumsum([0] + [f.n_samples for f in self.files])
+
+        total = int(self.file_offsets[-1])
+        self.start = min(max(0, int(start)), total)
+        self.end = total if end is None else min(max(self.start, int(end)), total)
+
+    @property
+    def shape(self):
+        return self.end - self.start, self.n_channels
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def locate(self, sample):
+        """Map a sample of the dataset to the index of its file and the sample within that file."""
+        if not 0 <= sample < len(self):
+            raise IndexError('Sample {} outside of dataset with {} samples'.format(sample, len(self)))
+        sample += self.start
+        file_idx = int(np.searchsorted(self.file_offsets, sample, side='right')) - 1
+        return file_idx, int(sample - self.file_offsets[file_idx])
+
+    def segments(self):
+        """Offset table of the dataset as list of (path, source, start, n_samples). Sources are read from the
+        .dataman.offsets of each file, files without one form a single segment. Starts are global samples
+        of the full file list."""
+        table = []
+        for path, file_start, f in zip(self.paths, self.file_offsets, self.files):
+            sources = read_offsets(path)
+            if sum([n for _, n in sources]) != f.n_samples:
+                sources = [(path, f.n_samples)]
+            position = int(file_start)
+            for source, n_samples in sources:
+                table.append((path, source, position, n_samples))
+                position += n_samples
+        return table
+
+    def read(self, start, n_samples):
+        """Samples [start, start + n_samples) of the dataset, clipped to its end. A view if the window lies in
+        a single file."""
+        start = min(max(0, int(start)), len(self))
+        end = min(len(self), start + max(0, int(n_samples)))
+        if start == end:
+            return np.empty((0, self.n_channels), dtype=self.dtype)
+
+        first, first_local = self.locate(start)
+        last, last_local = self.locate(end - 1)
+        if first == last:
+            return self.files[first].window(first_local, last_local + 1 - first_local)
+
+        parts = [self.files[first].window(first_local)] + [f.window() for f in self.files[first + 1:last]] + \
+                [self.files[last].window(0, last_local + 1)]
+        return np.concatenate(parts, axis=0)
+
+    def subset(self, start=0, end=None):
+        """Dataset restricted to samples [start, end) of this one, with slice semantics, without reading data."""
+        start, end, _ = slice(start, end).indices(len(self))
+        ds = object.__new__(DatDataset)
+        ds.__dict__.update(self.__dict__)
+        ds.start, ds.end = self.start + start, self.start + max(start, end)
+        return ds
+
+    def __getitem__(self, item):
+        """Row slices with step 1, optionally with a column index, e.g. ds[a:b], ds[a:b, :], ds[a:b, [0, 2]]."""
+        rows, cols = item if isinstance(item, tuple) else (item, slice(None))
+        if not isinstance(rows, slice) or rows.step not in [None, 1]:
+            raise IndexError('DatDataset only supports contiguous row slices, got {}'.format(rows))
+        start, stop, _ = rows.indices(len(self))
+        return self.read(start, stop - start)[:, cols]
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
 class DataStreamer(Streamer.Streamer):
     def __init__(self, target_path, metadata, *args, **kwargs):
         super(DataStreamer, self).__init__(*args, **kwargs)
         self.target_path = target_path
 
-        if 'dtype' in kwargs:
-            self.dtype = kwargs['dtype']
-        else:
-            self.dtype = np.dtype('int16')
         logger.debug('DAT-File Streamer Initialized at {}!'.format(target_path))
         self.cfg = metadata
 
@@ -34,20 +361,17 @@ class DataStreamer(Streamer.Streamer):
             logger.error('Using .vis with channel map not supported!')
             raise SystemExit
 
+        # Files are mapped lazily in the streaming process, several files (see merge_metadata) are joined
+        self.dataset = None
+
     def reposition(self, offset):
         logger.debug('Rolling to position {}'.format(offset))
+        if self.dataset is None:
+            self.dataset = DatDataset(self.cfg.get('TARGETS', [self.target_path]),
+                                      n_channels=self.cfg['CHANNELS']['n_channels'], dtype=self.cfg['DTYPE'])
 
-        n_channels = self.buffer.buffer.shape[0]
-        byte_offset = offset * n_channels * self.dtype.itemsize * NUM_SAMPLES
-        dtype = self.buffer.buffer.dtype
-
-        with open(self.target_path, 'rb') as dat_file:
-            dat_file.seek(byte_offset)
-            chunk = np.fromfile(dat_file, count=self.buffer.buffer.size, dtype=self.dtype).reshape(-1,
-                                                                                                   n_channels).T.astype(
-                dtype) * AMPLITUDE_SCALE
-
-        self.buffer.put_data(chunk)
+        chunk = self.dataset.read(offset * NUM_SAMPLES, self.buffer.buffer.shape[1])
+        self.put_samples(chunk.T, scale=AMPLITUDE_SCALE)
 
 
 def detect(base_path, pre_walk=None):
@@ -63,7 +387,7 @@ def detect(base_path, pre_walk=None):
     root, dirs, files = util.path_content(base_path) if pre_walk is None else pre_walk
 
     logger.debug('Looking for .dat files'.format(dirs, files))
-    dat_files = [f for f in files if util.fext(f) == '.dat']
+    dat_files = [f for f in files if util.fext(f) == FMT_FEXT]
     logger.debug('{} .dat files found: {}'.format(len(dat_files), dat_files))
     if not len(dat_files):
         return None
@@ -73,50 +397,200 @@ def detect(base_path, pre_walk=None):
         return '{}x {}'.format(len(dat_files), FMT_NAME)
 
 
-def guess_n_channels(base_path, dtype=DEFAULT_DTYPE, n_channels_max=MAX_NUM_CHANNELS_GUESS, n_bytes=1024):
-    """Proper sample alignment most likely has smaller sample diff than when samples of
-    channels are mixed up."""
+def sidecar_path(dat_path):
+    """Path of the metadata sidecar of a .dat file."""
+    return str(dat_path) + SIDECAR_SUFFIX
 
-    # FIXME: Return sorted list of candidates
-    def mean_abs_diff(arr, n):
-        return np.mean(np.abs(np.diff(arr[:arr.shape[0] - arr.shape[0] % (n + 1)].reshape(-1, n + 1), axis=0)))
 
-    chunk = np.fromfile(base_path, dtype=dtype, count=n_bytes * n_channels_max)
-    costs = [mean_abs_diff(chunk, n) for n in range(n_channels_max)]
-    return int(np.argmin(costs) + 1)
+def write_sidecar(dat_path, n_channels, dtype=DEFAULT_DTYPE, sampling_rate=DEFAULT_SAMPLING_RATE, bit_volts=None,
+                  offsets=None):
+    """Write the metadata sidecar of a .dat file, making guessing of its layout unnecessary.
 
+    Args:
+        dat_path: Path to the .dat file
+        n_channels: Number of interleaved channels
+        dtype: Sample data type
+        sampling_rate: Sampling rate in Hz
+        bit_volts: Microvolts per bit of the samples, if known
+        offsets: List of (source target, n_samples) the file was concatenated from, in order
+    """
+    sidecar = {'version': SIDECAR_VERSION,
+               'n_channels': int(n_channels),
+               'dtype': str(np.dtype(dtype)),
+               'sampling_rate': float(sampling_rate),
+               'bit_volts': bit_volts,
+               'offsets': [{'target': str(target), 'n_samples': int(n_samples)}
+                           for target, n_samples in ([] if offsets is None else offsets)]}
+    with open(sidecar_path(dat_path), 'w') as sf:
+        json.dump(sidecar, sf, indent=2)
+    logger.debug('Wrote metadata sidecar {}'.format(sidecar_path(dat_path)))
 
-def guess_dtype(base_path, n_bytes=2 ** 16, arr=None):
-    return None
-    #raise NotImplemented
-    # np_dtypes = list(map(np.dtype, POSSIBLE_DTYPES))
-    # chunk = np.fromfile(base_path, dtype='byte', count=n_bytes)
-    #
-    # ftypes = [dt for dt in POSSIBLE_DTYPES if 'float' in dt]
-    # fmaxes = [np.finfo(flt).max for flt in ftypes]
-    #
-    # itypes = [dt for dt in POSSIBLE_DTYPES if 'int' in dt]
-    # imaxes = [np.iinfo(it).max for it in itypes]
-    #
-    # dtypes = ftypes + itypes
-    # dmaxes = fmaxes + imaxes
-    # print(list(zip(dtypes, dmaxes)))
-
-    # # Float -> check for nans or huge exponents
-    #
-    # # uint or int? -> Check which is larger, int16 or uint16
-    #
-    # # (u)int16 or (u)int32? -> Non-normalized much larger, and first half < second half!
-    #
-    # relmus = []
-    # for idx, dt in enumerate(POSSIBLE_DTYPES):
-    #     relmus.append((dt, np.mean(np.abs(chunk.view(dt))) / dmaxes[idx]))
-    #
-    # res = []
-    # for idx, dt in enumerate(np_dtypes):
-    #     mu = np.mean(np.abs(chunk.view(dt)))
-    #     res.append(np.Inf if np.isnan(mu) else mu)
-    # print('{}\t: mu={:.2f}'.format(dt, res))
+
+def read_sidecar(dat_path):
+    """Read the metadata sidecar of a .dat file.
+
+    Returns:
+        Sidecar dictionary (n_channels, dtype, sampling_rate, bit_volts, offsets), None if the file has no
+        readable sidecar.
+    """
+    try:
+        with open(sidecar_path(dat_path), 'r') as sf:
+            sidecar = json.load(sf)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning('Ignoring unreadable metadata sidecar {}: {}'.format(sidecar_path(dat_path), e))
+        return None
+    if sidecar.get('version') != SIDECAR_VERSION:
+        logger.warning('Ignoring metadata sidecar {} of unknown version'.format(sidecar_path(dat_path)))
+        return None
+    return sidecar
+
+
+def copy_sidecar(src_path, dst_path, **updates):
+    """Write the sidecar of src_path for a derived .dat file at dst_path, e.g. with fewer channels. Gain and
+    offsets of .h5 files are read from and written to their attributes.
+
+    Returns:
+        True if src_path had a sidecar to copy.
+    """
+    sidecar = layout_info(src_path)
+    if sidecar is None:
+        return False
+    sidecar.update(updates)
+    offsets = [(offset['target'], offset['n_samples']) for offset in sidecar['offsets']]
+    if util.fext(str(dst_path)) == '.h5':
+        container_format(dst_path).write_metadata(dst_path, bit_volts=sidecar['bit_volts'], offsets=offsets)
+        return True
+    write_sidecar(dst_path, n_channels=sidecar['n_channels'], dtype=sidecar['dtype'],
+                  sampling_rate=sidecar['sampling_rate'], bit_volts=sidecar['bit_volts'], offsets=offsets)
+    return True
+
+
+def rank_layouts(base_path, dtypes=None, n_channels=None, n_channels_max=MAX_NUM_CHANNELS_GUESS, n_bytes=2 ** 17):
+    """Rank candidate (n_channels, dtype) layouts of a headerless .dat file.
+
+    Only channel counts dividing the number of items in the file are candidates. For each dtype, a window from
+    the middle of the file is scored for all candidate counts at once: correctly interleaved channels change
+    little from one sample to the next, so the mean absolute difference between items n_channels apart, relative
+    to the spread of the values, is smallest for the true layout. Float interpretations producing non-finite
+    values are dropped. Scores of all but the first dtype are inflated by DTYPE_PRIOR, remaining ties are
+    resolved in order of dtypes, then channel count. Files without signal get a single DEFAULT_DTYPE candidate
+    of the smallest fitting channel count.
+
+    Args:
+        base_path: Path to .dat file
+        dtypes: Candidate dtypes. Default: POSSIBLE_DTYPES, DEFAULT_DTYPE first
+        n_channels: Known channel count, only dtypes are ranked
+        n_channels_max: Largest channel count considered
+        n_bytes: Size of the scored window
+
+    Returns:
+        List of (n_channels, dtype, score) tuples, best candidate first.
+    """
+    if dtypes is None:
+        dtypes = [DEFAULT_DTYPE] + [dt for dt in POSSIBLE_DTYPES if dt != DEFAULT_DTYPE]
+    file_size = op.getsize(base_path)
+
+    # Window aligned to the largest item size, from the middle of the file to skip initial transients/zeros
+    align = max([np.dtype(dt).itemsize for dt in dtypes])
+    n_bytes = min(n_bytes, file_size - file_size % align)
+    offset = (file_size // 2 - n_bytes // 2) // align * align
+    raw = np.fromfile(base_path, dtype='uint8', count=n_bytes, offset=offset)
+    if not raw.any():
+        raw = np.fromfile(base_path, dtype='uint8', count=n_bytes)
+
+    # Nothing to score in empty or all-zero files (e.g. interrupted, preallocated outputs): fall back to the
+    # preferred dtype and the smallest channel count fitting the file
+    if not raw.any():
+        dtype = DEFAULT_DTYPE if np.dtype(DEFAULT_DTYPE) in [np.dtype(dt) for dt in dtypes] else dtypes[0]
+        itemsize = np.dtype(dtype).itemsize
+        count = 1 if n_channels is None else n_channels
+        if file_size % (itemsize * count):
+            return []
+        return [(count, dtype, 0.)]
+
+    # Integers stored in twice their width (e.g. int16 samples in an int32 file) look like a perfectly smooth
+    # narrow layout with every other channel holding the constant sign extension. Rule those out, but only in
+    # favour of the wide dtype: narrow recordings with zeroed channels look the same.
+    candidate_dtypes = set([np.dtype(dt) for dt in dtypes])
+    implausible = set()
+    for dtype in dtypes:
+        narrow = np.dtype(dtype)
+        if narrow.kind not in 'iu' or raw.size % (2 * narrow.itemsize):
+            continue
+        if not any([np.dtype('{}{}'.format(kind, 2 * narrow.itemsize)) in candidate_dtypes for kind in 'iu']):
+            continue
+        for kind in 'iu':
+            wide = raw.view('{}{}'.format(kind, 2 * narrow.itemsize))
+            if np.all(wide == wide.astype('{}{}'.format(kind, narrow.itemsize))):
+                implausible.add(narrow)
+
+    candidates = []
+    for preference, dtype in enumerate(dtypes):
+        itemsize = np.dtype(dtype).itemsize
+        if file_size % itemsize or np.dtype(dtype) in implausible:
+            continue
+        n_items = file_size // itemsize
+
+        if n_channels is not None:
+            counts = np.array([n_channels]) if not n_items % n_channels else np.array([], dtype=int)
+        else:
+            counts = np.arange(1, min(n_channels_max, n_items) + 1)
+            counts = counts[n_items % counts == 0]
+
+        with np.errstate(invalid='ignore', over='ignore'):
+            window = raw[:raw.size - raw.size % itemsize].view(dtype).astype('float64')
+        counts = counts[counts < window.size // 2]
+        if not counts.size or not np.all(np.isfinite(window)):
+            continue
+
+        # Signed and unsigned interpretations share the spread of the signed values, values wrapping around
+        # in the wrong interpretation then only add to its differences
+        reference = window if np.dtype(dtype).kind != 'u' else \
+            raw[:raw.size - raw.size % itemsize].view('i{}'.format(itemsize)).astype('float64')
+
+        # all lags in one strided computation, (n_counts, n_items) differences. Huge float values overflow,
+        # candidates without a finite score are dropped.
+        base = np.arange(min(window.size - counts.max(), max(NUM_SAMPLES, MAX_SCORE_ELEMENTS // counts.size)))
+        with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+            spread = np.abs(reference - reference.mean()).mean()
+            diffs = np.abs(window[base[None, :] + counts[:, None]] - window[base][None, :]).mean(axis=1)
+            scores = diffs / spread if spread > 0 else np.zeros(counts.size)
+        if preference:
+            scores *= DTYPE_PRIOR
+        candidates.extend([(float(score), preference, int(count), dtype) for count, score in zip(counts, scores)
+                           if np.isfinite(score)])
+
+    return [(count, dtype, score) for score, _, count, dtype in sorted(candidates)]
+
+
+def read_offsets(dat_path):
+    """Read the .dataman.offsets table written by conv next to a .dat file.
+
+    Returns:
+        List of (source target, n_samples) in order, empty if the file has no table.
+    """
+    try:
+        with open(str(dat_path) + OFFSETS_SUFFIX, 'r') as of:
+            lines = [line.strip() for line in of.readlines()[1:] if len(line.strip())]
+    except FileNotFoundError:
+        return []
+    return [(source.strip(), int(n_samples)) for source, n_samples in [line.rsplit(',', 1) for line in lines]]
+
+
+def guess_n_channels(base_path, dtype=DEFAULT_DTYPE, n_channels_max=MAX_NUM_CHANNELS_GUESS):
+    """Most likely channel count of a .dat file of the given dtype, see rank_layouts."""
+    ranking = rank_layouts(base_path, dtypes=[dtype], n_channels_max=n_channels_max)
+    if not len(ranking):
+        raise ValueError('No channel count up to {} fits {} as {}'.format(n_channels_max, base_path, dtype))
+    return ranking[0][0]
+
+
+def guess_dtype(base_path, n_channels=None):
+    """Most likely dtype of a .dat file, see rank_layouts. None if no candidate fits the file."""
+    ranking = rank_layouts(base_path, n_channels=n_channels)
+    return ranking[0][1] if len(ranking) else None
 
 
 def guess_sampling_rate(arr):
@@ -125,21 +599,46 @@ def guess_sampling_rate(arr):
 
 
 def metadata_from_target(base_path, *args, **kwargs):
-    if 'dtype' not in kwargs or kwargs['dtype'] is None:
+    # Compressed and HDF5 files carry their layout in the file
+    if container_format(base_path) is not None:
+        return container_format(base_path).metadata_from_target(base_path)
+
+    # Values given explicitly take precedence over the sidecar, the sidecar over any guessing
+    sidecar = read_sidecar(base_path)
+    if sidecar is not None:
+        logger.debug('Using metadata sidecar {}'.format(sidecar_path(base_path)))
+        for key in ['dtype', 'n_channels', 'sampling_rate']:
+            if kwargs.get(key) is None:
+                kwargs[key] = sidecar[key]
+
+    # continuous.dat files of Open Ephys binary recordings are described by their structure.oebin
+    if kwargs.get('n_channels') is None:
+        from dataman.formats import open_ephys_binary
+        oebin_metadata = open_ephys_binary.metadata_from_dat(base_path)
+        if oebin_metadata is not None:
+            logger.debug('Using channel count and sampling rate of Open Ephys binary recording')
+            joint_headers = next(iter(oebin_metadata['SUBSETS'].values()))['JOINT_HEADERS']
+            kwargs['n_channels'] = len(oebin_metadata['CHANNELS'])
+            if kwargs.get('dtype') is None:
+                kwargs['dtype'] = oebin_metadata['DTYPE']
+            if kwargs.get('sampling_rate') is None:
+                kwargs['sampling_rate'] = joint_headers['sampling_rate']
+
+    dtype, n_channels = kwargs.get('dtype'), kwargs.get('n_channels')
+    if dtype is None:
+        # smooth int16 recordings can look like other layouts, only guess_dtype ranks dtypes
         dtype = DEFAULT_DTYPE
-        guess_dtype(base_path)
-        logger.warning('Missing dtype parameter. Defaulting to {} without guessing.'.format(dtype))
-    else:
-        dtype = kwargs['dtype']
-
-    if 'n_channels' not in kwargs or kwargs['n_channels'] is None:
-        logger.warning('Channel number not given. Guessing between 1 and {} channels...'.format(MAX_NUM_CHANNELS_GUESS))
-        n_channels = guess_n_channels(base_path, dtype=dtype, n_channels_max=MAX_NUM_CHANNELS_GUESS)
-        logger.warning('{} seems to have {} channels'.format(base_path, n_channels))
-    else:
-        n_channels = kwargs['n_channels']
-
-    if 'sampling_rate' not in kwargs:
+        logger.warning('dtype not given, assuming {}'.format(np.dtype(DEFAULT_DTYPE)))
+    if n_channels is None:
+        logger.warning('Layout not given (dtype: {}, channels: {}). Guessing...'.format(dtype, n_channels))
+        ranking = rank_layouts(base_path, dtypes=[dtype], n_channels=n_channels)
+        if not len(ranking):
+            raise ValueError('No layout with up to {} channels fits {}'.format(MAX_NUM_CHANNELS_GUESS, base_path))
+        logger.debug('Layout candidates (channels, dtype, score): {}'.format(ranking[:5]))
+        n_channels, dtype = ranking[0][:2]
+        logger.warning('{} seems to have {} channels of {}'.format(base_path, n_channels, dtype))
+
+    if kwargs.get('sampling_rate') is None:
         sampling_rate = DEFAULT_SAMPLING_RATE
         logger.warning(
             'Missing sampling rate. Defaulting to {} kHz without guessing.'.format(DEFAULT_SAMPLING_RATE / 1e3))
@@ -148,7 +647,10 @@ def metadata_from_target(base_path, *args, **kwargs):
 
     return {'HEADER': {'sampling_rate': sampling_rate,
                        'block_size': 1,
-                       'n_samples': op.getsize(base_path) / DEFAULT_ITEMSIZE / n_channels},
+                       'n_samples': op.getsize(base_path) / np.dtype(dtype).itemsize / n_channels,
+                       'bit_volts': None if sidecar is None else sidecar['bit_volts']},
+            'OFFSETS': None if sidecar is None else sidecar['offsets'],
+            'TARGET': str(base_path),
             'DTYPE': dtype,
             'CHANNELS': {'n_channels': n_channels},
             'INFO': None,
@@ -157,6 +659,25 @@ def metadata_from_target(base_path, *args, **kwargs):
             'AUDIO': None}
 
 
+def merge_metadata(targets_metadata):
+    """Merge metadata of several .dat files of identical layout, read as one DatDataset by the DataStreamer.
+
+    Args:
+        targets_metadata: List of metadata dictionaries from metadata_from_target
+
+    Returns:
+        Metadata dictionary of the first file with the total n_samples and list of TARGETS.
+    """
+    layouts = set([(md['CHANNELS']['n_channels'], str(np.dtype(md['DTYPE']))) for md in targets_metadata])
+    if len(layouts) != 1:
+        raise ValueError('Files with different layouts can not be merged: {}'.format(layouts))
+
+    merged = dict(targets_metadata[0])
+    merged['HEADER'] = dict(merged['HEADER'], n_samples=sum([md['HEADER']['n_samples'] for md in targets_metadata]))
+    merged['TARGETS'] = [md['TARGET'] for md in targets_metadata]
+    return merged
+
+
 def fill_buffer(target, buffer, offset, **kwargs):
     # channels = kwargs['channels']
     n_channels = buffer.shape[0]
@@ -167,6 +688,6 @@ def fill_buffer(target, buffer, offset, **kwargs):
     with open(target, 'rb') as dat_file:
         dat_file.seek(byte_offset)
         logger.debug('offset: {}, byte_offset: {}, count: {}'.format(offset, byte_offset, buffer.shape[1]))
-        chunk = np.fromfile(dat_file, count=n_samples, dtype=dtype).reshape(-1, n_channels).T.astype(
-            'float32') * AMPLITUDE_SCALE
-        buffer[:] = chunk
+        chunk = np.fromfile(dat_file, count=n_samples, dtype=dtype).reshape(-1, n_channels).T
+        # integer buffers keep the raw values, scaling happens where they are displayed
+        buffer[:] = chunk if np.issubdtype(buffer.dtype, np.integer) else chunk.astype('float32') * AMPLITUDE_SCALE
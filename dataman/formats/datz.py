@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compressed variant of the flat .dat layout. Samples are stored in chunks of consecutive samples, each delta-encoded
+along time per channel (with wrap-around, so decoding is exact for integer types) and compressed with a standard
+library codec. Float samples are compressed as they are, deltas of floats would not decode exactly. A chunk index at
+the end of the file allows decoding any sample window by reading only the chunks spanning it.
+
+    MAGIC | header length (u4) | JSON header | chunk 0 | ... | chunk index | index offset, n_samples (u8) | MAGIC
+
+Appending leaves the existing chunk index and footer in place and writes the new chunks after them, followed by a new
+index of all chunks. Readers use the newest complete footer, an interrupted append loses only its own chunks.
+The JSON header holds the layout (n_channels, dtype, sampling_rate, codec, chunk_samples, delta) and is never
+rewritten. The chunk index is an (n_chunks, 3) u8 array of byte offset, compressed size and first sample of each chunk.
+Gain and source offsets live in the same .dataman.json sidecar as for .dat files.
+"""
+
+import bz2
+import json
+import logging
+import lzma
+import os
+import os.path as op
+import struct
+import zlib
+
+import numpy as np
+
+from dataman.lib import util
+from . import dat
+
+FMT_NAME = 'DATZ'
+FMT_FEXT = '.datz'
+
+MAGIC = b'DMZ1'
+DEFAULT_CHUNK_SAMPLES = 2 ** 16
+DEFAULT_CODEC = 'zlib'
+CODECS = {'zlib': (lambda b: zlib.compress(b, 1), zlib.decompress),
+          'bz2': (bz2.compress, bz2.decompress),
+          'lzma': (lzma.compress, lzma.decompress)}
+
+INDEX_DT = np.dtype('<u8')
+FOOTER = struct.Struct('<QQ4s')
+# Files without a footer at their end are searched backwards for the newest footer in blocks of this size
+FOOTER_SEARCH_BYTES = 2 ** 20
+
+logger = logging.getLogger(__name__)
+
+# Streaming through the virtual dataset of the dat module, which opens .datz files via dat.open_file
+DataStreamer = dat.DataStreamer
+AMPLITUDE_SCALE = dat.AMPLITUDE_SCALE
+
+
+def encode_chunk(chunk, codec=DEFAULT_CODEC, delta=True):
+    """Delta-encode (n_samples, n_channels) chunk along time and compress it, channel by channel. Without delta,
+    the samples are compressed as they are."""
+    if not delta:
+        return CODECS[codec][0](np.ascontiguousarray(chunk.T).tobytes())
+    deltas = np.empty_like(chunk.T)
+    deltas[:, 0] = chunk[0]
+    np.subtract(chunk[1:].T, chunk[:-1].T, out=deltas[:, 1:], casting='unsafe')
+    return CODECS[codec][0](deltas.tobytes())
+
+
+def decode_chunk(payload, n_channels, dtype, codec=DEFAULT_CODEC, delta=True):
+    """Decompress and integrate a chunk written by encode_chunk into (n_samples, n_channels) array."""
+    deltas = np.frombuffer(CODECS[codec][1](payload), dtype=dtype).reshape(n_channels, -1)
+    return np.cumsum(deltas, axis=1, dtype=dtype).T if delta else deltas.T
+
+
+class DatzFile:
+    """Reader of .datz files, serving the same windows and chunks as dat.DatFile. Decoded chunks are cached, reads
+    in order (e.g. by chunks()) decode each chunk once."""
+
+    def __init__(self, path, n_channels=None, dtype=None, mode='r', metadata=None):
+        if mode != 'r':
+            raise ValueError('{} files can not be modified in place.'.format(FMT_NAME))
+        self.path = str(path)
+        self.header, self.index, self._n_samples = read_layout(self.path)
+        self.n_channels = int(self.header['n_channels'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.sampling_rate = self.header['sampling_rate']
+        self.codec = self.header['codec']
+        self.delta = self.header.get('delta', True)
+        self.metadata = metadata_from_target(self.path) if metadata is None else metadata
+        self.mode = mode
+        self._fid = None
+        self._cached = (None, None)
+
+        if n_channels is not None and int(n_channels) != self.n_channels:
+            raise ValueError('{} has {} channels, not {}'.format(self.path, self.n_channels, n_channels))
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self._fid is None:
+            self._fid = open(self.path, 'rb')
+        return self
+
+    def close(self):
+        if self._fid is not None:
+            self._fid.close()
+        self._fid = None
+        self._cached = (None, None)
+
+    @property
+    def n_samples(self):
+        return self._n_samples
+
+    @property
+    def shape(self):
+        return self.n_samples, self.n_channels
+
+    def __len__(self):
+        return self.n_samples
+
+    def _chunk(self, idx):
+        if self._cached[0] != idx:
+            offset, size, _ = self.index[idx]
+            self.open()._fid.seek(int(offset))
+            payload = self._fid.read(int(size))
+            self._cached = (idx, decode_chunk(payload, self.n_channels, self.dtype, self.codec, self.delta))
+        return self._cached[1]
+
+    def window(self, start=0, n_samples=None, channels=None):
+        """Samples [start, start + n_samples) of the selected channels, see dat.DatFile.window. Only the chunks
+        spanning the window are read and decoded."""
+        start = min(max(0, int(start)), self.n_samples)
+        end = self.n_samples if n_samples is None else min(self.n_samples, start + int(n_samples))
+        if end <= start:
+            window = np.empty((0, self.n_channels), dtype=self.dtype)
+        else:
+            first, last = np.searchsorted(self.index[:, 2], [start, end - 1], side='right') - 1
+            parts = [self._chunk(idx) for idx in range(first, last + 1)]
+            window = parts[0] if len(parts) == 1 else np.concatenate(parts, axis=0)
+            skip = start - int(self.index[first, 2])
+            window = window[skip:skip + end - start]
+
+        if channels is None:
+            return window
+        if isinstance(channels, (int, np.integer, slice)):
+            return window[:, channels]
+        return window.take(channels, axis=1)
+
+    def channel_view(self, channels):
+        return self.window(channels=channels)
+
+    def chunks(self, chunk_size=None, channels=None, start=0, end=None):
+        """Iterate over (start, end, window) chunks, by default along the stored chunks."""
+        end = self.n_samples if end is None else min(self.n_samples, int(end))
+        chunk_size = int(self.header['chunk_samples']) if chunk_size is None else int(chunk_size)
+        for chunk_start in range(int(start), end, chunk_size):
+            chunk_end = min(end, chunk_start + chunk_size)
+            yield chunk_start, chunk_end, self.window(chunk_start, chunk_end - chunk_start, channels)
+
+
+class DatzWriter:
+    """Writes (n_samples, n_channels) arrays into a .datz file, chunk by chunk. Same interface as dat.DatWriter.
+    In append mode, the index of the existing file is read and new chunks are written after its footer, which stays
+    valid until close() writes the new one."""
+
+    def __init__(self, path, n_channels, dtype=dat.DEFAULT_DTYPE, sampling_rate=dat.DEFAULT_SAMPLING_RATE,
+                 mode='w', chunk_samples=DEFAULT_CHUNK_SAMPLES, codec=DEFAULT_CODEC):
+        self.path = str(path)
+        self.pending = []
+        self.n_pending = 0
+
+        if mode == 'a' and op.exists(self.path):
+            self.fid = open(self.path, 'r+b')
+            self.header, data_start = read_header(self.fid, self.path)
+            if (int(self.header['n_channels']), np.dtype(self.header['dtype'])) != (int(n_channels), np.dtype(dtype)):
+                self.fid.close()
+                raise ValueError('Can not append {} channels of {} to {}'.format(n_channels, dtype, self.path))
+            index, self.n_samples, footer_end = find_footer(self.fid, data_start, self.path)
+            self.index = [tuple(int(v) for v in row) for row in index]
+            # drops the chunks of an earlier, interrupted append
+            self.fid.seek(footer_end)
+            self.fid.truncate()
+        else:
+            if codec not in CODECS:
+                raise ValueError('Unknown codec {}, use one of {}'.format(codec, list(CODECS)))
+            self.header = {'n_channels': int(n_channels), 'dtype': str(np.dtype(dtype)),
+                           'sampling_rate': float(sampling_rate), 'codec': codec, 'chunk_samples': int(chunk_samples),
+                           'delta': np.dtype(dtype).kind in 'iu'}
+            self.n_samples = 0
+            self.index = []
+            self.fid = open(self.path, 'wb')
+            header = json.dumps(self.header).encode()
+            self.fid.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+        self.dtype = np.dtype(self.header['dtype'])
+        self.chunk_samples = int(self.header['chunk_samples'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, arr):
+        """Append (n_samples, n_channels) samples."""
+        self.pending.append(np.asarray(arr, dtype=self.dtype).reshape(-1, self.header['n_channels']))
+        self.n_pending += self.pending[-1].shape[0]
+        while self.n_pending >= self.chunk_samples:
+            self._flush(self.chunk_samples)
+
+    def _flush(self, n_samples):
+        pending = np.concatenate(self.pending, axis=0) if len(self.pending) > 1 else self.pending[0]
+        chunk, rest = pending[:n_samples], pending[n_samples:]
+        self.pending = [rest] if rest.shape[0] else []
+        self.n_pending = rest.shape[0]
+
+        payload = encode_chunk(chunk, self.header['codec'], self.header.get('delta', True))
+        self.index.append((self.fid.tell(), len(payload), self.n_samples))
+        self.fid.write(payload)
+        self.n_samples += chunk.shape[0]
+
+    def close(self):
+        """Write remaining samples as a last, shorter chunk, then the chunk index and footer."""
+        if self.fid is None:
+            return
+        if self.n_pending:
+            self._flush(self.n_pending)
+
+        index_offset = self.fid.tell()
+        np.array(self.index, dtype=INDEX_DT).reshape(-1, 3).tofile(self.fid)
+        self.fid.write(FOOTER.pack(index_offset, self.n_samples, MAGIC))
+        self.fid.close()
+        self.fid = None
+
+
+def open_file(path, n_channels=None, dtype=None, mode='r', metadata=None):
+    """Open a .datz file for reading, see dat.open_file."""
+    return DatzFile(path, n_channels=n_channels, dtype=dtype, mode=mode, metadata=metadata)
+
+
+def create_writer(path, n_channels, dtype=dat.DEFAULT_DTYPE, sampling_rate=dat.DEFAULT_SAMPLING_RATE, mode='w',
+                  compression=None):
+    """Writer of a .datz file compressed with the codec given as compression, see dat.create_writer."""
+    return DatzWriter(path, n_channels, dtype=dtype, sampling_rate=sampling_rate, mode=mode,
+                      codec=DEFAULT_CODEC if compression is None else compression)
+
+
+def read_layout(path):
+    """Header dictionary, (n_chunks, 3) chunk index (byte offset, size, first sample) and number of samples of a
+    .datz file."""
+    with open(str(path), 'rb') as fid:
+        header, data_start = read_header(fid, path)
+        index, n_samples, _ = find_footer(fid, data_start, path)
+    return header, index, n_samples
+
+
+def read_header(fid, path):
+    """JSON header of an open .datz file and the byte offset of its first chunk."""
+    fid.seek(0)
+    if fid.read(len(MAGIC)) != MAGIC:
+        raise ValueError('{} is not a {} file.'.format(path, FMT_NAME))
+    header_size = struct.unpack('<I', fid.read(4))[0]
+    return json.loads(fid.read(header_size).decode()), len(MAGIC) + 4 + header_size
+
+
+def read_footer(fid, footer_start, data_start):
+    """(n_chunks, 3) chunk index and number of samples of the footer at footer_start, None if there is no
+    consistent footer and index."""
+    fid.seek(footer_start)
+    index_offset, n_samples, magic = FOOTER.unpack(fid.read(FOOTER.size))
+    n_bytes = footer_start - index_offset
+    if magic != MAGIC or not data_start <= index_offset <= footer_start or n_bytes % (3 * INDEX_DT.itemsize):
+        return None
+    fid.seek(index_offset)
+    index = np.fromfile(fid, dtype=INDEX_DT, count=n_bytes // INDEX_DT.itemsize).reshape(-1, 3).astype('int64')
+    if not len(index):
+        return (index, 0) if not n_samples else None
+    if index[0, 0] < data_start or index[0, 2] or np.any(index[:, 0] + index[:, 1] > index_offset) \
+            or np.any(np.diff(index[:, 2]) <= 0) or index[-1, 2] >= n_samples:
+        return None
+    return index, int(n_samples)
+
+
+def find_footer(fid, data_start, path):
+    """Chunk index, number of samples and end of the newest complete footer of an open .datz file. Usually the
+    footer ends the file, after an interrupted append the file is searched backwards for the previous one."""
+    fid.seek(0, os.SEEK_END)
+    end = fid.tell()
+    if end - FOOTER.size >= data_start:
+        layout = read_footer(fid, end - FOOTER.size, data_start)
+        if layout is not None:
+            return layout + (end,)
+
+    logger.warning('{} does not end in a chunk index, searching for the index of an earlier write'.format(path))
+    block_end = end
+    while block_end - data_start >= len(MAGIC):
+        block_start = max(data_start, block_end - FOOTER_SEARCH_BYTES)
+        fid.seek(block_start)
+        block = fid.read(block_end - block_start)
+        pos = block.rfind(MAGIC)
+        while pos >= 0:
+            footer_end = block_start + pos + len(MAGIC)
+            layout = read_footer(fid, footer_end - FOOTER.size, data_start) \
+                if footer_end - FOOTER.size >= data_start else None
+            if layout is not None:
+                return layout + (footer_end,)
+            pos = block.rfind(MAGIC, 0, pos + len(MAGIC) - 1)
+        if block_start == data_start:
+            break
+        # overlap by less than a MAGIC, so a footer spanning both blocks is found in the next one
+        block_end = block_start + len(MAGIC) - 1
+    raise ValueError('{} is incomplete, chunk index missing.'.format(path))
+
+
+def detect(base_path, pre_walk=None):
+    """Checks for existence of .datz file(s) at the target path.
+
+    Args:
+        base_path: Directory to search in.
+        pre_walk: Tuple from previous path_content call (root, dirs, files)
+
+    Returns:
+        None if no data set found, else string
+    """
+    root, dirs, files = util.path_content(base_path) if pre_walk is None else pre_walk
+
+    datz_files = [f for f in files if util.fext(f) == FMT_FEXT]
+    if not len(datz_files):
+        return None
+    elif len(datz_files) == 1:
+        return '{}-File'.format(FMT_NAME)
+    else:
+        return '{}x {}'.format(len(datz_files), FMT_NAME)
+
+
+def metadata_from_target(base_path, *args, **kwargs):
+    """Metadata of a .datz file from its header and sidecar, in the layout of dat.metadata_from_target."""
+    header, _, n_samples = read_layout(base_path)
+    sidecar = dat.read_sidecar(base_path)
+    return {'HEADER': {'sampling_rate': header['sampling_rate'],
+                       'block_size': 1,
+                       'n_samples': n_samples,
+                       'bit_volts': None if sidecar is None else sidecar['bit_volts']},
+            'OFFSETS': None if sidecar is None else sidecar['offsets'],
+            'TARGET': str(base_path),
+            'DTYPE': header['dtype'],
+            'CHANNELS': {'n_channels': header['n_channels']},
+            'INFO': None,
+            'SIGNALCHAIN': None,
+            'FPGA_NODE': None,
+            'AUDIO': None}
+
+
+merge_metadata = dat.merge_metadata
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+Self-describing HDF5 variant of the flat .dat layout. Samples are stored in a single chunked (n_samples, n_channels)
+dataset, each chunk holds all channels of a stretch of samples, so time windows map to few consecutive chunks.
+Lossless compression (gzip or lzf with byte shuffling) is optional.
+
+    session.h5:/data          (n_samples, n_channels), attributes n_channels, dtype, sampling_rate
+    session.h5:/data.attrs    bit_volts, offsets, channel_groups, dead_channels written by conv
+
+Layout, gain, source recordings and channel groups are attributes of the data set, replacing the .prb, .offsets and
+metadata sidecar files that accompany a .dat file.
+"""
+
+import json
+import logging
+import os.path as op
+
+import h5py
+import numpy as np
+
+from dataman.lib import util, chunking
+from . import dat
+
+FMT_NAME = 'HDF5'
+FMT_FEXT = '.h5'
+
+DATASET_NAME = 'data'
+METADATA_VERSION = 1
+# Chunks of about this size, all channels of a stretch of samples, in multiples of CHUNK_ALIGN samples
+CHUNK_BYTES = 2 ** 18
+CHUNK_ALIGN = 1024
+# Chunk cache of readers, a few chunks to serve overlapping windows
+CACHE_BYTES = 16 * CHUNK_BYTES
+COMPRESSIONS = {'gzip': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+                'lzf': {'compression': 'lzf', 'shuffle': True}}
+
+logger = logging.getLogger(__name__)
+
+# Streaming through the virtual dataset of the dat module, which opens .h5 files via dat.open_file
+DataStreamer = dat.DataStreamer
+AMPLITUDE_SCALE = dat.AMPLITUDE_SCALE
+merge_metadata = dat.merge_metadata
+
+
+def chunk_samples(n_channels, dtype):
+    """Samples per chunk for the given layout, see CHUNK_BYTES."""
+    n_samples = CHUNK_BYTES // (int(n_channels) * np.dtype(dtype).itemsize)
+    return max(CHUNK_ALIGN, n_samples // CHUNK_ALIGN * CHUNK_ALIGN)
+
+
+class H5File:
+    """Reader of .h5 files written by H5Writer, serving the same windows and chunks as dat.DatFile. Windows are
+    read as hyperslabs, only the chunks overlapping a window are read and decompressed."""
+
+    def __init__(self, path, n_channels=None, dtype=None, mode='r', metadata=None):
+        if mode not in ['r', 'r+']:
+            raise ValueError('Unknown mode {}'.format(mode))
+        self.path = str(path)
+        self.mode = mode
+        self._file = None
+        self.open()
+        self.n_channels = int(self.dataset.shape[1])
+        self.dtype = self.dataset.dtype
+        self.sampling_rate = float(self.dataset.attrs['sampling_rate'])
+        self.metadata = metadata_from_target(self.path) if metadata is None else metadata
+
+        if n_channels is not None and int(n_channels) != self.n_channels:
+            raise ValueError('{} has {} channels, not {}'.format(self.path, self.n_channels, n_channels))
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self._file is None:
+            self._file = h5py.File(self.path, self.mode, rdcc_nbytes=CACHE_BYTES)
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    @property
+    def dataset(self):
+        return self.open()._file[DATASET_NAME]
+
+    @property
+    def data(self):
+        """The HDF5 dataset, sliced like the memory map of dat.DatFile."""
+        return self.dataset
+
+    @property
+    def n_samples(self):
+        return int(self.dataset.shape[0])
+
+    @property
+    def shape(self):
+        return self.n_samples, self.n_channels
+
+    def __len__(self):
+        return self.n_samples
+
+    def window(self, start=0, n_samples=None, channels=None):
+        """Samples [start, start + n_samples) of the selected channels, see dat.DatFile.window."""
+        start = min(max(0, int(start)), self.n_samples)
+        end = self.n_samples if n_samples is None else min(self.n_samples, start + int(n_samples))
+        if channels is None or isinstance(channels, slice):
+            return self.dataset[start:end, channels if channels is not None else slice(None)]
+        if isinstance(channels, (int, np.integer)):
+            return self.dataset[start:end, int(channels)]
+        return self.dataset[start:end].take(channels, axis=1)
+
+    def channel_view(self, channels):
+        return self.window(channels=channels)
+
+    def chunks(self, chunk_size=None, channels=None, start=0, end=None):
+        """Iterate over (start, end, window) chunks, by default along the stored chunks."""
+        end = self.n_samples if end is None else min(self.n_samples, int(end))
+        if chunk_size is None:
+            chunk_size = self.dataset.chunks[0] if self.dataset.chunks else \
+                chunking.plan_size('read', self.n_channels, self.dtype.itemsize)
+        for chunk_start in range(int(start), end, int(chunk_size)):
+            chunk_end = min(end, chunk_start + int(chunk_size))
+            yield chunk_start, chunk_end, self.window(chunk_start, chunk_end - chunk_start, channels)
+
+
+class H5Writer:
+    """Appends (n_samples, n_channels) arrays to the chunked dataset of a .h5 file. Same interface as
+    dat.DatWriter, see dat.create_writer."""
+
+    def __init__(self, path, n_channels, dtype=dat.DEFAULT_DTYPE, sampling_rate=dat.DEFAULT_SAMPLING_RATE,
+                 mode='w', compression=None):
+        self.path = str(path)
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression {}, use one of {}'.format(compression, list(COMPRESSIONS)))
+
+        if mode == 'a' and op.exists(self.path):
+            self.file = h5py.File(self.path, 'r+')
+            self.dataset = self.file[DATASET_NAME]
+            if (self.dataset.shape[1], self.dataset.dtype) != (int(n_channels), np.dtype(dtype)):
+                raise ValueError('Can not append {} channels of {} to {}'.format(n_channels, dtype, self.path))
+        else:
+            self.file = h5py.File(self.path, 'w')
+            self.dataset = self.file.create_dataset(DATASET_NAME, shape=(0, int(n_channels)), dtype=dtype,
+                                                    maxshape=(None, int(n_channels)),
+                                                    chunks=(chunk_samples(n_channels, dtype), int(n_channels)),
+                                                    **COMPRESSIONS.get(compression, {}))
+            self.dataset.attrs['version'] = METADATA_VERSION
+            self.dataset.attrs['n_channels'] = int(n_channels)
+            self.dataset.attrs['dtype'] = str(np.dtype(dtype))
+            self.dataset.attrs['sampling_rate'] = float(sampling_rate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, arr):
+        """Append (n_samples, n_channels) samples."""
+        arr = np.asarray(arr, dtype=self.dataset.dtype).reshape(-1, self.dataset.shape[1])
+        n_samples = self.dataset.shape[0]
+        self.dataset.resize(n_samples + arr.shape[0], axis=0)
+        self.dataset[n_samples:] = arr
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+
+def open_file(path, n_channels=None, dtype=None, mode='r', metadata=None):
+    """Open a .h5 file, see dat.open_file."""
+    return H5File(path, n_channels=n_channels, dtype=dtype, mode=mode, metadata=metadata)
+
+
+def create_writer(path, n_channels, dtype=dat.DEFAULT_DTYPE, sampling_rate=dat.DEFAULT_SAMPLING_RATE, mode='w',
+                  compression=None):
+    """Writer of a .h5 file, see dat.create_writer."""
+    return H5Writer(path, n_channels, dtype=dtype, sampling_rate=sampling_rate, mode=mode, compression=compression)
+
+
+def write_metadata(path, bit_volts=None, offsets=None, channel_groups=None, dead_channels=None):
+    """Describe the data of a .h5 file written by H5Writer with the contents of the metadata sidecar and .prb file.
+
+    Args:
+        path: Path to the .h5 file
+        bit_volts: Microvolts per bit of the samples, if known
+        offsets: List of (source target, n_samples) the file was concatenated from, in order
+        channel_groups: Channel groups of the probe layout, as in .prb files
+        dead_channels: List of dead channels
+    """
+    with h5py.File(str(path), 'r+') as h5f:
+        attrs = h5f[DATASET_NAME].attrs
+        if bit_volts is not None:
+            attrs['bit_volts'] = float(bit_volts)
+        attrs['offsets'] = json.dumps([{'target': str(target), 'n_samples': int(n_samples)}
+                                       for target, n_samples in ([] if offsets is None else offsets)])
+        if channel_groups is not None:
+            attrs['channel_groups'] = json.dumps({str(cg_id): cg for cg_id, cg in channel_groups.items()})
+        if dead_channels is not None:
+            attrs['dead_channels'] = json.dumps(list(dead_channels))
+    logger.debug('Wrote metadata attributes of {}'.format(path))
+
+
+def read_metadata(path):
+    """Metadata attributes of a .h5 file in the layout of a dat metadata sidecar, with channel_groups and
+    dead_channels if present."""
+    with h5py.File(str(path), 'r') as h5f:
+        dset = h5f[DATASET_NAME]
+        attrs = dict(dset.attrs)
+        metadata = {'version': int(attrs.get('version', METADATA_VERSION)),
+                    'n_channels': int(dset.shape[1]),
+                    'dtype': str(dset.dtype),
+                    'n_samples': int(dset.shape[0]),
+                    'sampling_rate': float(attrs['sampling_rate']),
+                    'bit_volts': float(attrs['bit_volts']) if 'bit_volts' in attrs else None,
+                    'offsets': json.loads(attrs.get('offsets', '[]'))}
+    for key in ['channel_groups', 'dead_channels']:
+        if key in attrs:
+            metadata[key] = json.loads(attrs[key])
+    if 'channel_groups' in metadata:
+        metadata['channel_groups'] = {int(cg_id): cg for cg_id, cg in metadata['channel_groups'].items()}
+    return metadata
+
+
+def detect(base_path, pre_walk=None):
+    """Checks for existence of .h5 file(s) at the target path.
+
+    Args:
+        base_path: Directory to search in.
+        pre_walk: Tuple from previous path_content call (root, dirs, files)
+
+    Returns:
+        None if no data set found, else string
+    """
+    root, dirs, files = util.path_content(base_path) if pre_walk is None else pre_walk
+
+    h5_files = [f for f in files if util.fext(f) == FMT_FEXT]
+    if not len(h5_files):
+        return None
+    elif len(h5_files) == 1:
+        return '{}-File'.format(FMT_NAME)
+    else:
+        return '{}x {}'.format(len(h5_files), FMT_NAME)
+
+
+def metadata_from_target(base_path, *args, **kwargs):
+    """Metadata of a .h5 file from its attributes, in the layout of dat.metadata_from_target."""
+    metadata = read_metadata(base_path)
+    return {'HEADER': {'sampling_rate': metadata['sampling_rate'],
+                       'block_size': 1,
+                       'n_samples': metadata['n_samples'],
+                       'bit_volts': metadata['bit_volts']},
+            'OFFSETS': metadata['offsets'],
+            'TARGET': str(base_path),
+            'DTYPE': metadata['dtype'],
+            'CHANNELS': {'n_channels': metadata['n_channels']},
+            'LAYOUT': {key: metadata[key] for key in ['channel_groups', 'dead_channels'] if key in metadata},
+            'INFO': None,
+            'SIGNALCHAIN': None,
+            'FPGA_NODE': None,
+            'AUDIO': None}
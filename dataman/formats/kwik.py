@@ -1,18 +1,185 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Open Ephys Kwik format. Raw data lives in a .raw.kwd HDF5 file per processor, holding one (n_samples, n_channels)
+int16 dataset per recording, the recordings play the role of the subsets of the open_ephys module.
+
+    experiment1_100.raw.kwd:/recordings/0/data
+    experiment1_100.raw.kwd:/recordings/0/application_data  (attribute channel_bit_volts)
+    experiment1_100.raw.kwd:/recordings/1/data
+
+Samples are read as hyperslabs of the chunked datasets, the files are never loaded as a whole.
+"""
+
 import os
 import xml.etree.ElementTree as ETree
+import logging
+from pathlib import Path
+from pprint import pformat
+
+import h5py
+import numpy as np
+
+from dataman.lib import Streamer
+from dataman.lib.constants import LOG_LEVEL_VERBOSE
 from dataman.lib.util import path_content
 from dataman.lib.util import fext
-import logging
+from . import open_ephys
+from .open_ephys import NUM_SAMPLES, AMPLITUDE_SCALE
 
 FMT_NAME = 'Kwik'
 FMT_FEXT = '.kwik'
 
+KWD_FEXT = '.kwd'
+RAW_KWD_SUFFIX = '.raw.kwd'
+DEFAULT_DTYPE = 'int16'
+DEFAULT_BIT_VOLTS = 0.195
+
 logger = logging.getLogger(__name__)
 
 
+class KwdDataset:
+    """Recordings (subsets) of one or more .kwd files as one contiguous (n_samples, n_channels) array, in the
+    order of the SUBSETS of the metadata. Reads are hyperslabs of the HDF5 datasets. Files are opened on first
+    read, so a dataset can be handed to another process before use.
+    """
+
+    def __init__(self, metadata, channels=None, start=0, end=None):
+        """
+        Args:
+            metadata: Metadata dictionary from metadata_from_target or merge_metadata
+            channels: Channels to read, in order. Default: all channels of the metadata
+            start: First sample of the dataset, see subset
+            end: End of the dataset (exclusive)
+        """
+        self.metadata = metadata
+        self.channels = list(metadata['CHANNELS']) if channels is None else list(channels)
+        self.n_channels = len(self.channels)
+        self.dtype = np.dtype(metadata['DTYPE'])
+
+        # contiguous channel ranges are read as part of the hyperslab
+        contiguous = self.channels == list(range(self.channels[0], self.channels[0] + self.n_channels))
+        self._columns = slice(self.channels[0], self.channels[0] + self.n_channels) if contiguous else None
+
+        subsets = list(metadata['SUBSETS'].values())
+        sampling_rates = set([subset['JOINT_HEADERS']['sampling_rate'] for subset in subsets])
+        if len(sampling_rates) != 1:
+            raise ValueError('Recordings with different sampling rates can not be joined: {}'.format(sampling_rates))
+        self.sampling_rate = sampling_rates.pop()
+
+        self.sources = [(subset['FILES'][self.channels[0]]['FILEPATH'], subset['FILES'][self.channels[0]]['DATASET'])
+                        for subset in subsets]
+        self.offsets = np.cumsum([0] + [int(subset['JOINT_HEADERS']['n_samples']) for subset in subsets])
+        self._files = {}
+
+        total = int(self.offsets[-1])
+        self.start = min(max(0, int(start)), total)
+        self.end = total if end is None else min(max(self.start, int(end)), total)
+
+    @property
+    def shape(self):
+        return self.end - self.start, self.n_channels
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _dataset(self, idx):
+        path, name = self.sources[idx]
+        if path not in self._files:
+            self._files[path] = h5py.File(path, 'r')
+        return self._files[path][name]
+
+    def locate(self, sample):
+        """Map a sample of the dataset to the index of its recording and the sample within that recording."""
+        if not 0 <= sample < len(self):
+            raise IndexError('Sample {} outside of dataset with {} samples'.format(sample, len(self)))
+        sample += self.start
+        idx = int(np.searchsorted(self.offsets, sample, side='right')) - 1
+        return idx, int(sample - self.offsets[idx])
+
+    def read(self, start, n_samples, out=None):
+        """Samples [start, start + n_samples) of the dataset, clipped to its end, across recording boundaries.
+
+        Args:
+            start: First sample
+            n_samples: Number of samples
+            out: Optional C-contiguous array of at least (n_samples, n_channels) the samples are read into
+
+        Returns:
+            (n_samples, n_channels) array, the leading rows of out if given.
+        """
+        start = min(max(0, int(start)), len(self))
+        end = min(len(self), start + max(0, int(n_samples)))
+        if out is None:
+            out = np.empty((end - start, self.n_channels), dtype=self.dtype)
+
+        position = start
+        while position < end:
+            idx, local = self.locate(position)
+            count = min(end - position, int(self.offsets[idx + 1] - self.start) - position)
+            dset = self._dataset(idx)
+            rows = np.s_[position - start:position - start + count]
+            if self._columns is not None and out.dtype == dset.dtype and out.flags.c_contiguous:
+                dset.read_direct(out, np.s_[local:local + count, self._columns], np.s_[rows, :])
+            else:
+                out[rows] = dset[local:local + count].take(self.channels, axis=1)
+            position += count
+        return out[:end - start]
+
+    def subset(self, start=0, end=None):
+        """Dataset restricted to samples [start, end) of this one, with slice semantics, without reading data."""
+        start, end, _ = slice(start, end).indices(len(self))
+        ds = object.__new__(KwdDataset)
+        ds.__dict__.update(self.__dict__)
+        ds._files = {}
+        ds.start, ds.end = self.start + start, self.start + max(start, end)
+        return ds
+
+    def __getitem__(self, item):
+        """Row slices with step 1, optionally with a column index, e.g. ds[a:b], ds[a:b, :], ds[a:b, [0, 2]]."""
+        rows, cols = item if isinstance(item, tuple) else (item, slice(None))
+        if not isinstance(rows, slice) or rows.step not in [None, 1]:
+            raise IndexError('KwdDataset only supports contiguous row slices, got {}'.format(rows))
+        start, stop, _ = rows.indices(len(self))
+        return self.read(start, stop - start)[:, cols]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class DataStreamer(Streamer.Streamer):
+    def __init__(self, target_path, metadata, *args, **kwargs):
+        super(DataStreamer, self).__init__(*args, **kwargs)
+        self.target_path = target_path
+        logger.debug('Kwik Streamer Initialized at {}!'.format(target_path))
+        self.metadata = metadata
+
+        # Files are opened in the streaming process, the window is read into a reused array
+        self.dataset = None
+        self.window = None
+
+    def reposition(self, offset):
+        """Read the hyperslab at the new position and hand it to the shared buffer, channels in channel map
+        order if given."""
+        logger.debug('Rolling to position {}'.format(offset))
+        if self.dataset is None:
+            self.dataset = KwdDataset(self.metadata, channels=self.channel_order)
+
+        n_samples = self.buffer.buffer.shape[1]
+        if self.window is None:
+            self.window = np.zeros((n_samples, self.dataset.n_channels), dtype=self.dataset.dtype)
+
+        window = self.dataset.read(offset * NUM_SAMPLES, n_samples, out=self.window)
+        self.put_samples(window.T, scale=AMPLITUDE_SCALE)
+
+
 def detect(base_path, pre_walk=None):
     """Checks for existence of a kwik formatted data set in the root directory.
 
@@ -21,7 +188,7 @@ def detect(base_path, pre_walk=None):
         pre_walk: Tuple from previous path_content call (root, dirs, files)
 
     Returns:
-        None if no data set found, else a dict of configuration data from settings.xml
+        None if no data set found, else True
     """
     root, dirs, files = path_content(base_path) if pre_walk is None else pre_walk
 
@@ -41,14 +208,93 @@ def format_version(base_path, pre_walk=None):
             return "{}_v{}".format(FMT_NAME, version if version else '???')
 
 
-def config(base_path):
-    logger.warning('Returning "empty" kwik config dict for path'.format(base_path))
-    return {'HEADER': {'sampling_rate': None},
-            'INFO': None,
-            'SIGNALCHAIN': None,
-            'FPGA_NODE': None,
-            'AUDIO': None}
+def find_kwd(target, proc_node=None):
+    """Path to the raw .kwd file of a Kwik data set, given the directory or the file itself.
+
+    Args:
+        target: Data set directory or .kwd file
+        proc_node: Processor id of the file to pick if there are several, e.g. 100 for experiment1_100.raw.kwd.
+                   Default: first raw file
+
+    Returns:
+        Path of the .kwd file
+    """
+    target = Path(target).resolve()
+    if target.is_file():
+        return target
+
+    candidates = sorted(target.glob('*' + RAW_KWD_SUFFIX)) or sorted(target.glob('*' + KWD_FEXT))
+    if proc_node is not None:
+        candidates = [c for c in candidates if c.name.split('.')[0].endswith('_{}'.format(proc_node))]
+    if not len(candidates):
+        raise FileNotFoundError('No {} file{} at {}'.format(
+            KWD_FEXT, '' if proc_node is None else ' of processor {}'.format(proc_node), target))
+    if len(candidates) > 1:
+        logger.warning('Several {} files at {}, using {}'.format(KWD_FEXT, target, candidates[0].name))
+    return candidates[0]
+
+
+def metadata_from_target(target, proc_node=None, *args, **kwargs):
+    """Get metadata of the recordings in a .kwd file, in the layout of the open_ephys module. Each recording is a
+    subset, all channels of a subset point to the HDF5 dataset of the recording.
+
+    Args:
+        target: Path to Kwik data set directory or .kwd file
+        proc_node: Processor id, see find_kwd
+
+    Returns:
+        Dictionary with configuration entries. (DTYPE, TARGET, INFO, SUBSETS, CHANNELS, ...)
+    """
+    kwd_path = find_kwd(target, proc_node)
+    subsets = {}
+    dtypes = set()
+    with h5py.File(str(kwd_path), 'r') as kwd:
+        for rec_name in sorted(kwd['recordings'], key=int):
+            recording = kwd['recordings'][rec_name]
+            data = recording['data']
+            n_samples, n_channels = data.shape
+            dtypes.add(str(data.dtype))
+
+            app_data = recording.get('application_data')
+            channel_bit_volts = app_data.attrs.get('channel_bit_volts') if app_data is not None else None
+            if channel_bit_volts is None:
+                channel_bit_volts = [DEFAULT_BIT_VOLTS] * n_channels
+
+            files = {channel: {'CHANNEL': channel,
+                               'BIT_VOLTS': float(channel_bit_volts[channel]),
+                               'FILEPATH': str(kwd_path),
+                               'FILENAME': kwd_path.name,
+                               'DATASET': data.name}
+                     for channel in range(n_channels)}
+            sampling_rate = float(recording.attrs.get('sample_rate', 0))
+            if not sampling_rate:
+                if app_data is None or 'channel_sample_rates' not in app_data.attrs:
+                    raise ValueError('No sampling rate for recording {} in {}'.format(rec_name, kwd_path))
+                sampling_rate = float(app_data.attrs['channel_sample_rates'][0])
+            subsets[int(rec_name)] = {'FILES': files,
+                                      'JOINT_HEADERS': {'n_samples': n_samples,
+                                                        'n_blocks': int(np.ceil(n_samples / NUM_SAMPLES)),
+                                                        'block_size': NUM_SAMPLES,
+                                                        'sampling_rate': sampling_rate,
+                                                        'chunks': data.chunks}}
+
+    if not len(subsets):
+        raise ValueError('No recordings in {}'.format(kwd_path))
+    channel_sets = set([tuple(subset['FILES']) for subset in subsets.values()])
+    if len(channel_sets) != 1 or len(dtypes) != 1:
+        raise ValueError('Recordings in {} differ in channel count or dtype.'.format(kwd_path))
+
+    metadata = {'DTYPE': dtypes.pop(),
+                'TARGET': str(Path(target).resolve()),
+                'INFO': None,
+                'SIGNALCHAIN': None,
+                'FPGA_NODE': proc_node,
+                'AUDIO': None,
+                'SUBSETS': subsets,
+                'CHANNELS': list(channel_sets.pop())}
+
+    logger.log(level=LOG_LEVEL_VERBOSE, msg=pformat(metadata, indent=2))
+    return metadata
 
 
-def fill_buffer():
-    raise NotImplementedError("Can't Kwik yet.")
+merge_metadata = open_ephys.merge_metadata
@@ -2,10 +2,15 @@
 
 import re
 import os
+import json
+import string
+import threading
 import xml.etree.ElementTree as ETree
 from dataman.lib import util, Streamer
 import numpy as np
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pformat
 
@@ -32,6 +37,54 @@ HEADER_REGEX = re.compile("header\.([\d\w\.\s]{1,}).=.\'*([^\;\']{1,})\'*")
 HEADER_DT = np.dtype([('Header', 'S%d' % SIZE_HEADER)])
 DEFAULT_DTYPE = 'int16'
 
+# .events file records, little endian (16 Byte)
+EVENTS_FEXT = '.events'
+EVENTS_DT = np.dtype([('timestamp', '<i8'),  # 8 Byte
+                      ('sample_num', '<i2'),  # 2 Byte, sample position in processing buffer
+                      ('event_type', np.uint8),  # 1 Byte, 3: TTL, 5: network event
+                      ('processor_id', np.uint8),  # 1 Byte
+                      ('event_id', np.uint8),  # 1 Byte, TTL: 1 rising, 0 falling edge
+                      ('channel', np.uint8),  # 1 Byte
+                      ('rec_num', '<u2')])  # 2 Byte
+EVENT_TYPE_TTL = 3
+
+# .spikes file records, little endian. Waveform shape is given by the channel/sample counts of the first record.
+SPIKES_FEXT = '.spikes'
+SPIKES_PREFIX_DT = np.dtype([('event_type', np.uint8),
+                             ('timestamp', '<i8'),
+                             ('software_timestamp', '<i8'),
+                             ('source', '<u2'),
+                             ('n_channels', '<u2'),
+                             ('n_samples', '<u2')])
+SPIKES_WAVEFORM_OFFSET = 32768  # waveforms stored as uint16 with offset
+SPIKES_GAIN_SCALE = 1000  # gains in units of 1000/uV
+SPIKES_CHUNK_SIZE = 100000  # spikes converted per chunk when writing waveform files
+
+
+def spikes_dt(n_channels, n_samples):
+    """Data type of records of a .spikes file with waveforms of n_channels x n_samples."""
+    return np.dtype(SPIKES_PREFIX_DT.descr + [('sorted_id', '<u2'),
+                                              ('electrode_id', '<u2'),
+                                              ('channel', '<u2'),
+                                              ('color', np.uint8, 3),
+                                              ('pc_proj', '<f4', 2),
+                                              ('sampling_rate', '<u2'),
+                                              ('waveforms', '<u2', (n_channels, n_samples)),
+                                              ('gain', '<f4', n_channels),
+                                              ('threshold', '<u2', n_channels),
+                                              ('rec_num', '<u2')])
+
+
+# Sidecar index of file listings and per-file metadata, keyed by file name and validated by size/mtime
+INDEX_FNAME = '.dataman_index.json'
+INDEX_VERSION = 2
+
+# Upper bound of simultaneously mapped .continuous files of a FilePool
+MAX_OPEN_FILES = 512
+
+# Headers are read by a thread pool, the work is dominated by file system latency, not CPU
+HEADER_WORKERS = 16
+
 logger = logging.getLogger(__name__)
 
 # (2048 + 22) Byte = 2070 Byte total
@@ -44,9 +97,8 @@ DATA_DT = np.dtype([('timestamp', np.int64),  # 8 Byte
 
 
 class ContinuousFile:
-    """Single .continuous file. Generates chunks of data."""
-
-    # TODO: Allow record counts and offsets
+    """Single .continuous file. Memory-maps the records of the file as structured DATA_DT array, allowing
+    both sequential reading of records and random access to arbitrary sample windows."""
 
     def __init__(self, path):
         self.path = os.path.abspath(os.path.expanduser(path))
@@ -54,30 +106,360 @@ class ContinuousFile:
         # Make sure we have full records all the way through
         assert (self.file_size - SIZE_HEADER) % SIZE_RECORD == 0
         self.num_records = (self.file_size - SIZE_HEADER) // SIZE_RECORD
+        self.num_samples = self.num_records * NUM_SAMPLES
         self.duration = self.num_records
 
-    def __enter__(self):
-        self.header = self._read_header()
+        self.header = None
         self.record_dtype = DATA_DT  # data_dt(self.header['blockLength'])
-        self.__fid = open(self.path, 'rb')
-        self.__fid.seek(SIZE_HEADER)
+        self.records = None
+        self._position = 0
+
+    def __enter__(self):
+        return self.open()
+
+    def open(self):
+        """Read header and map the records of the file. The mapping holds a file descriptor until closed.
+        Header and read position are kept when a closed file is opened again."""
+        if self.header is None:
+            self.header = self._read_header()
+        if self.records is None:
+            self.records = np.memmap(self.path, dtype=self.record_dtype, mode='r', offset=SIZE_HEADER,
+                                     shape=(self.num_records,))
         return self
 
+    def close(self):
+        self.records = None
+
     def _read_header(self):
         return format_header(np.fromfile(self.path, dtype=HEADER_DT, count=1))
 
+    @property
+    def samples(self):
+        """Zero-copy (n_records, NUM_SAMPLES) view of the big-endian sample payload of all records."""
+        return self.records['samples']
+
+    def read(self, start_sample=0, n_samples=None, out=None):
+        """Return samples [start_sample, start_sample + n_samples) as native int16 array.
+
+        Only the records spanning the requested window are touched. The record payloads are copied exactly once
+        when converting to native byte order, the window is a view into that copy.
+
+        Args:
+            start_sample: First sample to read
+            n_samples: Number of samples to read. Default: all remaining samples. Clipped to end of file.
+            out: Optional contiguous 1D int16 array the samples are written to. Record aligned windows are
+                 converted straight into it.
+
+        Returns:
+            1D int16 array of samples, a view into out if given.
+        """
+        start_sample = max(0, int(start_sample))
+        end_sample = self.num_samples if n_samples is None else min(self.num_samples, start_sample + int(n_samples))
+        if end_sample <= start_sample:
+            return np.empty(0, dtype=DEFAULT_DTYPE) if out is None else out[:0]
+
+        first_record, skip = divmod(start_sample, NUM_SAMPLES)
+        last_record = -(-end_sample // NUM_SAMPLES)
+        n_samples = end_sample - start_sample
+        if out is not None and not skip and not n_samples % NUM_SAMPLES:
+            out[:n_samples].reshape(-1, NUM_SAMPLES)[:] = self.samples[first_record:last_record]
+            return out[:n_samples]
+
+        window = self.samples[first_record:last_record].astype(DEFAULT_DTYPE).reshape(-1)
+        window = window[skip:skip + n_samples]
+        if out is not None:
+            out[:n_samples] = window
+            return out[:n_samples]
+        return window
+
+    def read_blocks(self, records, positions, n_blocks):
+        """Scatter records into a zero-filled window of n_blocks blocks. Used to fill gaps in the record stream.
+
+        Args:
+            records: Indices of records to read
+            positions: Block positions of the records in the output window
+            n_blocks: Size of output window in blocks of NUM_SAMPLES
+
+        Returns:
+            1D int16 array of n_blocks * NUM_SAMPLES samples.
+        """
+        window = np.zeros((n_blocks, NUM_SAMPLES), dtype=DEFAULT_DTYPE)
+        window[positions] = self.samples[records]
+        return window.reshape(-1)
+
     def read_record(self, count=1):
-        buf = np.fromfile(self.__fid, dtype=self.record_dtype, count=count)
+        """Sequentially read the payload of the next count records as flat big-endian view."""
+        buf = self.records[self._position:self._position + count]
+        self._position += buf.shape[0]
 
         # make sure offsets are likely correct
         assert np.array_equal(buf[0]['rec_mark'], REC_MARKER)
         return buf['samples'].reshape(-1)
 
+    def seek(self, record):
+        """Set position of the next sequential read_record call."""
+        self._position = min(max(0, int(record)), self.num_records)
+
     def next(self):
-        return self.read_record() if self.__fid.tell() < self.file_size else None
+        return self.read_record() if self._position < self.num_records else None
 
     def __exit__(self, *args):
-        self.__fid.close()
+        self.close()
+
+
+class FilePool:
+    """Bounded pool of mapped ContinuousFiles. Every mapping holds a file descriptor, so recordings with hundreds
+    of channels (plus references and other channel types) can run into the open file limit. The pool keeps at
+    most max_open files mapped, unmapping the least recently used one when another file is needed. Files
+    remember their header and read position, remapping an evicted file is cheap.
+
+    Files are only valid until the next call to get, keep paths rather than file objects around.
+    """
+
+    def __init__(self, max_open=None):
+        """
+        Args:
+            max_open: Maximum number of simultaneously mapped files. Default: half the open file limit of the
+                      process, capped at MAX_OPEN_FILES.
+        """
+        self.max_open = default_max_open() if max_open is None else max(1, int(max_open))
+        self._files = {}
+        self._mapped = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._mapped)
+
+    def get(self, path):
+        """Mapped ContinuousFile for path, evicting the least recently used mapping if the pool is full."""
+        if path in self._mapped:
+            self._mapped.move_to_end(path)
+            return self._files[path]
+
+        while len(self._mapped) >= self.max_open:
+            evicted, _ = self._mapped.popitem(last=False)
+            self._files[evicted].close()
+
+        if path not in self._files:
+            self._files[path] = ContinuousFile(path)
+        self._mapped[path] = True
+        return self._files[path].open()
+
+    def read(self, requests, out=None):
+        """Read a list of (path, start_sample, n_samples) requests of equal length. Reads are scheduled by file
+        and offset (see schedule_reads), the result rows follow the order of the requests.
+
+        Args:
+            requests: List of (path, start_sample, n_samples) tuples
+            out: Optional (len(requests), n_samples) int16 array to read into
+
+        Returns:
+            (len(requests), n_samples) int16 array, samples past the end of a file are zero.
+        """
+        n_samples = max([int(r[2]) for r in requests]) if len(requests) else 0
+        if out is None:
+            out = np.zeros((len(requests), n_samples), dtype=DEFAULT_DTYPE)
+        for row in schedule_reads(requests, self._mapped):
+            path, start_sample, n_request = requests[row]
+            n_read = len(self.get(path).read(start_sample, n_request, out=out[row]))
+            out[row, n_read:] = 0
+        return out
+
+    def read_blocks(self, paths, records, positions, n_blocks):
+        """Scatter the same records of several files into zero-filled (len(paths), n_blocks * NUM_SAMPLES)
+        array, see ContinuousFile.read_blocks."""
+        out = np.zeros((len(paths), n_blocks, NUM_SAMPLES), dtype=DEFAULT_DTYPE)
+        for row in schedule_reads([(path, 0, 0) for path in paths], self._mapped):
+            out[row, positions] = self.get(paths[row]).samples[records]
+        return out.reshape(len(paths), -1)
+
+    def close(self):
+        for path in self._mapped:
+            self._files[path].close()
+        self._mapped.clear()
+
+
+def default_max_open():
+    """Number of files a FilePool maps at once by default, half of the soft open file limit."""
+    try:
+        import resource
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError, OSError):
+        return MAX_OPEN_FILES
+    if soft_limit == resource.RLIM_INFINITY:
+        return MAX_OPEN_FILES
+    return max(1, min(MAX_OPEN_FILES, soft_limit // 2))
+
+
+def schedule_reads(requests, mapped=()):
+    """Order in which to serve a list of (path, start_sample, n_samples) read requests: grouped by file, in
+    ascending offset within a file. Each file is mapped once per batch of requests, and its records are
+    touched front to back. Files already mapped are served first, so a batch of more files than a FilePool
+    holds only evicts files it is done with.
+
+    Args:
+        requests: List of (path, start_sample, n_samples) tuples
+        mapped: Paths of currently mapped files
+
+    Returns:
+        List of request indices.
+    """
+    return sorted(range(len(requests)), key=lambda i: (requests[i][0] not in mapped, requests[i][0], requests[i][1]))
+
+
+class SpikesFile:
+    """Single .spikes file of online detected spikes. Memory-maps the spike records, timestamps and waveforms
+    are exposed as zero-copy views."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.file_size = os.path.getsize(self.path)
+
+        if self.file_size > SIZE_HEADER:
+            prefix = np.fromfile(self.path, dtype=SPIKES_PREFIX_DT, count=1, offset=SIZE_HEADER)[0]
+            self.n_channels, self.n_samples = int(prefix['n_channels']), int(prefix['n_samples'])
+        else:
+            self.n_channels, self.n_samples = 0, 0
+        self.record_dtype = spikes_dt(self.n_channels, self.n_samples)
+
+        # Make sure we have full records all the way through
+        assert (self.file_size - SIZE_HEADER) % self.record_dtype.itemsize == 0
+        self.num_spikes = (self.file_size - SIZE_HEADER) // self.record_dtype.itemsize
+        self.records = None
+
+    def __enter__(self):
+        return self.open()
+
+    def open(self):
+        if self.records is None:
+            self.records = np.memmap(self.path, dtype=self.record_dtype, mode='r', offset=SIZE_HEADER,
+                                     shape=(self.num_spikes,)) if self.num_spikes \
+                else np.empty(0, dtype=self.record_dtype)
+        return self
+
+    def close(self):
+        self.records = None
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def timestamps(self):
+        """Zero-copy view of the spike timestamps."""
+        return self.records['timestamp']
+
+    @property
+    def waveforms(self):
+        """Zero-copy (n_spikes, n_channels, n_samples) view of the raw uint16 waveforms."""
+        return self.records['waveforms']
+
+    def waveforms_uv(self, start=0, end=None):
+        """Waveforms of spikes [start, end) in microvolts as (n_spikes, n_channels, n_samples) float32 array."""
+        records = self.records[start:end]
+        gain = records['gain'][:, :, np.newaxis] / SPIKES_GAIN_SCALE
+        return ((records['waveforms'].astype(np.float32) - SPIKES_WAVEFORM_OFFSET) / gain).astype(np.float32)
+
+    def to_mat(self, outpath, t0=0, s_start=0, n_samples=32, bit_volts=0.195, s_pre=10):
+        """Write spikes into a waveform .mat file in the layout of detect.extract_waveforms, e.g. to compute
+        features without running spike detection on the wide-band signal.
+
+        Args:
+            outpath: Path of .mat file to create
+            t0: Timestamp of the first sample of the converted data, e.g. first record timestamp of the recording
+            s_start: First sample of the stored waveforms to use
+            n_samples: Number of waveform samples to keep, dm fet expects 32
+            bit_volts: Conversion factor to the int16 amplitude units of the .continuous data
+            s_pre: Number of samples before the peak, as used in the index of detect.extract_waveforms
+        """
+        import h5py
+        from dataman.detect.detect import create_waveform_file
+
+        if s_start + n_samples > self.n_samples:
+            raise ValueError('Requested samples {}:{} exceed {} stored samples'.format(
+                s_start, s_start + n_samples, self.n_samples))
+
+        timestamps = self.timestamps - t0 + s_start + s_pre
+        create_waveform_file(outpath, timestamps, n_samples, self.n_channels, s_pre=s_pre)
+
+        with h5py.File(str(outpath), 'a') as hf:
+            for start in range(0, self.num_spikes, SPIKES_CHUNK_SIZE):
+                waveforms = self.waveforms_uv(start, start + SPIKES_CHUNK_SIZE)[:, :, s_start:s_start + n_samples]
+                waveforms = np.round(waveforms / bit_volts).astype(np.int16).transpose(0, 2, 1)
+                hf['spikes'][:, start:start + waveforms.shape[0]] = waveforms.reshape(waveforms.shape[0], -1).T
+
+
+class ContinuousDataset:
+    """Virtual concatenation of all subsets of one or more recordings along a single, global sample axis.
+    Subsets are stitched in order of the SUBSETS entries of the metadata, an offset table maps global samples
+    to the files of a subset without writing a concatenated copy of the data.
+    """
+
+    def __init__(self, metadata, channels=None):
+        """
+        Args:
+            metadata: Metadata dictionary from metadata_from_target or merge_metadata
+            channels: Default channel order of reads. Default: all channels of the metadata
+        """
+        self.metadata = metadata
+        self.channels = list(metadata['CHANNELS']) if channels is None else list(channels)
+        self.subsets = list(metadata['SUBSETS'].values())
+
+        sampling_rates = set([subset['JOINT_HEADERS']['sampling_rate'] for subset in self.subsets])
+        if len(sampling_rates) != 1:
+            raise ValueError('Subsets with different sampling rates can not be joined: {}'.format(sampling_rates))
+        self.sampling_rate = sampling_rates.pop()
+
+        lengths = [int(subset['JOINT_HEADERS']['n_samples']) for subset in self.subsets]
+        self.offsets = np.cumsum([0] + lengths)
+        self.n_samples = int(self.offsets[-1])
+        self.pool = FilePool()
+
+    def offset_table(self):
+        """List of (target, sub_id, global start sample, n_samples) of all subsets in order."""
+        return [(subset.get('TARGET', self.metadata.get('TARGET')), subset.get('SUB_ID', sub_id),
+                 int(self.offsets[n]), int(self.offsets[n + 1] - self.offsets[n]))
+                for n, (sub_id, subset) in enumerate(self.metadata['SUBSETS'].items())]
+
+    def locate(self, sample):
+        """Map a global sample to the index of its subset and the sample within that subset."""
+        if not 0 <= sample < self.n_samples:
+            raise IndexError('Sample {} outside of dataset with {} samples'.format(sample, self.n_samples))
+        subset = int(np.searchsorted(self.offsets, sample, side='right')) - 1
+        return subset, int(sample - self.offsets[subset])
+
+    def read(self, start, n_samples, channels=None):
+        """Read n_samples from global sample start on, across subset boundaries.
+
+        Args:
+            start: Global first sample
+            n_samples: Number of samples, clipped to the end of the dataset
+            channels: Channel order of the result. Default: dataset channel order
+
+        Returns:
+            (n_channels, n_samples) int16 array
+        """
+        channels = self.channels if channels is None else channels
+        start = max(0, int(start))
+        end = min(self.n_samples, start + int(n_samples))
+        data = np.empty((len(channels), max(0, end - start)), dtype=DEFAULT_DTYPE)
+
+        position = start
+        while position < end:
+            subset, local_start = self.locate(position)
+            n_read = min(end, int(self.offsets[subset + 1])) - position
+            files = self.subsets[subset]['FILES']
+            requests = [(files[channel]['FILEPATH'], local_start, n_read) for channel in channels]
+            self.pool.read(requests, out=data[:, position - start:position - start + n_read])
+            position += n_read
+        return data
+
+    def close(self):
+        self.pool.close()
 
 
 class DataStreamer(Streamer.Streamer):
@@ -86,70 +468,60 @@ class DataStreamer(Streamer.Streamer):
         self.target_path = target_path
         logger.debug('Open Ephys Streamer Initialized at {}!'.format(target_path))
         self.metadata = metadata
-        logger.warning('Only traversing first subset of files!')
-        first_subset = next(iter(self.metadata['SUBSETS'].values()))
-        self.files = first_subset['FILES']
+
+        # Files are mapped lazily in the streaming process, kept across repositioning
+        self.dataset = None
 
     def reposition(self, offset):
         """Reposition current buffer representing data files. Also reorders channels according to
         channel order map.
         """
         logger.debug('Rolling to position {}'.format(offset))
-        n_samples = self.buffer.buffer.shape[1]
+        if self.dataset is None:
+            self.dataset = ContinuousDataset(self.metadata, channels=self.channel_order)
 
-        for ch, ch_dict in self.files.items():
-            if self.channel_order is None:
-                ch_pos = ch
-            else:
-                ch_pos = self.channel_order.index(ch)
+        n_samples = self.buffer.buffer.shape[1]
+        self.put_samples(self.dataset.read(offset * NUM_SAMPLES, n_samples), scale=AMPLITUDE_SCALE)
 
-            data = read_record(ch_dict['FILEPATH'], offset=offset)[:n_samples]
-            self.buffer.put_data(data, channel=ch_pos)
 
+def _template_regex(template, **fields):
+    """Compile a regular expression matching file names generated from a file name template. The channel number
+    and the optional sub_id suffix are captured as named groups, all other fields must match the given values.
 
-def _ids_from_fname(fn, channel_type='CH'):
-    """Extract channel number and sub_id from a .continuous file of expected form
-    {NODE_ID}_CH{CHANNEL}[_{SUB_ID}].continuous. The underscore is used as indicator of the file name format.
     Args:
-        fn: Filename
+        template: File name template, e.g. NAME_TEMPLATE
+        **fields: Values of the fixed template fields (e.g. proc_node, channel_type)
 
     Returns:
-        Channel number, sub_id
+        Compiled regular expression with groups 'channel' and 'sub_id'.
     """
-    id_str = fn[fn.index(channel_type) + 2:fn.index('.continuous')]
-    if '_' in id_str:
-        # has sub_id
-        sub_id = id_str[id_str.index('_') + 1:]
-        channel = id_str[:id_str.index('_')]
-    else:
-        # no sub_id
-        sub_id = -1
-        channel = id_str
-
-    try:
-        sub_id = int(sub_id)
-        channel = int(channel)
-    except ValueError:
-        raise ValueError("Couldn't parse file name {}, not matching expected pattern.".format(fn))
-
-    return sub_id, channel
+    pattern = ''
+    for literal, field, _, _ in string.Formatter().parse(template):
+        pattern += re.escape(literal)
+        if field is None:
+            continue
+        elif field == 'channel':
+            pattern += r'(?P<channel>\d+)'
+        elif field == 'sub_id':
+            pattern += r'(?:_(?P<sub_id>\d+))?'
+        else:
+            pattern += re.escape(str(fields[field]))
+    return re.compile(pattern)
 
 
 def gather_files(target_directory, proc_node, channels='*', channel_type='CH',
-                 sub_id=-1, scan_sub_ids=True, template=NAME_TEMPLATE):
+                 sub_id=-1, scan_sub_ids=True, template=NAME_TEMPLATE, index=None):
     """Return dictionary of list of paths to valid input files for the input directory, keyed by subset ids.
     Sub_id is the numerical suffix after channel number in file name, indicating additional recordings
     subsets in the same data folder. Also checks that all sub_ids have the same number of files.
     Because that would cause headaches otherwise...
 
     The annoyance with gathering files here is that we don't know the number of channels or the number of sub_ids.
-    There is no/I don't know a wildcard pattern to catch all channel numbers AND separate the sub_ids, as channel
-    numbers aren't padded. Looks like we'll need to do this "manually". Furthermore, the sub_id may start at _0
-    without non-sufficed companions.
+    Channel numbers aren't padded, and the sub_id may start at _0 without non-suffixed companions.
 
-    What we do is to gather up all channel_type matching .continuous files, find the set of sub_ids and channel
-    numbers, then loop over the combination of both and rebuilding those file names. This is kind of backwards,
-    but doesn't require too much prior knowledge of the search space.
+    What we do is to list the directory once and match every name against a regular expression compiled from
+    the template, capturing channel number and sub_id. The result is built directly from the matches, no
+    candidate file names are rebuilt or stat'ed.
 
     E.g. file names: [100_CH34.continuous, 100_CH34_0.continuous], 100_CH1.continuous, 106_CH1024_59.continuous
 
@@ -157,55 +529,279 @@ def gather_files(target_directory, proc_node, channels='*', channel_type='CH',
         target_directory: path to directory to be scanned
         proc_node: Processing node origin of files, typically 100
         channels: Channel number or glob pattern for multiple channels, default all: *
-        channel_type: Type of channel to look for (CH, ADC, AUX). Only one can be used right now.
+        channel_type: Type of channel to look for (CH, ADC, AUX), or list of types gathered from the same
+                      directory listing.
 
         sub_id: Starting sub_id. If sub_id is None, no suffix will be appended. Else, numerical.
         scan_sub_ids: Only scan for a single sub_id, or scan through range incrementally until no files found.
-        template: Glob pattern template for proc_node, channels, sub_id to match .continuous file names.
+        template: File name template for proc_node, channels, sub_id to match .continuous file names.
+        index: Optional metadata index (see load_index). The cached directory listing is used if the directory
+               was not modified since, and refreshed otherwise.
 
-    Returns: dict {sub_id: {channel: {proc_node: proc_node, channel_type: channel_type, filename:filename}}
+    Returns: dict {sub_id: {channel: {proc_node: proc_node, channel_type: channel_type, filename:filename}},
+             for a list of channel types a dict of those keyed by channel type.
 
     TODO: Channel selection list
-    TODO: Multiple channel types
     """
     logger.debug('Gathering .continuous files with template {}'.format(template))
     logger.debug('Channel type: {}, starting sub_id: {}, channel range: {}, scanning subsets: {}'.format(
         channel_type, sub_id, channels, scan_sub_ids))
 
     target_path = Path(target_directory).resolve()
-    files = {}
-
-    # This glob catches ALL channels/sub_ids present in the target directories for the proc_node!
-    glob = template.format(proc_node=proc_node, channel_type=channel_type, channel='*', sub_id='')
-    globbed = [g.name for g in target_path.glob(glob)]
-
-    globbed_sub_ids, globbed_channels = map(tuple, map(set, zip(*[_ids_from_fname(f, channel_type) for f in globbed])))
-    logger.debug('Found sub ids: {}, channels: {}'.format(globbed_sub_ids, globbed_channels))
+    channel_types = [channel_type] if isinstance(channel_type, str) else list(channel_type)
+    name_regexes = {ctype: _template_regex(template, proc_node=proc_node, channel_type=ctype)
+                    for ctype in channel_types}
+
+    # Single pass over the directory listing, sorting matching names by channel type, sub_id and channel
+    found = {ctype: {} for ctype in channel_types}
+    for filename in list_directory(target_path, index):
+        for ctype, name_regex in name_regexes.items():
+            match = name_regex.fullmatch(filename)
+            if match is None:
+                continue
+            sid = -1 if match.group('sub_id') is None else int(match.group('sub_id'))
+            channel = int(match.group('channel')) - 1
+            found[ctype].setdefault(sid, {})[channel] = filename
+            break
+
+    files = {ctype: _subsets_from_matches(found[ctype], target_path, proc_node, ctype, name_regexes[ctype],
+                                          sub_id, scan_sub_ids)
+             for ctype in channel_types}
+    return files[channel_type] if isinstance(channel_type, str) else files
+
+
+def _subsets_from_matches(found, target_path, proc_node, channel_type, name_regex, sub_id, scan_sub_ids):
+    """Check consistency of the file names of one channel type matched by gather_files, and build their
+    subset dictionary."""
+    if not len(found):
+        raise FileNotFoundError('No {} files matching {} at {}'.format(FMT_FEXT, name_regex.pattern, target_path))
+    logger.debug('Found {} sub ids: {}, channels: {}'.format(
+        channel_type, sorted(found), sorted(set([ch for sub_files in found.values() for ch in sub_files]))))
 
-    globbed_channels = [g - 1 for g in globbed_channels]
     # override sub_id search space to singular instance if we aren't scanning them all
     if not scan_sub_ids:
-        if sub_id not in globbed_sub_ids:
+        if sub_id not in found:
             raise ValueError('Requested sub_id {} not found in files at target.'.format(sub_id))
-        globbed_sub_ids = [sub_id]
-
-    # Build the return dictionary by building file names from the template and check their existence
-    for sid in sorted(globbed_sub_ids):
-        sub_files = {}
-        for channel in sorted(globbed_channels):
-            filename = template.format(proc_node=proc_node, channel=channel + 1, channel_type=channel_type,
-                                       sub_id='' if sid is -1 else '_{}'.format(sid))
-            file_path = target_path / filename
-            # Check file existence
-            if not file_path.exists():
-                raise FileNotFoundError('Sub_ids and channels not matching up at {}'.format(file_path))
-
-            sub_files[channel] = {'PROC_NODE': proc_node, 'CHANNEL_TYPE': channel_type, 'CHANNEL': channel,
-                                  'FILEPATH': str(file_path), 'FILENAME': filename}
-        files[sid] = {'FILES': sub_files}
+        found = {sub_id: found[sub_id]}
+
+    # All subsets have to consist of the same channels
+    channel_sets = set([tuple(sorted(sub_files)) for sub_files in found.values()])
+    if len(channel_sets) > 1:
+        raise FileNotFoundError('Sub_ids and channels not matching up at {}: {}'.format(
+            target_path, {sid: sorted(sub_files) for sid, sub_files in found.items()}))
+
+    files = {}
+    for sid in sorted(found):
+        files[sid] = {'FILES': {channel: {'PROC_NODE': proc_node, 'CHANNEL_TYPE': channel_type, 'CHANNEL': channel,
+                                          'FILEPATH': str(target_path / found[sid][channel]),
+                                          'FILENAME': found[sid][channel]}
+                                for channel in sorted(found[sid])}}
     return files
 
 
+def load_index(target_dir):
+    """Load the metadata index sidecar file of a recording directory.
+
+    Args:
+        target_dir: Path to the recording directory
+
+    Returns:
+        Index dictionary. Empty index if there is no index file, or it is unreadable or outdated.
+    """
+    index_path = Path(target_dir) / INDEX_FNAME
+    try:
+        with open(str(index_path), 'r') as index_file:
+            index = json.load(index_file)
+        if index.get('VERSION') == INDEX_VERSION:
+            logger.debug('Loaded metadata index {} with {} entries'.format(index_path, len(index['FILES'])))
+            return index
+        logger.debug('Ignoring outdated metadata index {}'.format(index_path))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning('Ignoring unreadable metadata index {}: {}'.format(index_path, e))
+
+    return {'VERSION': INDEX_VERSION, 'LISTING': None, 'FILES': {}}
+
+
+def save_index(target_dir, index):
+    """Write the metadata index sidecar file if it was modified. The file is replaced atomically, failures
+    (e.g. read-only data directories) are logged and otherwise ignored.
+
+    Args:
+        target_dir: Path to the recording directory
+        index: Index dictionary as returned by load_index
+    """
+    if not index.pop('MODIFIED', False):
+        return
+
+    index_path = Path(target_dir) / INDEX_FNAME
+    # Unique temporary name, the same target may be indexed by concurrent workers
+    tmp_path = index_path.with_name('{}.{}-{}.tmp'.format(INDEX_FNAME, os.getpid(), threading.get_ident()))
+    try:
+        listing = index.get('LISTING')
+        current = listing is not None and listing['mtime'] == os.stat(str(target_dir)).st_mtime_ns
+        with open(str(tmp_path), 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(str(tmp_path), str(index_path))
+
+        # Replacing the index changes the directory, not its listing. Rewriting the contents of the index in place
+        # leaves the directory alone, the listing then stays valid for the next open.
+        if current:
+            listing['mtime'] = os.stat(str(target_dir)).st_mtime_ns
+            with open(str(index_path), 'w') as index_file:
+                json.dump(index, index_file)
+        logger.debug('Updated metadata index {}'.format(index_path))
+    except OSError as e:
+        logger.warning('Could not write metadata index {}: {}'.format(index_path, e))
+
+
+def list_directory(target_dir, index=None):
+    """List of file names in a directory from a single scan. With an index, the cached listing is reused as long as
+    the modification time of the directory itself is unchanged, i.e. no files were added, removed or renamed.
+
+    Args:
+        target_dir: Path to directory
+        index: Optional metadata index
+
+    Returns:
+        List of file names
+    """
+    if index is not None:
+        dir_mtime = os.stat(str(target_dir)).st_mtime_ns
+        cached = index.get('LISTING')
+        if cached is not None and cached['mtime'] == dir_mtime:
+            return cached['names']
+
+    # Entry types come with the directory listing on most platforms, is_file() does not need to stat
+    with os.scandir(str(target_dir)) as entries:
+        names = [entry.name for entry in entries if entry.is_file()]
+    if index is None:
+        return names
+
+    index['LISTING'] = {'mtime': dir_mtime, 'names': names}
+    index['MODIFIED'] = True
+    return names
+
+
+def verify_records(path, chunk_records=None):
+    """Validate every record of a .continuous file in a single vectorized pass over the memory-mapped file.
+    Checks that the record marker is intact, that each record holds a full block of samples and that the
+    record timestamps are strictly increasing.
+
+    Args:
+        path: Path to .continuous file
+        chunk_records: Number of records validated at once. Default: all records
+
+    Returns:
+        Dictionary with the number of records, number of trailing bytes not forming a complete record and
+        arrays of indices of records with corrupt markers, sample counts or non-increasing timestamps.
+    """
+    n_record_bytes = os.path.getsize(path) - SIZE_HEADER
+    n_records, trailing_bytes = divmod(max(0, n_record_bytes), SIZE_RECORD)
+    result = {'FILEPATH': str(path), 'n_records': n_records, 'trailing_bytes': trailing_bytes}
+
+    if not n_records:
+        empty = np.empty(0, dtype=np.int64)
+        result.update(bad_rec_mark=empty, bad_n_samples=empty, bad_timestamps=empty)
+        return result
+
+    records = np.memmap(path, dtype=DATA_DT, mode='r', offset=SIZE_HEADER, shape=(n_records,))
+    chunk_records = n_records if chunk_records is None else max(1, int(chunk_records))
+    bad = {'bad_rec_mark': [], 'bad_n_samples': [], 'bad_timestamps': []}
+    for start in range(0, n_records, chunk_records):
+        # chunks overlap by one record to compare timestamps across chunk boundaries
+        first = max(0, start - 1)
+        chunk = records[first:start + chunk_records]
+        bad['bad_rec_mark'].append(np.flatnonzero(~np.all(chunk['rec_mark'][start - first:] == REC_MARKER,
+                                                         axis=1)) + start)
+        bad['bad_n_samples'].append(np.flatnonzero(chunk['n_samples'][start - first:] != NUM_SAMPLES) + start)
+        bad['bad_timestamps'].append(np.flatnonzero(np.diff(chunk['timestamp']) <= 0) + first + 1)
+    del records
+    result.update({key: np.concatenate(indices) for key, indices in bad.items()})
+
+    return result
+
+
+def timeline_from_timestamps(timestamps):
+    """Build a timeline of records from their timestamps. Each record is placed at the block given by its timestamp
+    relative to the first record. Missing blocks between records are gaps, records not advancing past the blocks
+    already covered (duplicated or out of order records) are dropped.
+
+    Args:
+        timestamps: Array of record timestamps
+
+    Returns:
+        Dictionary with first timestamp, number of records, number of blocks spanned, list of [record, n_missing]
+        gaps preceding a record and list of dropped records.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    n_records = timestamps.shape[0]
+    if not n_records:
+        return {'first_timestamp': None, 'n_records': 0, 'n_blocks': 0, 'gaps': [], 'dropped': []}
+
+    blocks = (timestamps - timestamps[0]) // NUM_SAMPLES
+    covered = np.maximum.accumulate(blocks)
+    kept = np.ones(n_records, dtype=bool)
+    kept[1:] = blocks[1:] > covered[:-1]
+
+    kept_records = np.flatnonzero(kept)
+    missing = np.diff(blocks[kept_records]) - 1
+    gap_idx = np.flatnonzero(missing)
+
+    return {'first_timestamp': int(timestamps[0]),
+            'n_records': int(n_records),
+            'n_blocks': int(covered[-1]) + 1,
+            'gaps': [[int(kept_records[g + 1]), int(missing[g])] for g in gap_idx],
+            'dropped': np.flatnonzero(~kept).tolist()}
+
+
+def record_positions(timeline):
+    """Expand a timeline into the indices of records to read and their block positions in the gapless output.
+
+    Args:
+        timeline: Timeline dictionary (see timeline_from_timestamps)
+
+    Returns:
+        Tuple of (record indices, block positions), both sorted.
+    """
+    kept = np.ones(timeline['n_records'], dtype=bool)
+    kept[timeline['dropped']] = False
+    records = np.flatnonzero(kept)
+
+    shift = np.zeros(records.shape[0], dtype=np.int64)
+    for record, n_missing in timeline['gaps']:
+        shift[np.searchsorted(records, record)] += n_missing
+    positions = np.arange(records.shape[0]) + np.cumsum(shift)
+    return records, positions
+
+
+def timeline_from_file(path, index=None):
+    """Timeline of the records of a .continuous file from its memory-mapped record timestamps.
+
+    Args:
+        path: Path to .continuous file
+        index: Optional metadata index. Timelines are cached in the index, validated by file size and mtime.
+
+    Returns:
+        Timeline dictionary (see timeline_from_timestamps)
+    """
+    stat = os.stat(path)
+    fname = os.path.basename(path)
+    if index is not None:
+        entry = index.setdefault('TIMELINES', {}).get(fname)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['timeline']
+
+    with ContinuousFile(path) as cf:
+        timeline = timeline_from_timestamps(cf.records['timestamp'])
+
+    if index is not None:
+        index['TIMELINES'][fname] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'timeline': timeline}
+        index['MODIFIED'] = True
+    return timeline
+
+
 def check_continuous_headers(files):
     """Check that length, sampling rate, buffer and block sizes of a list of open-ephys ContinuousFiles are
     identical and return them in that order."""
@@ -265,7 +861,9 @@ def format_header(header_str):
     for key in ['bitVolts', 'sampleRate']:
         header_dict[key] = float(header_dict[key])
     for key in ['blockLength', 'bufferSize', 'header_bytes', 'channel']:
-        header_dict[key] = int(header_dict[key] if not key == 'channel' else header_dict[key][2:])
+        # channel names carry their type as prefix, e.g. CH12, AUX3, ADC1
+        value = header_dict[key] if not key == 'channel' else header_dict[key].lstrip(string.ascii_letters)
+        header_dict[key] = int(value)
     return header_dict
 
 
@@ -277,11 +875,79 @@ def read_segment(filename, offset, count, dtype):
     return segment
 
 
-def read_record(filename, offset=0, count=30, dtype=DATA_DT):
-    # FIXME: Stupid undocumented magic division of return value...
-    return read_segment(filename, offset=SIZE_HEADER + offset * SIZE_RECORD, count=count, dtype=dtype)['samples'] \
-               .ravel() \
-               .astype(np.float32) * AMPLITUDE_SCALE
+def read_record(filename, offset=0, count=30, dtype=DATA_DT, scale=True):
+    """Read count records from record offset on as flat array of samples. With scale, samples are
+    float32 multiplied by AMPLITUDE_SCALE, otherwise the native int16 values."""
+    samples = read_segment(filename, offset=SIZE_HEADER + offset * SIZE_RECORD, count=count, dtype=dtype)['samples']
+    samples = samples.ravel().astype(DEFAULT_DTYPE)
+    return samples.astype(np.float32) * AMPLITUDE_SCALE if scale else samples
+
+
+def read_events(filename):
+    """Read all records of an .events file into a structured EVENTS_DT array with a single read.
+
+    Args:
+        filename: Path to .events file
+
+    Returns:
+        Structured array of events. Timestamps share the sample clock of the .continuous record timestamps.
+    """
+    n_record_bytes = os.path.getsize(filename) - SIZE_HEADER
+    n_events, trailing_bytes = divmod(max(0, n_record_bytes), EVENTS_DT.itemsize)
+    if trailing_bytes:
+        logger.warning('Ignoring {} trailing bytes of incomplete event in {}'.format(trailing_bytes, filename))
+    return np.fromfile(filename, dtype=EVENTS_DT, count=n_events, offset=SIZE_HEADER)
+
+
+def ttl_index(events):
+    """Index of TTL edges per channel.
+
+    Args:
+        events: Structured EVENTS_DT array as returned by read_events
+
+    Returns:
+        Dictionary {channel: {'on': rising edge timestamps, 'off': falling edge timestamps}}, sorted arrays.
+    """
+    ttl = events[events['event_type'] == EVENT_TYPE_TTL]
+    index = {}
+    for channel in np.unique(ttl['channel']):
+        channel_events = ttl[ttl['channel'] == channel]
+        rising = channel_events['event_id'] == 1
+        index[int(channel)] = {'on': np.sort(channel_events['timestamp'][rising]),
+                               'off': np.sort(channel_events['timestamp'][~rising])}
+    return index
+
+
+def last_ttl_edge(edges, timestamps):
+    """Timestamp of the last TTL edge at or before each of the given timestamps, e.g. to align spikes to the last
+    stimulus onset. Uses binary search, O(log n) per timestamp.
+
+    Args:
+        edges: Sorted edge timestamps of one channel, e.g. ttl_index(events)[channel]['on']
+        timestamps: Array of timestamps to look up
+
+    Returns:
+        Array of edge timestamps, -1 where no edge precedes the timestamp.
+    """
+    if not len(edges):
+        return np.full(np.shape(timestamps), -1, dtype=np.int64)
+    idx = np.searchsorted(edges, timestamps, side='right') - 1
+    return np.where(idx >= 0, edges[np.maximum(idx, 0)], -1)
+
+
+def ttl_state(channel_index, timestamps):
+    """State of a TTL line at each of the given timestamps, i.e. whether the last edge was a rising one.
+
+    Args:
+        channel_index: Edge dictionary of one channel of a ttl_index
+        timestamps: Array of timestamps to look up
+
+    Returns:
+        Boolean array, True where the TTL line is high.
+    """
+    last_on = last_ttl_edge(channel_index['on'], timestamps)
+    last_off = last_ttl_edge(channel_index['off'], timestamps)
+    return last_on > last_off
 
 
 def detect(base_path, pre_walk=None):
@@ -341,13 +1007,19 @@ def _fpga_node(chain_dict):
         raise BaseException('Node ID not found in xml dict {}'.format(chain_dict))
 
 
-def metadata_from_target(target_dir, channel_type='CH', *args, **kwargs):
+def metadata_from_target(target_dir, channel_type='CH', use_index=True, timeline=False, *args, **kwargs):
     """Get metadata from directory containing .continuous files. Directories may contain multiple "subsets"
     of recordings that may have been acquired at different points in time. Stupid.
 
+    File headers and the directory listing are cached in an index file in the target directory, only
+    changed files are re-read on subsequent calls.
+
     Args:
         target_dir: path to the data set
-        channel_type: AUX, CH or ADC. Default: 'CH'
+        channel_type: AUX, CH or ADC, or a list of those. With a list, SUBSETS and CHANNELS describe the
+                      first type, and TYPES holds SUBSETS and CHANNELS of every type. Default: 'CH'
+        use_index: Read and update the metadata index sidecar file. Default: True
+        timeline: Add record timeline of each subset, built from the timestamps of its first file. Default: False
 
     Returns:
         Dictionary with configuration entries. (DTYPE, INFO, SIGNALCHAIN, SUBSETS, AUDIO, FPGA_NODE)
@@ -362,50 +1034,108 @@ def metadata_from_target(target_dir, channel_type='CH', *args, **kwargs):
     logger.debug('Searching FPGA node in signal chain')
     metadata['FPGA_NODE'] = _fpga_node(metadata['SIGNALCHAIN'])
 
-    metadata['CHANNEL_TYPE'] = channel_type
+    channel_types = [channel_type] if isinstance(channel_type, str) else list(channel_type)
+    metadata['CHANNEL_TYPE'] = channel_types[0]
 
-    metadata['SUBSETS'] = gather_files(target_dir, metadata['FPGA_NODE'], channel_type=channel_type)
+    index = load_index(target_dir) if use_index else None
+    types_subsets = gather_files(target_dir, metadata['FPGA_NODE'], channel_type=channel_types, index=index)
 
-    for sub_id in metadata['SUBSETS']:
-        for channel, channel_metadata in metadata['SUBSETS'][sub_id]['FILES'].items():
-            channel_metadata.update(metadata_from_file(channel_metadata['FILEPATH']))
-        metadata['SUBSETS'][sub_id]['JOINT_HEADERS'] = reduce_files_metadata(metadata['SUBSETS'][sub_id]['FILES'])
+    files_metadata = [channel_metadata for subsets in types_subsets.values() for sub_id in subsets
+                      for channel_metadata in subsets[sub_id]['FILES'].values()]
+    with ThreadPoolExecutor(max_workers=max(1, min(HEADER_WORKERS, len(files_metadata)))) as pool:
+        headers = pool.map(lambda fmd: metadata_from_file(fmd['FILEPATH'], index=index), files_metadata)
+        for channel_metadata, header in zip(files_metadata, headers):
+            channel_metadata.update(header)
 
-    logger.log(level=LOG_LEVEL_VERBOSE, msg=pformat(metadata, indent=2))
+    metadata['TYPES'] = {}
+    for ctype, subsets in types_subsets.items():
+        for sub_id in subsets:
+            subsets[sub_id]['JOINT_HEADERS'] = reduce_files_metadata(subsets[sub_id]['FILES'])
+
+            if timeline:
+                first_file = next(iter(subsets[sub_id]['FILES'].values()))
+                subsets[sub_id]['TIMELINE'] = timeline_from_file(first_file['FILEPATH'], index=index)
 
-    # Channels should be the same for all subsets
-    channels = sorted(set([ch for sub_id in metadata['SUBSETS']
-                           for ch in metadata['SUBSETS'][sub_id]['JOINT_HEADERS']['CHANNEL']]))
-    metadata['CHANNELS'] = channels
+        # Channels should be the same for all subsets
+        channels = sorted(set([ch for sub_id in subsets for ch in subsets[sub_id]['JOINT_HEADERS']['CHANNEL']]))
+        metadata['TYPES'][ctype] = {'SUBSETS': subsets, 'CHANNELS': channels}
 
+    if index is not None:
+        save_index(target_dir, index)
+
+    metadata['SUBSETS'] = metadata['TYPES'][channel_types[0]]['SUBSETS']
+    metadata['CHANNELS'] = metadata['TYPES'][channel_types[0]]['CHANNELS']
+    if isinstance(channel_type, str):
+        del metadata['TYPES']
+
+    logger.log(level=LOG_LEVEL_VERBOSE, msg=pformat(metadata, indent=2))
     return metadata
 
 
-def metadata_from_file(file):
+def merge_metadata(targets_metadata):
+    """Merge metadata of several targets, e.g. from a session file, for use with ContinuousDataset. Subsets of
+    all targets are renumbered in order, each keeping its original TARGET and SUB_ID.
+
+    Args:
+        targets_metadata: List of metadata dictionaries from metadata_from_target
+
+    Returns:
+        Metadata dictionary of the first target with SUBSETS of all targets and list of TARGETS.
+    """
+    channels = [md['CHANNELS'] for md in targets_metadata]
+    if any([ch != channels[0] for ch in channels]):
+        raise ValueError('Targets with different channels can not be merged.')
+
+    merged = dict(targets_metadata[0])
+    merged['TARGETS'] = [md['TARGET'] for md in targets_metadata]
+    merged['SUBSETS'] = {}
+    for md in targets_metadata:
+        for sub_id, subset in md['SUBSETS'].items():
+            merged['SUBSETS'][len(merged['SUBSETS'])] = dict(subset, TARGET=md['TARGET'], SUB_ID=sub_id)
+    return merged
+
+
+def metadata_from_file(file, index=None):
     """Read metadata of single .continuous file header/file stats. Checks if the file contains
     complete records based on the size of the file as header size + integer multiples of records.
 
     Args:
         file: Path to .continuous file
+        index: Optional metadata index. Entries with matching size and modification time are returned
+               without reading the file, missing or stale entries are updated. Safe to share between
+               threads, entries are only ever replaced as a whole.
 
     Returns:
         Dictionary with n_blocks, block_size, n_samples, sampling_rate fields.
     """
+    stat = os.stat(file)
+    if index is not None:
+        entry = index['FILES'].get(os.path.basename(file))
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return dict(entry['metadata'])
+
     header = read_header(file)
     fs = header['sampleRate']
-    n_record_bytes = int(os.path.getsize(file) - SIZE_HEADER)
+    n_record_bytes = int(stat.st_size - SIZE_HEADER)
     n_blocks = n_record_bytes / SIZE_RECORD
     if n_record_bytes % SIZE_RECORD != 0:
         raise ValueError('File {} contains incomplete records!'.format(file))
 
-    n_samples = n_record_bytes - n_blocks * (SIZE_RECORD - SIZE_DATA)
+    n_samples = n_blocks * NUM_SAMPLES
     logger.log(level=LOG_LEVEL_VERBOSE, msg='{}, Fs = {:.2f}Hz, {} blocks, {} samples, {}'
                .format(file, fs, n_blocks, n_samples, util.fmt_time(n_samples / fs)))
 
-    return dict(n_blocks=int(n_blocks),
-                block_size=NUM_SAMPLES,
-                n_samples=int(n_samples),
-                sampling_rate=fs)
+    file_metadata = dict(n_blocks=int(n_blocks),
+                         block_size=NUM_SAMPLES,
+                         n_samples=int(n_samples),
+                         sampling_rate=fs)
+
+    if index is not None:
+        index['FILES'][os.path.basename(file)] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                                  'metadata': file_metadata}
+        index['MODIFIED'] = True
+
+    return dict(file_metadata)
 
 
 def reduce_files_metadata(files_metadata):
@@ -472,7 +1202,7 @@ def metadata_from_xml(base_dir):
 
     # Signal chain/processing nodes
     sc = root.find('SIGNALCHAIN')
-    chain = [dict(type=e.tag, attrib=e.attrib) for e in sc.getchildren()]
+    chain = [dict(type=e.tag, attrib=e.attrib) for e in sc]
 
     # Audio settings
     audio = root.find('AUDIO').attrib
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Open Ephys binary format. A recording directory holds a structure.oebin JSON file describing the
+continuous streams, each written as interleaved int16 continuous.dat file, i.e. the layout
+produced by dm conv. The data files are memory-mapped and used directly.
+
+    recording1/structure.oebin
+    recording1/continuous/Rhythm_FPGA-100.0/continuous.dat
+    recording1/continuous/Rhythm_FPGA-100.0/timestamps.npy
+"""
+
+import json
+import logging
+import os
+import os.path as op
+from pathlib import Path
+from pprint import pformat
+
+import numpy as np
+
+from dataman.lib import util, Streamer
+from dataman.lib.constants import LOG_LEVEL_VERBOSE
+from .open_ephys import NUM_SAMPLES, AMPLITUDE_SCALE
+
+FMT_NAME = 'OEBin'
+FMT_FEXT = '.oebin'
+
+STRUCTURE_FNAME = 'structure.oebin'
+DATA_FNAME = 'continuous.dat'
+DEFAULT_DTYPE = 'int16'
+
+logger = logging.getLogger(__name__)
+
+
+class DataStreamer(Streamer.Streamer):
+    def __init__(self, target_path, metadata, *args, **kwargs):
+        super(DataStreamer, self).__init__(*args, **kwargs)
+        self.target_path = target_path
+        logger.debug('Open Ephys binary Streamer Initialized at {}!'.format(target_path))
+        self.metadata = metadata
+
+        # Mapped lazily in the streaming process
+        self.data = None
+
+    def reposition(self, offset):
+        """Reposition current buffer representing the data file. Also reorders channels according to
+        channel order map.
+        """
+        logger.debug('Rolling to position {}'.format(offset))
+        if self.data is None:
+            self.data = memmap(self.metadata)
+
+        n_samples = self.buffer.buffer.shape[1]
+        start = offset * NUM_SAMPLES
+        window = self.data[start:start + n_samples]
+        if self.channel_order is not None:
+            window = window.take(self.channel_order, axis=1)
+        self.put_samples(window.T, scale=AMPLITUDE_SCALE)
+
+
+def detect(base_path, pre_walk=None):
+    """Checks for existence of an Open Ephys binary data set, i.e. a structure.oebin file, at the target path.
+
+    Args:
+        base_path: Directory to search in, or path to structure.oebin file.
+        pre_walk: Tuple from previous path_content call (root, dirs, files)
+
+    Returns:
+        None if no data set found, else True
+    """
+    root, dirs, files = util.path_content(base_path) if pre_walk is None else pre_walk
+
+    for f in files:
+        if op.basename(f) == STRUCTURE_FNAME:
+            return True
+
+
+def find_structure(target):
+    """Path to the structure.oebin file of a recording, given the recording directory or the file itself."""
+    target = Path(target).resolve()
+    structure_path = target if target.is_file() else target / STRUCTURE_FNAME
+    if not structure_path.exists():
+        raise FileNotFoundError('No {} at {}'.format(STRUCTURE_FNAME, target))
+    return structure_path
+
+
+def memmap(metadata, mode='r'):
+    """Memory-map the continuous.dat file of a stream as (n_samples, n_channels) array."""
+    subset = next(iter(metadata['SUBSETS'].values()))
+    data_path = next(iter(subset['FILES'].values()))['FILEPATH']
+    n_channels = len(subset['FILES'])
+    return np.memmap(data_path, dtype=metadata['DTYPE'], mode=mode).reshape(-1, n_channels)
+
+
+def metadata_from_target(target, stream=0, *args, **kwargs):
+    """Get metadata of a continuous stream of an Open Ephys binary recording. The layout follows the open_ephys
+    module with a single subset, all channels of the subset point to the shared interleaved data file.
+
+    Args:
+        target: Path to recording directory containing structure.oebin, or the structure.oebin file
+        stream: Index of the continuous stream in structure.oebin. Default: 0
+
+    Returns:
+        Dictionary with configuration entries. (DTYPE, TARGET, INFO, SUBSETS, CHANNELS, ...)
+    """
+    structure_path = find_structure(target)
+    with open(str(structure_path), 'r') as sf:
+        structure = json.load(sf)
+
+    continuous = structure['continuous'][stream]
+    data_path = structure_path.parent / 'continuous' / continuous['folder_name'] / DATA_FNAME
+    n_channels = int(continuous['num_channels'])
+    sampling_rate = float(continuous['sample_rate'])
+
+    itemsize = np.dtype(DEFAULT_DTYPE).itemsize
+    n_bytes = os.path.getsize(str(data_path))
+    if n_bytes % (itemsize * n_channels):
+        raise ValueError('File {} does not contain complete samples of {} channels!'.format(data_path, n_channels))
+    n_samples = n_bytes // (itemsize * n_channels)
+
+    files = {}
+    for channel, channel_info in enumerate(continuous['channels']):
+        files[channel] = {'CHANNEL': channel,
+                          'CHANNEL_NAME': channel_info['channel_name'],
+                          'BIT_VOLTS': channel_info['bit_volts'],
+                          'FILEPATH': str(data_path),
+                          'FILENAME': DATA_FNAME}
+
+    joint_headers = {'n_samples': n_samples,
+                     'n_blocks': int(np.ceil(n_samples / NUM_SAMPLES)),
+                     'block_size': NUM_SAMPLES,
+                     'sampling_rate': sampling_rate}
+
+    metadata = {'DTYPE': DEFAULT_DTYPE,
+                'TARGET': str(structure_path.parent),
+                'INFO': {'VERSION': structure.get('GUI version')},
+                'SIGNALCHAIN': None,
+                'FPGA_NODE': continuous.get('source_processor_id'),
+                'AUDIO': None,
+                'SUBSETS': {0: {'FILES': files, 'JOINT_HEADERS': joint_headers}},
+                'CHANNELS': sorted(files)}
+
+    logger.log(level=LOG_LEVEL_VERBOSE, msg=pformat(metadata, indent=2))
+    return metadata
+
+
+def metadata_from_dat(dat_path):
+    """Metadata for a continuous.dat file from the structure.oebin of the recording it belongs to.
+
+    Args:
+        dat_path: Path to a .dat file
+
+    Returns:
+        Metadata dictionary of the stream the file belongs to, None if the file is not part of a recording.
+    """
+    dat_path = Path(dat_path).resolve()
+    structure_path = dat_path.parents[2] / STRUCTURE_FNAME if len(dat_path.parents) > 2 else None
+    if dat_path.name != DATA_FNAME or structure_path is None or not structure_path.exists():
+        return None
+
+    with open(str(structure_path), 'r') as sf:
+        folders = [c['folder_name'].rstrip('/') for c in json.load(sf)['continuous']]
+    if dat_path.parent.name not in folders:
+        return None
+    return metadata_from_target(structure_path, stream=folders.index(dat_path.parent.name))
@@ -10,6 +10,7 @@ Stream data to buffer
 import logging
 import multiprocessing as mp
 import signal
+import numpy as np
 from time import time, sleep
 from dataman.lib.SharedBuffer import SharedBuffer
 from queue import Empty
@@ -95,6 +96,20 @@ class Streamer(mp.Process):
     def reposition(self, offset):
         pass
 
+    def put_samples(self, data, scale=1.):
+        """Write (n_channels, n_samples) samples into the shared buffer, zero-padding a window cut short by
+        the end of the data. Integer buffers take the samples as they are, scaling is left to the consumer.
+        Float buffers receive the samples multiplied by scale.
+        """
+        buffer = self.buffer.buffer
+        n_channels, n_samples = min(buffer.shape[0], data.shape[0]), min(buffer.shape[1], data.shape[1])
+        if np.issubdtype(buffer.dtype, np.integer):
+            buffer[:n_channels, :n_samples] = data[:n_channels, :n_samples]
+        else:
+            np.multiply(data[:n_channels, :n_samples], scale, out=buffer[:n_channels, :n_samples], casting='unsafe')
+        buffer[n_channels:] = 0
+        buffer[:n_channels, n_samples:] = 0
+
     def __get_instructions(self):
         cmdlets = []
         while self.queue.qsize():
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Chunk sizes of the streaming stages (conv, ref, split, detect, check), planned from one memory budget.
+
+Every stage holds a few copies of a chunk while processing it, e.g. the converted samples next to the samples read,
+or the float64 filtered signal of detect. STAGE_FACTORS gives the bytes held per byte of input samples, the largest
+chunk of a stage is the memory budget divided by the footprint of one sample of all channels. Within that limit,
+a ChunkPlanner starts with small chunks and doubles their size as long as the measured throughput improves, so
+chunks stay as small as possible without paying for per-chunk overhead.
+
+The budget is set for the whole process with set_memory_limit, from the --mem-limit argument of the subcommands.
+"""
+
+import logging
+import time
+
+from dataman.lib.constants import DEFAULT_MEMORY_LIMIT_MB, LOG_LEVEL_VERBOSE
+
+# Bytes held in memory per byte of input samples
+STAGE_FACTORS = {'read': 2,
+                 'conv': 3,
+                 'ref': 4,
+                 'split': 3,
+                 'detect': 16,
+                 'check': 1}
+
+# Planner starts at this fraction of the largest chunk, growing while throughput improves by at least MIN_GAIN
+PROBE_FRACTION = 16
+MIN_GAIN = 0.05
+# Chunks taking longer than this are halved, to keep progress reports and interrupts responsive
+MAX_CHUNK_SECONDS = 2.
+
+_memory_limit_mb = DEFAULT_MEMORY_LIMIT_MB
+
+logger = logging.getLogger(__name__)
+
+
+def memory_limit():
+    """Memory budget of the streaming stages in MB."""
+    return _memory_limit_mb
+
+
+def set_memory_limit(limit_mb=None):
+    """Set the memory budget of the streaming stages in MB, None for DEFAULT_MEMORY_LIMIT_MB."""
+    global _memory_limit_mb
+    limit_mb = DEFAULT_MEMORY_LIMIT_MB if limit_mb is None else float(limit_mb)
+    if limit_mb <= 0:
+        raise ValueError('Memory limit must be positive, got {} MB'.format(limit_mb))
+    _memory_limit_mb = limit_mb
+    logger.debug('Memory limit of streaming stages: {} MB'.format(limit_mb))
+
+
+def add_memory_argument(parser):
+    """Add the --mem-limit argument to the parser of a subcommand, see apply_memory_argument."""
+    parser.add_argument('--mem-limit', type=float,
+                        help='Memory budget in MB for the chunks of data processed at once. '
+                             'Default: {} MB'.format(DEFAULT_MEMORY_LIMIT_MB))
+
+
+def apply_memory_argument(cli_args):
+    """Set the memory budget from the parsed --mem-limit argument, if given."""
+    if cli_args.mem_limit is not None:
+        set_memory_limit(cli_args.mem_limit)
+
+
+def plan_size(stage, n_channels, itemsize=2, align=1, maximum=None, workers=1, limit_mb=None):
+    """Largest chunk of a stage within the memory budget.
+
+    Args:
+        stage: Key of STAGE_FACTORS
+        n_channels: Number of channels of a sample
+        itemsize: Bytes per channel of a sample
+        align: Chunk size is a multiple of align, e.g. the samples of a record. At least one align.
+        maximum: Upper limit, e.g. the samples of the data set or a fixed chunk duration
+        workers: Number of chunks processed at the same time, sharing the budget
+        limit_mb: Memory budget in MB. Default: memory_limit()
+
+    Returns:
+        Number of samples per chunk.
+    """
+    limit_mb = memory_limit() if limit_mb is None else limit_mb
+    sample_bytes = max(1, int(n_channels)) * int(itemsize) * STAGE_FACTORS[stage] * max(1, int(workers))
+    size = int(limit_mb * 1e6 // sample_bytes) // int(align) * int(align)
+    if maximum is not None:
+        size = min(size, -(-int(maximum) // int(align)) * int(align))
+    return max(int(align), size)
+
+
+class ChunkPlanner:
+    """Chunk sizes of a stage, adapted to the measured throughput within the memory budget of plan_size.
+
+    Usage:
+        planner = ChunkPlanner('split', n_channels)
+        for start, end in planner.spans(0, n_samples):
+            ...  # process samples [start, end)
+    """
+
+    def __init__(self, stage, n_channels, itemsize=2, align=1, workers=1, limit_mb=None):
+        self.stage = stage
+        self.align = int(align)
+        self.max_size = plan_size(stage, n_channels, itemsize=itemsize, align=align, workers=workers,
+                                  limit_mb=limit_mb)
+        self.size = max(self.align, self.max_size // PROBE_FRACTION // self.align * self.align)
+        self.growing = self.size < self.max_size
+        self.best_rate = 0.
+        logger.log(level=LOG_LEVEL_VERBOSE, msg='{} chunks of {} to {} samples'.format(stage, self.size,
+                                                                                       self.max_size))
+
+    def update(self, n_samples, elapsed):
+        """Adapt the chunk size after processing n_samples in elapsed seconds."""
+        if elapsed <= 0 or n_samples < self.size:
+            # the last, shorter chunk tells nothing about the current size
+            return
+
+        rate = n_samples / elapsed
+        if self.growing:
+            if rate > self.best_rate * (1 + MIN_GAIN):
+                self.best_rate = rate
+                self.size = min(self.max_size, self.size * 2)
+                self.growing = self.size < self.max_size
+            else:
+                self.growing = False
+
+        if elapsed > MAX_CHUNK_SECONDS and self.size > self.align:
+            self.size = max(self.align, self.size // 2 // self.align * self.align)
+            self.growing = False
+
+    def spans(self, start, end):
+        """Iterate over (start, end) of consecutive chunks covering [start, end). The time until the next chunk is
+        requested counts as processing time of a chunk."""
+        position = int(start)
+        while position < end:
+            size = min(self.size, int(end) - position)
+            t_start = time.perf_counter()
+            yield position, position + size
+            self.update(size, time.perf_counter() - t_start)
+            position += size
+
+
+def iter_chunks(data_file, planner, channels=None, start=0, end=None):
+    """Iterate over (start, end, window) chunks of a dat.DatFile, datz.DatzFile or hdf5.H5File, sized by planner.
+    Reading a window counts as part of processing the chunk."""
+    end = data_file.n_samples if end is None else min(data_file.n_samples, int(end))
+    for chunk_start, chunk_end in planner.spans(start, end):
+        yield chunk_start, chunk_end, data_file.window(chunk_start, chunk_end - chunk_start, channels)
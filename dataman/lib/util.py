@@ -12,7 +12,7 @@ from scipy import signal
 from termcolor import colored
 
 from dataman.formats import get_valid_formats
-from dataman.lib.constants import DEFAULT_MEMORY_LIMIT_MB
+from dataman.lib import chunking
 
 ansi_escape = re.compile(r'\x1b[^m]*m')
 logger = logging.getLogger(__name__)
@@ -26,8 +26,9 @@ def butter_bandpass(lowcut, highcut, fs, order=5):
     return b, a
 
 
-def get_batch_size(arr, ram_limit=DEFAULT_MEMORY_LIMIT_MB):
-    """Get batch size for an array given memory limit per batch"""
+def get_batch_size(arr, ram_limit=None):
+    """Get batch size for an array given memory limit per batch. Default: memory budget of chunking"""
+    ram_limit = chunking.memory_limit() if ram_limit is None else ram_limit
     batch_size = int(ram_limit * 1e6 / arr.shape[1] / arr.dtype.itemsize)
     return batch_size
 
@@ -1,8 +1,9 @@
 from os import path as op, remove
 from shutil import copyfile
 import numpy as np
-from dataman.lib.util import get_batch_limits, get_batch_size, run_prb, flat_channel_list, has_prb
+from dataman.lib.util import run_prb, flat_channel_list, has_prb
 from dataman.formats import dat
+from dataman.lib import chunking
 import logging
 from tqdm import trange, tqdm
 from pathlib import Path
@@ -38,75 +39,81 @@ def subtract_reference(dat_path, ref_path, precision='single', inplace=False,
     logger.debug('Subtracting {} from {}'.format(ref_path, dat_path))
     logger.debug('Precision: {}, inplace={} with {} channels'.format(precision, inplace, n_channels))
     logger.debug('Opening files, dat: {}; ref: {}'.format(dat_path, ref_path))
-    with open(dat_path, 'r+b') as dat_file, open(ref_path, 'r+b') as ref_file:
-        dat_arr = np.memmap(dat_file, dtype='int16').reshape(-1, n_channels)
-        ref_arr = np.memmap(ref_file, dtype=precision).reshape(-1, 1)
-        assert (dat_arr.shape[0] == ref_arr.shape[0])
+    dat_file = dat.open_file(dat_path, n_channels=n_channels, mode='r+' if inplace else 'r')
+    ref_arr = np.memmap(ref_path, dtype=precision, mode='r').reshape(-1, 1)
+    assert (dat_file.n_samples == ref_arr.shape[0])
 
     fname, ext = op.splitext(dat_path)
     out_path = fname + '_meanref' + ext
 
     logger.debug('Bad channels: {}, zeroing: {}'.format(ch_idx_bad, zero_bad_channels))
 
+    planner = chunking.ChunkPlanner('ref', dat_file.n_channels, dat_file.dtype.itemsize)
+    pbar = tqdm(total=dat_file.n_samples, unit_scale=True, unit='Samples')
     try:
         if inplace:
-            out_arr = dat_arr
-        else:
-            out_arr = np.memmap(out_path, mode='w+', dtype=dat_arr.dtype, shape=dat_arr.shape)
-
-        batches = get_batch_limits(dat_arr.shape[0], get_batch_size(dat_arr))
-
-        for start, end in tqdm(batches):
-            logger.debug(str((start, end)))
-            if inplace:
+            out_arr = dat_file.data
+            for start, end in planner.spans(0, dat_file.n_samples):
+                logger.debug(str((start, end)))
+                pbar.update(end - start)
                 out_arr[start:end, :] -= ref_arr[start:end].astype(out_arr.dtype)
-            else:
-                out_arr[start:end, :] = dat_arr[start:end, :] - ref_arr[start:end]
-
-            if zero_bad_channels and ch_idx_bad is not None:
-                logger.info('Zeroing channels {}'.format(ch_idx_bad))
-                out_arr[start:end, ch_idx_bad] = 0
+                if zero_bad_channels and ch_idx_bad is not None:
+                    logger.info('Zeroing channels {}'.format(ch_idx_bad))
+                    out_arr[start:end, ch_idx_bad] = 0
+        else:
+            # Written as stream, the output is a .dat or compressed .datz file like the input
+            with dat.create_writer(out_path, dat_file.n_channels, dtype=dat_file.dtype,
+                                   sampling_rate=dat_file.sampling_rate) as out_file:
+                for start, end, batch in chunking.iter_chunks(dat_file, planner):
+                    logger.debug(str((start, end)))
+                    pbar.update(end - start)
+                    out_batch = (batch - ref_arr[start:end]).astype(dat_file.dtype)
+                    if zero_bad_channels and ch_idx_bad is not None:
+                        logger.info('Zeroing channels {}'.format(ch_idx_bad))
+                        out_batch[:, ch_idx_bad] = 0
+                    out_file.write(out_batch)
 
     except BaseException as e:
         print(e)
     else:
         return out_path
+    finally:
+        pbar.close()
+        dat_file.close()
 
 
 def make_ref_file(dat_path, n_channels, ref_out_fname=None, precision='float32',
                   ch_idx_good=None, ch_idx_bad=None, *args, **kwargs):
     """Create reference file, that is a file of the mean of all good channels of a .dat file."""
     if ref_out_fname is None:
+        # the reference is a raw float file, also for compressed inputs
         fname, ext = op.splitext(dat_path)
-        ref_out_fname = fname + '_reference' + ext
-
-    with open(dat_path, 'rb') as dat_file, open(ref_out_fname, 'wb+') as ref_file:
-        dat_arr = np.memmap(dat_file, mode='r', dtype='int16').reshape(-1, n_channels)
+        ref_out_fname = fname + '_reference' + dat.FMT_FEXT
 
+    with dat.open_file(dat_path, n_channels=n_channels) as dat_file, open(ref_out_fname, 'wb+') as ref_file:
         assert not (ch_idx_good is not None and ch_idx_bad is not None)
         if ch_idx_bad is not None:
-            ch_idx_good = [c for c in range(dat_arr.shape[1]) if c not in ch_idx_bad]
+            ch_idx_good = [c for c in range(dat_file.n_channels) if c not in ch_idx_bad]
         if ch_idx_good is not None:
             n_channels = len(ch_idx_good)
         else:
-            n_channels = dat_arr.shape[1]
+            n_channels = dat_file.n_channels
 
-        all_good = set(range(n_channels)) == set(ch_idx_good)
+        all_good = ch_idx_good is None or set(range(dat_file.n_channels)) == set(ch_idx_good)
 
         logger.debug(
             'Reference will be created at {} from {} channels'.format(ref_file.name, n_channels))
         if all_good:
             logger.debug('All channels good, will calculate mean over all channels.')
 
-        batches = get_batch_limits(dat_arr.shape[0], get_batch_size(dat_arr))
-        for start, end in tqdm(batches):
-            logger.debug(str((start, end)))
-            if ch_idx_good is None or all_good:
-                batch = dat_arr[start:end, :]
-            else:
-                batch = dat_arr[start:end, :].take(ch_idx_good, axis=1)
-            mean = np.mean(batch, axis=1, dtype=precision)
-            mean.tofile(ref_file)
+        channels = None if ch_idx_good is None or all_good else ch_idx_good
+        planner = chunking.ChunkPlanner('ref', dat_file.n_channels, dat_file.dtype.itemsize)
+        with tqdm(total=dat_file.n_samples, unit_scale=True, unit='Samples') as pbar:
+            for start, end, batch in chunking.iter_chunks(dat_file, planner, channels=channels):
+                logger.debug(str((start, end)))
+                pbar.update(end - start)
+                mean = np.mean(batch, axis=1, dtype=precision)
+                mean.tofile(ref_file)
 
     return ref_out_fname
 
@@ -130,7 +137,9 @@ def main(args):
     parser.add_argument('-m', '--make-only', action='store_true', help='Only create the reference file.')
     parser.add_argument('-l', '--layout', help='Path to probe file defining channel order')
     parser.add_argument('-k', '--keep', action='store_true', help='Keep intermediate reference file')
+    chunking.add_memory_argument(parser)
     cli_args = parser.parse_args(args)
+    chunking.apply_memory_argument(cli_args)
 
     # get number of channels in data, either from the cli args or data set config
     n_channels = cli_args.channels if 'channels' in cli_args else None
@@ -178,3 +187,4 @@ def main(args):
     if not cli_args.inplace:
         logger.warning('Copying probe file to follow referenced data.')
         copy_as(probe_file, reffed_path.with_suffix('.prb'))
+        dat.copy_sidecar(cli_args.input, reffed_path)
@@ -5,10 +5,10 @@ import sys
 from contextlib import ExitStack
 from pathlib import Path
 
-import numpy as np
 from tqdm import tqdm
 
 from dataman.formats import dat
+from dataman.lib import chunking
 from dataman.lib.util import run_prb, write_prb
 
 logger = logging.getLogger(__name__)
@@ -21,7 +21,7 @@ def main(args):
     parser.add_argument('-o', '--out', help='Directory to store segments in', default='.')
     parser.add_argument('-c', '--clean', action='store_true', help='Remove the original dat file when successful')
     parser.add_argument('-C', '--channels', type=int, help='Number of channels in input file.')
-    parser.add_argument('-d', '--dtype', default='int16')
+    parser.add_argument('-d', '--dtype', help='Sample data type. Default: from metadata sidecar, or int16')
     parser.add_argument('-p', '--prefix', default='tetrode',
                         help='Prefix to output file name. Default: "tetrode"')  # '{infile}_'
     parser.add_argument('--keep_dead', help='Do not skip tetrodes with all-dead channels', action='store_true')
@@ -29,12 +29,17 @@ def main(args):
     grouping = parser.add_mutually_exclusive_group()
     grouping.add_argument('-l', '--layout', help='Path to probe file defining channel order')
     grouping.add_argument('-g', '--groups_of', type=int, help='Split into regular groups of n channels')
+    chunking.add_memory_argument(parser)
 
     cli_args = parser.parse_args(args)
+    chunking.apply_memory_argument(cli_args)
     logger.debug('cli_args: {}'.format(cli_args))
 
     in_path = os.path.abspath(os.path.expanduser(cli_args.input))
     bp, ext = os.path.splitext(in_path)
+    sidecar = dat.layout_info(in_path)
+    dtype = cli_args.dtype if cli_args.dtype is not None else \
+        sidecar['dtype'] if sidecar is not None else dat.DEFAULT_DTYPE
 
     probe_file = cli_args.layout
     if not any([cli_args.layout, cli_args.groups_of]):
@@ -51,7 +56,10 @@ def main(args):
         n_channels = sum([len(cg['channels']) for idx, cg in channel_groups.items()])
         logger.debug('{} channels from prb file'.format(n_channels))
     else:
-        if cli_args.channels is None:
+        if cli_args.channels is None and sidecar is not None:
+            n_channels = sidecar['n_channels']
+            logger.debug('{} channels from metadata sidecar'.format(n_channels))
+        elif cli_args.channels is None:
             logging.warning('No channel count given. Guessing...')
             n_channels = dat.guess_n_channels(in_path)
             logging.warning('Guessed there to be {} channels'.format(n_channels))
@@ -64,7 +72,7 @@ def main(args):
 
     logging.debug('channel_groups: {}'.format(channel_groups))
 
-    mm = np.memmap(in_path, dtype=cli_args.dtype, mode='r').reshape(-1, n_channels)
+    dat_file = dat.open_file(in_path, n_channels=n_channels, dtype=dtype)
 
     # Select valid channel groups, skip group with all-dead channels
     indices = []
@@ -91,13 +99,15 @@ def main(args):
     #     prb_out.write('dead_channels = {}\n'.format(pprint.pformat(dead_channels)))
     #     prb_out.write('channel_groups = {}'.format(pprint.pformat(cg_out)))
 
-    batch_size = 1_000_000
-    n_samples = mm.shape[0]
+    planner = chunking.ChunkPlanner('split', dat_file.n_channels, dat_file.dtype.itemsize)
+    n_samples = dat_file.n_samples
     pbar = tqdm(total=n_samples, unit_scale=True, unit='Samples')
-    postfix = '{cg_id:0' + str(math.floor(math.log10(max(indices))) + 1) + 'd}.dat'
+    # outputs are in the format of the input
+    postfix = '{cg_id:0' + str(math.floor(math.log10(max(indices))) + 1) + 'd}' + ext
 
     with ExitStack() as stack:
         out_files = {}
+        out_paths = {}
         for cg_id in indices:
             dat_path = Path((cli_args.prefix + postfix).format(cg_id=cg_id, infile=bp))
             prb_path = dat_path.with_suffix('.prb')
@@ -107,21 +117,22 @@ def main(args):
             cg_out = {0: {'channels': list(range(len(ch_out)))}}
             dead_ch = sorted([ch_out.index(dc) for dc in dead_channels if dc in ch_out])
             write_prb(prb_path, cg_out, dead_ch)
+            out_paths[cg_id] = dat_path
 
-            # Create file object for .dat file and append to exit stack for clean shutdown
-            of = open(dat_path, 'wb')
+            # Create writer for .dat file and append to exit stack for clean shutdown
+            of = dat.create_writer(dat_path, len(ch_out), dtype=dtype, sampling_rate=dat_file.sampling_rate)
             out_files[cg_id] = stack.enter_context(of)
 
-        samples_remaining = n_samples
-        while samples_remaining > 0:
-            pbar.update(batch_size)
-            offset = n_samples - samples_remaining
-            arr = mm[offset:offset + batch_size, :]
+        for start, end, arr in chunking.iter_chunks(dat_file, planner):
+            pbar.update(end - start)
             for cg_id in out_files.keys():
-                arr.take(channel_groups[cg_id]['channels'], axis=1).tofile(out_files[cg_id])
-            samples_remaining -= batch_size
+                out_files[cg_id].write(arr.take(channel_groups[cg_id]['channels'], axis=1))
 
-    del mm
+    dat_file.close()
+
+    # After the writers are closed, .h5 outputs take the metadata as attributes
+    for cg_id, dat_path in out_paths.items():
+        dat.copy_sidecar(in_path, dat_path, n_channels=len(channel_groups[cg_id]['channels']), dtype=dtype)
 
     try:
         if cli_args.clean:
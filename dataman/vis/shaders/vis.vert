@@ -10,6 +10,9 @@ varying vec3 v_index;
 // 2D scaling factor (zooming).
 uniform vec2 u_scale;
 
+// Amplitude scaling of raw sample values.
+uniform float u_gain;
+
 // Size of the table.
 uniform vec2 u_size;
 
@@ -30,7 +33,7 @@ void main() {
 
     // Compute the x coordinate from the time index.
     float x = -1 + 2*a_index.z*u_scale.x / (u_n-1);
-    vec2 position = vec2(x, a_position*u_scale.y);
+    vec2 position = vec2(x, a_position*u_gain*u_scale.y);
 
     // Find the affine transformation for the subplots.
     vec2 a = vec2(1./ncols, 1./nrows)*1.0;  // reduce to e.g. 0.98 for borders between columns
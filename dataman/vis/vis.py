@@ -22,7 +22,9 @@ with open(os.path.join(SHADER_PATH, 'vis.vert')) as vs:
 with open(os.path.join(SHADER_PATH, 'vis.frag')) as fs:
     FRAG_SHADER = fs.read()
 
-BUFFER_DTYPE = 'float32'
+# Raw samples are kept in the shared buffer and scaled in the vertex shader
+BUFFER_DTYPE = 'int16'
+UPLOAD_DTYPE = 'float32'
 BUFFER_LENGTH = int(3e4)
 
 
@@ -35,7 +37,11 @@ class Vis(app.Canvas):
         # Target configuration (format, sampling rate, sizes...)
         self.target_path = target_path
         self.logger.debug('Target path: {}'.format(target_path))
-        self.format = util.detect_format(self.target_path)
+
+        # Session files list several recordings, joined into one continuous view
+        from dataman.conv.convert import expand_sessions
+        self.targets = [util.full_path(t) for t in expand_sessions([target_path])]
+        self.format = util.detect_format(self.targets[0])
         self.logger.debug('Target module: {}'.format(self.format))
         assert self.format is not None
 
@@ -53,14 +59,15 @@ class Vis(app.Canvas):
             self.block_size = self.metadata['HEADER']['block_size']
 
         elif 'SUBSETS' in self.metadata:
-            # FIXME: Only traverses first subset.
             self.logger.debug('Using new style metadata dictionary layout')
-            # get number of channels and sampling rate from first subset
+            # get number of channels and sampling rate from first subset, subsets are shown back to back
             first_subset = next(iter(self.metadata['SUBSETS'].values()))
             self.fs = first_subset['JOINT_HEADERS']['sampling_rate']
-            self.n_samples_total = int(first_subset['JOINT_HEADERS']['n_samples'])
+            self.n_samples_total = sum([int(subset['JOINT_HEADERS']['n_samples'])
+                                        for subset in self.metadata['SUBSETS'].values()])
             self.n_channels = len(first_subset['FILES'])
             self.block_size = first_subset['JOINT_HEADERS']['block_size']
+            self.input_dtype = self.metadata['DTYPE']
         else:
             raise ValueError('Unknown metadata format from target.')
 
@@ -80,7 +87,11 @@ class Vis(app.Canvas):
         # Buffer to store all the pre-loaded signals
         self.buf = SharedBuffer.SharedBuffer()
         self.buffer_length = BUFFER_LENGTH
-        self.buf.initialize(n_channels=self.n_channels, n_samples=self.buffer_length, np_dtype=BUFFER_DTYPE)
+        # Other input types (e.g. float32 .dat files) are converted and scaled by the streamer
+        native = self.input_dtype is None or np.dtype(self.input_dtype) == np.dtype(BUFFER_DTYPE)
+        self.buffer_dtype = BUFFER_DTYPE if native else UPLOAD_DTYPE
+        self.gain = getattr(self.format, 'AMPLITUDE_SCALE', 1.) if self.buffer_dtype == BUFFER_DTYPE else 1.
+        self.buf.initialize(n_channels=self.n_channels, n_samples=self.buffer_length, np_dtype=self.buffer_dtype)
 
         # Streamer to keep buffer filled
         self.streamer = None
@@ -173,16 +184,23 @@ class Vis(app.Canvas):
         # needs a copy to make memory contiguous
         idc = np.transpose(np.array([col_idc, row_idc, ch_idc], dtype='float32'))
 
-        self.program['a_position'] = np.ones((self.n_channels, self.buffer_length), dtype=BUFFER_DTYPE)
+        self.program['a_position'] = np.ones((self.n_channels, self.buffer_length), dtype=UPLOAD_DTYPE)
         self.program['a_color'] = color
         self.program['a_index'] = idc.copy()
         self.program['u_scale'] = (1., max(.1, 1. - 1 / self.n_channels))
+        self.program['u_gain'] = self.gain
         self.program['u_size'] = (self.n_rows, self.n_cols)
         self.program['u_n'] = self.buffer_length
 
     def _get_target_config(self, *args, **kwargs):
         self.logger.debug('Target found: {}'.format(self.format.FMT_NAME))
-        return self.format.metadata_from_target(self.target_path, *args, **kwargs)
+        if len(self.targets) == 1:
+            return self.format.metadata_from_target(self.targets[0], *args, **kwargs)
+
+        if not hasattr(self.format, 'merge_metadata'):
+            raise ValueError('{} targets can not be joined into a single view.'.format(self.format.FMT_NAME))
+        return self.format.merge_metadata([self.format.metadata_from_target(t, *args, **kwargs)
+                                           for t in self.targets])
 
     def set_scale(self, factor_x=1.0, factor_y=1.0, scale_x=None, scale_y=None):
         self.dirty = True
@@ -309,7 +327,9 @@ class Vis(app.Canvas):
 
             # Apply filter settings
             if self.apply_filter:
-                data = signal.filtfilt(self.filter[0], self.filter[1], data, axis=1).astype(np.float32)
+                data = signal.filtfilt(self.filter[0], self.filter[1], data, axis=1).astype(UPLOAD_DTYPE)
+            else:
+                data = data.astype(UPLOAD_DTYPE)
 
             self.program['a_position'].set_data(data)
 
@@ -333,7 +353,7 @@ def run(*args, **kwargs):
                                      <Shift>/<Ctrl>+<left>/<right> for larger jumps.
                                      <Shift>/<Ctrl>+Mousewheel to scale.
                                      Use <q> or <Esc> to exit. """)
-    parser.add_argument('path', help='Relative or absolute path to directory',
+    parser.add_argument('path', help='Relative or absolute path to directory or .session file',
                         default='.', nargs='?')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Debug mode -- verbose output, no confirmations.')
@@ -0,0 +1,36 @@
+import numpy as np
+
+from dataman.formats import open_ephys as oe
+
+SETTINGS = """<?xml version="1.0"?>
+<SETTINGS><INFO><VERSION>0.4.4</VERSION><DATE>1 Jan 2020</DATE><OS>Linux</OS><MACHINE>m</MACHINE></INFO>
+<SIGNALCHAIN><PROCESSOR name="Sources/Rhythm FPGA" NodeId="100"/><PROCESSOR name="Sinks/Record" NodeId="101"/>
+</SIGNALCHAIN><AUDIO bufferSize="1024"/></SETTINGS>"""
+
+HEADER = "header.format = 'Open Ephys Data Format'; \nheader.version = 0.4;\nheader.header_bytes = 1024;\n" \
+         "header.description = 'x';\nheader.date_created = '1-Jan-2020 000000';\nheader.channel = 'CH{channel}';\n" \
+         "header.channelType = 'Continuous';\nheader.sampleRate = 30000;\nheader.blockLength = 1024;\n" \
+         "header.bufferSize = 1024;\nheader.bitVolts = 0.195;\n"
+
+
+def write_recording(path, n_channels, n_records, seed=0):
+    """Recording directory of n_channels .continuous files with n_records records of noise each.
+
+    Returns:
+        List of paths of the .continuous files, in channel order.
+    """
+    path.mkdir()
+    (path / 'settings.xml').write_text(SETTINGS)
+    rng = np.random.RandomState(seed)
+    file_paths = []
+    for channel in range(1, n_channels + 1):
+        records = np.zeros(n_records, dtype=oe.DATA_DT)
+        records['timestamp'] = np.arange(n_records) * oe.NUM_SAMPLES
+        records['n_samples'] = oe.NUM_SAMPLES
+        records['samples'] = rng.randint(-2000, 2000, size=(n_records, oe.NUM_SAMPLES))
+        records['rec_mark'] = oe.REC_MARKER
+        file_paths.append(path / oe.NAME_TEMPLATE.format(proc_node=100, channel_type='CH', channel=channel, sub_id=''))
+        with open(str(file_paths[-1]), 'wb') as fid:
+            fid.write(HEADER.format(channel=channel).encode().ljust(oe.SIZE_HEADER))
+            records.tofile(fid)
+    return [str(file_path) for file_path in file_paths]
@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import os.path as op
+from pathlib import Path
+
+import numpy as np
+
+from dataman.conv import convert
+from dataman.ref import referencing
+from dataman.split import split
+from tests.helpers import write_recording
+
+
+def target(name, n_blocks=10, block_size=1024, sampling_rate=30000.):
+    headers = {'n_blocks': n_blocks, 'block_size': block_size, 'sampling_rate': sampling_rate,
+               'n_samples': n_blocks * block_size}
+    return {'TARGET': name, 'SUBSETS': {0: {'JOINT_HEADERS': headers}}}
+
+
+def test_schedule_without_duration_limit():
+    targets = [target('a'), target('b')]
+    for duration in [None, 0]:
+        schedule = convert.conversion_schedule(targets, duration)
+        assert [(md['TARGET'], start, n_samples) for md, _, start, n_samples in schedule] == \
+            [('a', 0, 10240), ('b', 10240, 10240)]
+
+
+def test_schedule_duration_limit():
+    # 0.5 s at 30 kHz: all 10 records of the first target, 4 of the second, less than a record left for the third
+    schedule = convert.conversion_schedule([target('a'), target('b'), target('c')], 0.5)
+    assert [(md['TARGET'], start, n_samples) for md, _, start, n_samples in schedule] == \
+        [('a', 0, 10240), ('b', 10240, 4096), ('c', 14336, 0)]
+
+
+def write_session(path, n_recordings=3, n_channels=8, n_records=20):
+    """Recordings rec00, rec01, ... of n_channels noise channels and a probe file of tetrodes, channel 5 dead."""
+    targets = []
+    for n in range(n_recordings):
+        targets.append(Path(path, 'rec{:02d}'.format(n)))
+        write_recording(targets[-1], n_channels, n_records, seed=n)
+    channel_groups = {cg: {'channels': list(range(cg * 4, cg * 4 + 4))} for cg in range(n_channels // 4)}
+    Path(path, 'rec.prb').write_text('dead_channels = [5]\nchannel_groups = {}\n'.format(channel_groups))
+    return [str(target) for target in targets], str(Path(path, 'rec.prb'))
+
+
+def dat_files(path):
+    return {name: Path(path, name).read_bytes() for name in sorted(os.listdir(str(path))) if name.endswith('.dat')}
+
+
+def test_parallel_matches_sequential(tmpdir):
+    targets, prb = write_session(str(tmpdir))
+    for extra in [[], ['-l', prb, '-S']]:
+        outputs = []
+        for jobs in [1, 2]:
+            out_path = op.join(str(tmpdir), 'out{}{}'.format(len(extra), jobs))
+            convert.main(targets + ['-o', out_path, '-N', str(jobs)] + extra)
+            outputs.append(dat_files(out_path))
+        assert len(outputs[0]) == (2 if len(extra) else 1)
+        assert outputs[0] == outputs[1]
+
+
+def test_pipeline_matches_stages(tmpdir, monkeypatch):
+    targets, prb = write_session(str(tmpdir), n_recordings=1)
+    staged_path, pipeline_path = op.join(str(tmpdir), 'staged'), op.join(str(tmpdir), 'pipeline')
+    convert.main(targets + ['-l', prb, '-o', staged_path])
+    convert.main(targets + ['-l', prb, '-o', pipeline_path, '--pipeline', 'ref,split'])
+
+    # split writes into the working directory
+    monkeypatch.chdir(staged_path)
+    referencing.main(['rec00--cg00.dat', '-Z'])
+    split.main(['rec00--cg00_meanref.dat'])
+
+    staged = {name: data for name, data in dat_files(staged_path).items() if name.startswith('tetrode')}
+    assert sorted(staged) == ['tetrode0.dat', 'tetrode1.dat']
+    assert staged == dat_files(pipeline_path)
+    assert not np.frombuffer(staged['tetrode1.dat'], dtype='int16').reshape(-1, 4)[:, 1].any()
+
+
+def interrupted_conversion(tmpdir, monkeypatch, n_kept, n_claimed):
+    """Converted session, and its output and checkpoint as left by a conversion interrupted n_kept samples into
+    the second target, with n_claimed samples of the second target recorded in the checkpoint."""
+    targets, _ = write_session(str(tmpdir), n_recordings=2)
+    out_path = op.join(str(tmpdir), 'out')
+    with monkeypatch.context() as m:
+        m.setattr(convert.Checkpoint, 'remove', lambda self: None)
+        convert.main(targets + ['-o', out_path])
+    dat_path = op.join(out_path, 'rec00--cg00.dat')
+    converted = Path(dat_path).read_bytes()
+
+    checkpoint_path = dat_path + convert.CHECKPOINT_SUFFIX
+    with open(checkpoint_path, 'r') as cf:
+        stored = json.load(cf)
+    n_first = stored['done'][0]
+    stored['done'][1] = n_claimed
+    with open(checkpoint_path, 'w') as cf:
+        json.dump(stored, cf)
+    with open(dat_path, 'r+b') as fid:
+        fid.truncate((n_first + n_kept) * 8 * 2)
+    return targets, out_path, dat_path, converted, n_first
+
+
+def test_resume(tmpdir, monkeypatch, caplog):
+    # the checkpoint claims more than was written before the interruption
+    targets, out_path, dat_path, converted, _ = interrupted_conversion(tmpdir, monkeypatch, 7000, 9000)
+    caplog.set_level(logging.INFO, logger=convert.__name__)
+    convert.main(targets + ['-o', out_path, '--resume'])
+    assert 'rec01 at sample 6144 of 20480' in caplog.text
+    assert Path(dat_path).read_bytes() == converted
+    assert not op.exists(dat_path + convert.CHECKPOINT_SUFFIX)
+
+
+def test_resume_mismatched_tail(tmpdir, monkeypatch, caplog):
+    targets, out_path, dat_path, converted, n_first = interrupted_conversion(tmpdir, monkeypatch, 7000, 7000)
+    # the last record before the resume position (6144) does not match the source
+    samples = np.memmap(dat_path, dtype='int16', mode='r+').reshape(-1, 8)
+    samples[n_first + 6000] = 12345
+    samples.flush()
+    del samples
+    caplog.set_level(logging.INFO, logger=convert.__name__)
+    convert.main(targets + ['-o', out_path, '--resume'])
+    assert 'stepping back one record' in caplog.text
+    assert 'rec01 at sample 5120 of 20480' in caplog.text
+    assert Path(dat_path).read_bytes() == converted
+    assert not op.exists(dat_path + convert.CHECKPOINT_SUFFIX)
@@ -0,0 +1,57 @@
+import os.path as op
+import warnings
+
+import numpy as np
+
+from dataman.formats import dat
+
+
+def write_tetrode(path, n_channels=4, n_samples=2 ** 16, seed=0):
+    """Sidecar-less int16 .dat file of smooth, slowly drifting channels."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_samples)[:, None]
+    samples = 800 * np.sin(2 * np.pi * t / rng.uniform(200, 2000, n_channels)) \
+        + np.cumsum(rng.normal(0, 4, (n_samples, n_channels)), axis=0) + rng.normal(0, 10, (n_samples, n_channels))
+    samples.astype('int16').tofile(str(path))
+
+
+def test_int16_without_sidecar(tmpdir):
+    for seed in range(10):
+        for n_channels in [4, 16]:
+            path = op.join(str(tmpdir), 'tetrode{}_{}.dat'.format(n_channels, seed))
+            write_tetrode(path, n_channels=n_channels, seed=seed)
+            metadata = dat.metadata_from_target(path)
+            assert (str(np.dtype(metadata['DTYPE'])), metadata['CHANNELS']['n_channels']) == ('int16', n_channels)
+
+
+def test_rank_layouts_finite(tmpdir):
+    path = op.join(str(tmpdir), 'tetrode.dat')
+    write_tetrode(path)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        ranking = dat.rank_layouts(path)
+    assert len(ranking)
+    assert all([np.isfinite(score) for _, _, score in ranking])
+    assert [score for _, _, score in ranking] == sorted([score for _, _, score in ranking])
+
+
+def test_int16_zeroed_channels(tmpdir):
+    # ref -Z zeroes dead channels, here every other one
+    path = op.join(str(tmpdir), 'zeroed.dat')
+    write_tetrode(path, n_channels=16)
+    samples = np.fromfile(path, dtype='int16').reshape(-1, 16)
+    samples[:, 1::2] = 0
+    samples.tofile(path)
+    metadata = dat.metadata_from_target(path)
+    assert str(np.dtype(metadata['DTYPE'])) == 'int16'
+    assert not 16 % metadata['CHANNELS']['n_channels']
+
+
+def test_all_zero_and_empty(tmpdir):
+    zeros_path, empty_path = op.join(str(tmpdir), 'zeros.dat'), op.join(str(tmpdir), 'empty.dat')
+    np.zeros((1024, 4), dtype='int16').tofile(zeros_path)
+    open(empty_path, 'wb').close()
+    for path in [zeros_path, empty_path]:
+        metadata = dat.metadata_from_target(path)
+        assert (str(np.dtype(metadata['DTYPE'])), metadata['CHANNELS']['n_channels']) == ('int16', 1)
+        assert dat.guess_dtype(path) == dat.DEFAULT_DTYPE
@@ -0,0 +1,58 @@
+import os.path as op
+
+import numpy as np
+
+from dataman.formats import datz
+
+
+def test_roundtrip(tmpdir):
+    rng = np.random.RandomState(0)
+    samples = rng.randint(-2 ** 15, 2 ** 15, (5000, 3)).astype('int16')
+    for codec in datz.CODECS:
+        path = op.join(str(tmpdir), '{}.datz'.format(codec))
+        # 3000 samples in chunks of 1024 leave a short last chunk, the append adds two more chunks
+        with datz.DatzWriter(path, 3, dtype='int16', chunk_samples=1024, codec=codec) as writer:
+            writer.write(samples[:1000])
+            writer.write(samples[1000:3000])
+        with datz.DatzWriter(path, 3, dtype='int16', mode='a') as writer:
+            writer.write(samples[3000:])
+
+        datz_file = datz.DatzFile(path)
+        assert datz_file.shape == samples.shape
+        assert np.array_equal(datz_file.window(), samples)
+        for start, n_samples in [(0, 1), (1000, 48), (1020, 10), (2990, 20), (2500, 2000), (4999, 10)]:
+            assert np.array_equal(datz_file.window(start, n_samples), samples[start:start + n_samples])
+            assert np.array_equal(datz_file.window(start, n_samples, channels=[2, 0]),
+                                  samples[start:start + n_samples, [2, 0]])
+        for chunk_size, start in [(None, 0), (700, 13), (3000, 1500)]:
+            chunks = list(datz_file.chunks(chunk_size=chunk_size, start=start))
+            assert [chunk_start for chunk_start, _, _ in chunks][0] == start
+            assert np.array_equal(np.concatenate([window for _, _, window in chunks]), samples[start:])
+        datz_file.close()
+
+
+def test_float_roundtrip(tmpdir):
+    samples = np.random.RandomState(1).normal(0, 100, (3000, 2)).astype('float32')
+    path = op.join(str(tmpdir), 'float.datz')
+    with datz.DatzWriter(path, 2, dtype='float32', chunk_samples=1024) as writer:
+        writer.write(samples)
+    assert np.array_equal(datz.DatzFile(path).window(), samples)
+
+
+def test_interrupted_append(tmpdir):
+    samples = np.random.RandomState(2).randint(-2 ** 15, 2 ** 15, (6000, 2)).astype('int16')
+    path = op.join(str(tmpdir), 'append.datz')
+    with datz.DatzWriter(path, 2, dtype='int16', chunk_samples=1024) as writer:
+        writer.write(samples[:3000])
+
+    # chunks of an append are written, but never its index and footer
+    writer = datz.DatzWriter(path, 2, dtype='int16', mode='a')
+    writer.write(samples[3000:5500])
+    writer.fid.close()
+    assert np.array_equal(datz.DatzFile(path).window(), samples[:3000])
+
+    with datz.DatzWriter(path, 2, dtype='int16', mode='a') as writer:
+        writer.write(samples[3000:])
+    datz_file = datz.DatzFile(path)
+    assert np.array_equal(datz_file.window(), samples)
+    assert np.array_equal(datz_file.window(2900, 300), samples[2900:3200])
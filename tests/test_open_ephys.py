@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import numpy as np
+
+from dataman.formats import open_ephys as oe
+from tests.helpers import write_recording
+
+
+def channel_paths(path, n_channels=6, n_records=10):
+    return write_recording(Path(path), n_channels, n_records)
+
+
+def test_pool_eviction(tmpdir):
+    paths = channel_paths(str(tmpdir.join('rec')))
+    with oe.FilePool(max_open=2) as pool:
+        first = pool.get(paths[0])
+        pool.get(paths[1])
+        pool.get(paths[2])
+        assert len(pool) == 2
+        assert first.records is None
+
+        # paths[1] was used last, paths[2] is the least recently used mapping now
+        pool.get(paths[1])
+        pool.get(paths[3])
+        assert sorted(pool._mapped) == sorted([paths[1], paths[3]])
+
+        # evicted files keep their header and are mapped again on demand
+        assert pool.get(paths[0]) is first and first.records is not None and first.header is not None
+    assert len(pool) == 0
+    assert first.records is None
+
+
+def test_scheduled_reads(tmpdir):
+    paths = channel_paths(str(tmpdir.join('rec')))
+    n_total = 10 * oe.NUM_SAMPLES
+    rng = np.random.RandomState(0)
+    requests = [(paths[rng.randint(len(paths))], int(start), 3000)
+                for start in list(rng.randint(0, n_total, 20)) + [0, 1024, n_total - 100, n_total]]
+
+    order = oe.schedule_reads(requests)
+    assert sorted(order) == list(range(len(requests)))
+    assert [requests[i][:2] for i in order] == sorted([request[:2] for request in requests])
+
+    with oe.FilePool(max_open=2) as pool:
+        samples = pool.read(requests)
+    for (path, start, n_samples), row in zip(requests, samples):
+        with oe.ContinuousFile(path) as cf:
+            expected = cf.read(start, n_samples)
+        assert np.array_equal(row[:len(expected)], expected)
+        assert not row[len(expected):].any()
+
+
+def test_pool_batches_larger_than_pool(tmpdir, monkeypatch):
+    paths = channel_paths(str(tmpdir.join('rec')))
+    n_closed = []
+    close = oe.ContinuousFile.close
+    monkeypatch.setattr(oe.ContinuousFile, 'close', lambda self: n_closed.append(self.path) or close(self))
+    with oe.FilePool(max_open=2) as pool:
+        requests = [(path, 0, 1024) for path in paths]
+        first = pool.read(requests)
+        del n_closed[:]
+        # files still mapped from the last batch are read first, only the others are remapped
+        assert np.array_equal(pool.read(requests), first)
+        assert len(n_closed) == len(paths) - 2
+
+
+def test_index_reused(tmpdir):
+    target = tmpdir.join('rec')
+    write_recording(Path(str(target)), 4, 10)
+    first = oe.metadata_from_target(str(target))
+    index_path = target.join(oe.INDEX_FNAME)
+    index_mtime = index_path.stat().mtime_ns
+
+    # the stored listing is still valid after writing the index, so the next open neither rescans nor rewrites
+    index = oe.load_index(str(target))
+    assert index['LISTING']['mtime'] == target.stat().mtime_ns
+    assert oe.metadata_from_target(str(target))['CHANNELS'] == first['CHANNELS']
+    assert index_path.stat().mtime_ns == index_mtime
+    assert oe.list_directory(str(target), index) is index['LISTING']['names'] and 'MODIFIED' not in index